@@ -0,0 +1,56 @@
+# compares the legacy "*"-delimited BSM body with the binary codec
+# run from the repo root: python -m benchmarks.bsm_codec_benchmark
+import argparse
+import timeit
+from collections import namedtuple
+
+from helpers.bsm_codec import encode_bsm, decode_bsm
+
+Location = namedtuple("Location", ["x", "y", "z"])
+
+location = Location(x=-455.123456, y=16.654321, z=0.600412)
+name = "car123"
+crash = False
+speed = 87.3412
+
+
+def legacy_encode():
+    return f"{name}*Location:{location.x},{location.y},{location.z}*Crash:{crash}*Speed:{speed}"
+
+
+def legacy_decode(body):
+    msg_splitted = body.split("*")
+    car_name = msg_splitted[0]
+    car_location = msg_splitted[1].split(":")[1]
+    x, y, z = car_location.split(",")
+    car_speed = float(msg_splitted[3].split(":")[1])
+    car_crash = msg_splitted[2] == "Crash:True"
+    return car_name, float(x), float(y), float(z), car_crash, car_speed
+
+
+def binary_encode():
+    return encode_bsm(name, location, crash, speed)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="BSM codec micro-benchmark")
+    argparser.add_argument('-n', '--number', default=200000, type=int, help='iterations per measurement (default: 200000)')
+    argparser.add_argument('-r', '--repeat', default=5, type=int, help='measurements, best is reported (default: 5)')
+    args = argparser.parse_args()
+
+    legacy_body = legacy_encode()
+    binary_body = binary_encode()
+    cases = [
+        ("legacy encode", legacy_encode),
+        ("binary encode", binary_encode),
+        ("legacy decode", lambda: legacy_decode(legacy_body)),
+        ("binary decode", lambda: decode_bsm(binary_body)),
+    ]
+    print(f"legacy body: {len(legacy_body)} bytes, binary body: {len(binary_body)} bytes")
+    for label, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat))
+        print(f"{label:15s} {best / args.number * 1e6:8.3f} us/msg  {args.number / best:12.0f} msg/s")
+
+
+if __name__ == '__main__':
+    main()
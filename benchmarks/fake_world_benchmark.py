@@ -0,0 +1,93 @@
+import time
+
+from helpers import fake_carla as carla
+
+# Ticks the fake CARLA world in synchronous mode with a growing number of
+# autopilot vehicles and reports how much faster than real time it runs.
+# First checks that the fake traffic flows: with the east-west lights green
+# and the north-south ones red, cars on the map's roads have to cross the
+# green stop lines and none may cross a red one.
+FLEET_SIZES = [100, 1000, 5000]
+TICKS = 100
+DELTA_SECONDS = 0.05
+CHECK_SECONDS = 60.0
+
+
+def spawn_fleet(client, world, size):
+    blueprint = world.get_blueprint_library().find("vehicle.tesla.model3")
+    batch = []
+    for i in range(size):
+        # rows of cars 10 m apart on parallel lanes 4 m apart
+        transform = carla.Transform(carla.Location(x=(i % 100) * 10.0, y=(i // 100) * 4.0 + 500.0, z=0.6))
+        batch.append(carla.command.SpawnActor(blueprint, transform)
+                     .then(carla.command.SetAutopilot(carla.command.FutureActor, True, 8000)))
+    return [response.actor_id for response in client.apply_batch_sync(batch) if not response.error]
+
+
+def new_world():
+    client = carla.Client()
+    world = client.load_world(carla.DEFAULT_MAP)
+    settings = world.get_settings()
+    settings.synchronous_mode = True
+    settings.fixed_delta_seconds = DELTA_SECONDS
+    world.apply_settings(settings)
+    return client, world
+
+
+def stop_line_crossings(start, end, stop_lines):
+    # stop lines (transform, lane_width) a vehicle driving straight from start to end went over
+    crossed = []
+    for transform, width in stop_lines:
+        forward = transform.get_forward_vector()
+        stop = transform.location
+        before = (start.x - stop.x) * forward.x + (start.y - stop.y) * forward.y
+        after = (end.x - stop.x) * forward.x + (end.y - stop.y) * forward.y
+        lateral = abs((start.y - stop.y) * forward.x - (start.x - stop.x) * forward.y)
+        if before < 0 < after and lateral < width / 2:
+            crossed.append(transform)
+    return crossed
+
+
+def check_traffic_lights():
+    client, world = new_world()
+    green, red = [], []
+    for light in world.get_actors().filter("traffic.traffic_light"):
+        is_green = light.get_pole_index() in (0, 2)
+        light.set_state(carla.TrafficLightState.Green if is_green else carla.TrafficLightState.Red)
+        light.freeze(True)
+        stop_lines = [(waypoint.transform, waypoint.lane_width) for waypoint in light.get_stop_waypoints()]
+        (green if is_green else red).extend(stop_lines)
+    blueprint = world.get_blueprint_library().find("vehicle.tesla.model3")
+    batch = [carla.command.SpawnActor(blueprint, transform)
+             .then(carla.command.SetAutopilot(carla.command.FutureActor, True, 8000))
+             for transform in world.get_map().get_spawn_points()]
+    ids = [response.actor_id for response in client.apply_batch_sync(batch) if not response.error]
+    vehicles = world.get_actors(ids)
+    start = {vehicle.id: vehicle.get_location() for vehicle in vehicles}
+    for _ in range(int(CHECK_SECONDS / DELTA_SECONDS)):
+        world.tick()
+    crossed_green = sum(len(stop_line_crossings(start[v.id], v.get_location(), green)) for v in vehicles)
+    crossed_red = sum(len(stop_line_crossings(start[v.id], v.get_location(), red)) for v in vehicles)
+    print(f"traffic check: {len(ids)} vehicles in {CHECK_SECONDS:.0f} s, {crossed_green} green and "
+          f"{crossed_red} red stop line crossings")
+    if not crossed_green or crossed_red:
+        raise SystemExit("fake traffic does not obey the traffic lights")
+
+
+def main():
+    check_traffic_lights()
+    for size in FLEET_SIZES:
+        client, world = new_world()
+        vehicles = spawn_fleet(client, world, size)
+
+        start = time.perf_counter()
+        for _ in range(TICKS):
+            world.tick()
+        elapsed = time.perf_counter() - start
+        simulated = TICKS * DELTA_SECONDS
+        print(f"{len(vehicles):5d} vehicles: {TICKS / elapsed:8.1f} ticks/s, "
+              f"{simulated / elapsed:6.1f}x real time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# messages per second of the crash prevention agents on the fake world and the
+# in-process message bus, with the agents in this process and in N workers,
+# in total and per core. The defaults (BSMs at 2 Hz to vehicles within 50 m)
+# are a load the agents keep up with; a run whose agents parse less than
+# KEEP_UP of what was delivered is marked "behind", its rates are queueing.
+# run from the repo root: python -m benchmarks.shard_benchmark
+import argparse
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+DELIVERED = re.compile(r"(\d+) messages delivered")
+RECEIVED = re.compile(r"age at receipt\s+n=(\d+) p50=([\d.]+) ms")
+KEEP_UP = 0.95
+
+
+def run(workers, args):
+    env = dict(os.environ, V2V_CARLA_BACKEND="fake")
+    command = [sys.executable, "-u", "-m", "simulation_runner", "crash_prevention", "--transport", "bus",
+               "--scenario", args.scenario, "--workers", str(workers), "--no-broadcast",
+               "--bsm-rate", str(args.bsm_rate), "--comm-radius", str(args.comm_radius)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    output = []
+    for line in process.stdout:
+        output.append(line)
+        if line.startswith("spawned"):
+            break
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    process.send_signal(signal.SIGINT)
+    elapsed = time.perf_counter() - started
+    output.append(process.communicate()[0])
+    output = "".join(output)
+    delivered = sum(int(count) for count in DELIVERED.findall(output))
+    received = RECEIVED.search(output)
+    parsed, age = (int(received.group(1)), float(received.group(2))) if received else (0, float("nan"))
+    return delivered / elapsed, parsed / elapsed, age
+
+
+def cores_used(workers, cores):
+    # the coordinator ticks the world next to the workers
+    return min(workers + 1 if workers > 1 else 1, cores)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Multi-process agent sharding benchmark")
+    argparser.add_argument('--scenario', default='dense_traffic', help='scenario to run (default: dense_traffic)')
+    argparser.add_argument('--bsm-rate', default=2.0, type=float, help='simulated BSM rate in Hz (default: 2)')
+    argparser.add_argument('--comm-radius', default=50.0, type=float,
+                           help='metres a BSM reaches (default: 50)')
+    argparser.add_argument('-d', '--duration', default=10.0, type=float, help='seconds measured per run (default: 10)')
+    argparser.add_argument('-w', '--workers', default=[1, 2, 4], type=int, nargs='+',
+                           help='worker counts, 1 is in-process (default: 1 2 4)')
+    args = argparser.parse_args()
+
+    cores = len(os.sched_getaffinity(0))
+    print(f"{cores} cores available")
+    for workers in args.workers:
+        delivered, parsed, age = run(workers, args)
+        used = cores_used(workers, cores)
+        behind = "  behind" if parsed < KEEP_UP * delivered else ""
+        print(f"{workers:2d} workers on {used:2d} cores"
+              f"  delivered {delivered:8.0f} msg/s ({delivered / used:7.0f}/core)"
+              f"  parsed {parsed:8.0f} msg/s ({parsed / used:7.0f}/core)  age p50 {age:7.1f} ms{behind}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# compares the per-vehicle python loop of the lane change HUD with the
+# vectorized assess_threats pass
+# run from the repo root: python -m benchmarks.threat_assessment_benchmark
+import argparse
+import math
+import timeit
+
+import numpy as np
+
+from helpers.threat_assessment import assess_threats
+
+HISTORY = 5
+
+
+class Location:
+    # stand-in for carla.Location so the benchmark runs without CARLA
+    def __init__(self, x, y, z):
+        self.x, self.y, self.z = x, y, z
+
+    def distance(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+
+def getting_closer(positions, my_position):
+    distance = 10000
+    count = 0
+    for pos in positions:
+        dist_to_compare = pos.distance(my_position)
+        if dist_to_compare < distance:
+            distance = dist_to_compare
+            count += 1
+    return count >= 4
+
+
+def legacy_status(speeds, positions, my_speed, my_position):
+    # evaluates every vehicle (no early return) so both paths do the same work
+    return [speeds[key] > my_speed and getting_closer(positions[key], my_position) for key in speeds]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Lane change threat assessment benchmark")
+    argparser.add_argument('-n', '--number', default=200, type=int, help='iterations per measurement (default: 200)')
+    argparser.add_argument('-r', '--repeat', default=5, type=int, help='measurements, best is reported (default: 5)')
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(33)
+    my_position = (0.0, 0.0, 0.0)
+    for vehicles in (10, 100, 1000):
+        positions = rng.uniform(-200, 200, size=(vehicles, HISTORY, 3))
+        speeds = rng.uniform(0, 130, size=vehicles)
+        legacy_positions = {i: [Location(*p) for p in positions[i]] for i in range(vehicles)}
+        legacy_speeds = {i: speeds[i] for i in range(vehicles)}
+        legacy_me = Location(*my_position)
+
+        legacy = min(timeit.repeat(lambda: legacy_status(legacy_speeds, legacy_positions, 60.0, legacy_me),
+                                   number=args.number, repeat=args.repeat)) / args.number
+        vectorized = min(timeit.repeat(lambda: assess_threats(positions, speeds, my_position, 60.0),
+                                       number=args.number, repeat=args.repeat)) / args.number
+        print(f"{vehicles:5d} vehicles  legacy {legacy * 1e3:8.3f} ms  vectorized {vectorized * 1e3:8.3f} ms"
+              f"  speedup {legacy / vectorized:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
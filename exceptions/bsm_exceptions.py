@@ -0,0 +1,4 @@
+class InvalidBSM(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,10 @@
+class InvalidScenario(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class InvalidTimingPlan(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
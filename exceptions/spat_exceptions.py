@@ -0,0 +1,4 @@
+class InvalidSpat(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
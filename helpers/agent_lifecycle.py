@@ -0,0 +1,73 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+import spade
+
+from helpers.register_user_ejabberd import EjabberdProvisioner
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self, title):
+        print(f"{title} timing:")
+        for name, seconds in self.durations.items():
+            print(f"  {name:24s} {seconds:8.3f} s")
+        print(f"  {'total':24s} {sum(self.durations.values()):8.3f} s")
+
+
+async def start_agent(agent, limit, provisioner):
+    async with limit:
+        try:
+            await agent.start(auto_register=False)
+        except spade.agent.AuthenticationFailure:
+            await provisioner.register(agent.name, agent.password)
+            await agent.start()
+    return agent
+
+
+async def start_agents(agents, concurrency=16):
+    # XMPP login (and registration when needed) for all agents at once,
+    # with at most `concurrency` connections being set up at the same time
+    limit = asyncio.Semaphore(concurrency)
+    async with EjabberdProvisioner(concurrency=concurrency) as provisioner:
+        results = await asyncio.gather(*(start_agent(agent, limit, provisioner) for agent in agents),
+                                       return_exceptions=True)
+    started = []
+    for agent, result in zip(agents, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Could not start agent {agent.jid}: {result!r}")
+        else:
+            started.append(agent)
+    return started
+
+
+async def stop_agents(agents, timeout=10.0):
+    # stop every running agent at once, agents still stopping after `timeout`
+    # seconds are abandoned so teardown time does not grow with the fleet
+    tasks = [asyncio.ensure_future(agent.stop()) for agent in agents if agent.is_alive()]
+    if not tasks:
+        return 0
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"{len(pending)} agents did not stop within {timeout} s")
+    stopped = 0
+    for task in done:
+        if task.exception():
+            logging.error(f"Error while stopping agent: {task.exception()!r}")
+        else:
+            stopped += 1
+    return stopped
@@ -0,0 +1,84 @@
+import fnmatch
+from collections import namedtuple
+
+from exceptions.scenario_exceptions import InvalidScenario
+from helpers.disk_cache import load_cached, store_cached
+
+# Blueprint catalogue cached on disk across runs.
+# Selecting vehicle blueprints used to filter the whole library, read the
+# base_type/generation attribute of every candidate and sort them on every
+# start. The catalogue keeps the ids, tags, attribute values and recommended
+# values (colors, driver ids) of all blueprints in plain tuples, stored under
+# the server version and map name, so a new CARLA build or another map reads
+# the library again. Only the blueprints actually spawned are looked up in
+# the live library, because SpawnActor needs the real ActorBlueprint.
+
+# bump when BlueprintRecord changes, invalidates cached catalogues
+CATALOGUE_FORMAT = 1
+
+# attributes maps attribute ids to their value, recommended to their recommended values
+BlueprintRecord = namedtuple("BlueprintRecord", ["id", "tags", "attributes", "recommended"])
+
+
+def read_blueprint_records(library):
+    records = []
+    for blueprint in library:
+        attributes = {}
+        recommended = {}
+        for attribute in blueprint:
+            attributes[attribute.id] = attribute.as_str()
+            if attribute.recommended_values:
+                recommended[attribute.id] = tuple(attribute.recommended_values)
+        records.append(BlueprintRecord(blueprint.id, tuple(blueprint.tags), attributes, recommended))
+    records.sort(key=lambda record: record.id)
+    return records
+
+
+class BlueprintCatalogue:
+    def __init__(self, records, world=None):
+        self.records = records
+        self.world = world
+        self.library = None
+        self.matches = {}
+
+    @classmethod
+    def load(cls, client, world, use_cache=True):
+        name = world.get_map().name
+        key = (CATALOGUE_FORMAT, client.get_server_version(), name)
+        records = load_cached("blueprints", name, key) if use_cache else None
+        catalogue = cls(records, world)
+        if records is None:
+            catalogue.library = world.get_blueprint_library()
+            catalogue.records = read_blueprint_records(catalogue.library)
+            if use_cache:
+                store_cached("blueprints", name, key, catalogue.records)
+        return catalogue
+
+    def filter(self, pattern):
+        # same wildcard rules as BlueprintLibrary.filter (id or tag), memoised per pattern
+        matches = self.matches.get(pattern)
+        if matches is None:
+            matches = self.matches[pattern] = [
+                record for record in self.records
+                if fnmatch.fnmatchcase(record.id, pattern) or any(fnmatch.fnmatchcase(tag, pattern) for tag in record.tags)
+            ]
+        return matches
+
+    def select(self, selection):
+        # records matching a scenario's BlueprintSelection, sorted by id
+        records = self.filter(selection.filter)
+        if selection.generation.lower() != "all":
+            records = [r for r in records if r.attributes.get("generation") == str(int(selection.generation))]
+        if selection.base_type is not None:
+            records = [r for r in records if r.attributes.get("base_type") == selection.base_type]
+        if selection.id_contains is not None:
+            records = [r for r in records if selection.id_contains in r.id.lower()]
+        if not records:
+            raise InvalidScenario(f"No blueprint matches {selection}")
+        return records
+
+    def blueprint(self, record):
+        # the live ActorBlueprint, the library is only fetched for the first one
+        if self.library is None:
+            self.library = self.world.get_blueprint_library()
+        return self.library.find(record.id)
@@ -0,0 +1,112 @@
+import binascii
+import math
+import re
+import struct
+import time
+from collections import namedtuple
+
+from exceptions.bsm_exceptions import InvalidBSM
+
+# Binary BSM wire format shared by all simulations.
+# Every message starts with a version byte so receivers can reject (or later
+# translate) layouts they do not know. The packed bytes are base64 encoded
+# because the XMPP message body has to be text.
+#
+# version 1: version(B) flags(B) sender_id(I) x(f) y(f) z(f) speed(f)
+# version 2: version 1 followed by frame(I) sent_at(d), the simulation frame
+#            the state was sampled in and the sender's wall clock (time.time())
+BSM_VERSION = 2
+
+FLAG_CRASH = 0x01
+FLAG_HAS_SPEED = 0x02
+FLAG_HAS_FRAME = 0x04
+
+_LAYOUTS = {
+    1: struct.Struct("!BBIffff"),
+    2: struct.Struct("!BBIffffId"),
+}
+
+_SENDER_PREFIX = "car"
+_sender_id_regex = re.compile(r"\d+")
+_sender_ids = {}
+_sender_names = {}
+
+# frame and sent_at are None for version 1 messages, frame also when the sender did not know it
+BasicSafetyMessage = namedtuple("BasicSafetyMessage",
+                                ["version", "sender", "x", "y", "z", "crash", "speed", "frame", "sent_at"])
+
+
+def sender_id_from_name(name):
+    sender_id = _sender_ids.get(name)
+    if sender_id is None:
+        match = _sender_id_regex.search(name)
+        if not match:
+            raise InvalidBSM(f"Cannot derive sender id from agent name '{name}'")
+        sender_id = _sender_ids[name] = int(match.group())
+    return sender_id
+
+
+def encode_bsm(sender, location, crash=False, speed=None, frame=None, sent_at=None):
+    flags = 0
+    if crash:
+        flags |= FLAG_CRASH
+    if speed is not None:
+        flags |= FLAG_HAS_SPEED
+    else:
+        speed = math.nan
+    if frame is not None:
+        flags |= FLAG_HAS_FRAME
+    else:
+        frame = 0
+    if sent_at is None:
+        sent_at = time.time()
+    packed = _LAYOUTS[BSM_VERSION].pack(BSM_VERSION, flags, sender_id_from_name(sender),
+                                        location.x, location.y, location.z, speed, frame, sent_at)
+    return binascii.b2a_base64(packed, newline=False).decode("ascii")
+
+
+def _sender_name(sender_id):
+    name = _sender_names.get(sender_id)
+    if name is None:
+        name = _sender_names[sender_id] = f"{_SENDER_PREFIX}{sender_id}"
+    return name
+
+
+# (crash, has speed, has frame) per flags byte, so decoding does no bit tests
+_FLAG_TABLE = [(bool(flags & FLAG_CRASH), bool(flags & FLAG_HAS_SPEED), bool(flags & FLAG_HAS_FRAME))
+               for flags in range(256)]
+_CURRENT_LAYOUT = _LAYOUTS[BSM_VERSION]
+_CURRENT_SIZE = _CURRENT_LAYOUT.size
+_unpack_current = _CURRENT_LAYOUT.unpack_from
+# builds the namedtuple without the keyword handling of BasicSafetyMessage.__new__
+_new_bsm = tuple.__new__
+
+
+def decode_bsm(body):
+    try:
+        packed = binascii.a2b_base64(body)
+    except (binascii.Error, ValueError):
+        raise InvalidBSM("BSM body is not valid base64")
+    if len(packed) == _CURRENT_SIZE and packed[0] == BSM_VERSION:
+        # every simulation sends the current version, the others take the slow path
+        version, flags, sender_id, x, y, z, speed, frame, sent_at = _unpack_current(packed)
+        crash, has_speed, has_frame = _FLAG_TABLE[flags]
+        sender = _sender_names.get(sender_id) or _sender_name(sender_id)
+        return _new_bsm(BasicSafetyMessage, (version, sender, x, y, z, crash, speed if has_speed else None,
+                                             frame if has_frame else None, sent_at))
+    return _decode_other(packed)
+
+
+def _decode_other(packed):
+    if not packed:
+        raise InvalidBSM("Empty BSM body")
+    layout = _LAYOUTS.get(packed[0])
+    if layout is None:
+        raise InvalidBSM(f"Unsupported BSM version {packed[0]}")
+    if len(packed) != layout.size:
+        raise InvalidBSM(f"BSM version {packed[0]} expects {layout.size} bytes, got {len(packed)}")
+    # only version 1 is left
+    version, flags, sender_id, x, y, z, speed = layout.unpack(packed)
+    crash, has_speed, _ = _FLAG_TABLE[flags]
+    return BasicSafetyMessage(version, _sender_name(sender_id), x, y, z, crash, speed if has_speed else None,
+                              None, None)
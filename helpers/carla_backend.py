@@ -0,0 +1,11 @@
+# Chooses the module used as `carla` by the simulation scripts and agents.
+# V2V_CARLA_BACKEND=fake runs them against the in-process kinematic world in
+# helpers/fake_carla.py, anything else (the default) uses the real CARLA client.
+import os
+
+BACKEND = os.environ.get("V2V_CARLA_BACKEND", "carla")
+
+if BACKEND == "fake":
+    from helpers import fake_carla as carla
+else:
+    import carla
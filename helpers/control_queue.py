@@ -0,0 +1,90 @@
+import time
+
+from helpers.carla_backend import carla
+from helpers.latency import LatencyHistogram
+
+# Coalesces the agents' autopilot and control changes into one apply_batch.
+# Reactions like crash braking or a green light launch used to call
+# set_autopilot()/apply_control() on the actor, a blocking RPC each; an alert
+# reaching 100 cars cost hundreds of them. Agents now queue the change and the
+# launcher flushes the queue once per tick as SetAutopilot and
+# ApplyVehicleControl commands in a single client.apply_batch() call.
+#
+# Per vehicle only the last request survives: a newer control replaces the
+# pending one, and handing the car back to the autopilot drops a control that
+# was not sent yet. Without a launcher driving flush() (asynchronous mode), the
+# first queued change schedules a flush `period` seconds later instead.
+
+
+class ControlQueue:
+    def __init__(self, client, tm_port=8000, period=None, loop=None):
+        self.client = client
+        self.tm_port = tm_port
+        self.period = period
+        self.loop = loop
+        self.autopilot = {}
+        self.controls = {}
+        self.first_queued = None
+        self.flush_handle = None
+        self.batch_sizes = LatencyHistogram(lowest=1.0)
+        self.wait_ms = LatencyHistogram()
+        self.flush_ms = LatencyHistogram()
+        self.requested = 0
+        self.sent = 0
+
+    def set_autopilot(self, actor_id, enabled):
+        self.autopilot[actor_id] = enabled
+        if enabled:
+            self.controls.pop(actor_id, None)
+        self._queued()
+
+    def apply_control(self, actor_id, control):
+        self.controls[actor_id] = control
+        self._queued()
+
+    def _queued(self):
+        self.requested += 1
+        if self.first_queued is None:
+            self.first_queued = time.perf_counter()
+            if self.period is not None and self.loop is not None:
+                self.flush_handle = self.loop.call_later(self.period, self.flush)
+
+    def __len__(self):
+        return len(self.autopilot) + len(self.controls)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.first_queued is None:
+            return 0
+        started = time.perf_counter()
+        self.wait_ms.record((started - self.first_queued) * 1000.0)
+        autopilot, controls = self.autopilot, self.controls
+        self.autopilot = {}
+        self.controls = {}
+        self.first_queued = None
+        count = self.send(autopilot, controls)
+        self.flush_ms.record((time.perf_counter() - started) * 1000.0)
+        self.batch_sizes.record(count)
+        self.sent += count
+        return count
+
+    def send(self, autopilot, controls):
+        # autopilot changes first, a car taken off autopilot must not get its control overridden
+        commands = [carla.command.SetAutopilot(actor_id, enabled, self.tm_port)
+                    for actor_id, enabled in autopilot.items()]
+        commands.extend(carla.command.ApplyVehicleControl(actor_id, control)
+                        for actor_id, control in controls.items())
+        self.client.apply_batch(commands)
+        return len(commands)
+
+    def report(self):
+        if not self.batch_sizes.total:
+            print("control queue: no vehicle control changes")
+            return
+        print(f"control queue: {self.requested} changes sent as {self.sent} commands "
+              f"in {self.batch_sizes.total} batches")
+        print(f"  batch size       {self.batch_sizes.summary('commands')}")
+        print(f"  queued for       {self.wait_ms.summary('ms')}")
+        print(f"  apply_batch      {self.flush_ms.summary('ms')}")
@@ -0,0 +1,38 @@
+import hashlib
+import os
+import pickle
+
+# Small pickle cache for things that are slow to build and rarely change
+# (validated scenarios, the blueprint catalogue). Every entry is stored with
+# a key; load_cached() returns None when the stored key differs, so callers
+# put whatever invalidates the entry (file mtime, CARLA version, ...) in it.
+# The cache is best effort: unreadable or unwritable files are ignored.
+CACHE_DIR = os.environ.get("V2V_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "v2v-simulation"))
+
+
+def cache_file(kind, name):
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:20]
+    return os.path.join(CACHE_DIR, kind, f"{digest}.pickle")
+
+
+def load_cached(kind, name, key):
+    try:
+        with open(cache_file(kind, name), "rb") as f:
+            cached_key, value = pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    if cached_key != key:
+        return None
+    return value
+
+
+def store_cached(kind, name, key, value):
+    path = cache_file(kind, name)
+    partial = f"{path}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(partial, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, path)
+    except OSError:
+        pass
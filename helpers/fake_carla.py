@@ -0,0 +1,930 @@
+# In-process stand-in for the subset of the CARLA Python API used by the
+# simulation launchers and agents, for headless runs without a simulator.
+# Select it with V2V_CARLA_BACKEND=fake (see helpers/carla_backend.py).
+#
+# Vehicles are simple kinematic points: on autopilot they accelerate towards
+# the traffic manager's desired speed, keep distance to the vehicle ahead and
+# stop at the stop line when the light of their lane is red or yellow; off
+# autopilot they follow the applied VehicleControl. Nothing is rendered,
+# there are no sensors and the only road network is the grid of Map, and
+# the world only advances when the client ticks it, so in synchronous mode it
+# runs as fast as the caller can tick.
+import fnmatch
+import itertools
+import math
+import time
+
+import numpy as np
+
+SERVER_VERSION = "0.9.15-fake"
+DEFAULT_MAP = "Town10HD_Opt"
+DEFAULT_DELTA_SECONDS = 0.05
+DEFAULT_SPEED_LIMIT = 30.0  # km/h
+MAX_ACCELERATION = 3.5  # m/s^2
+MAX_DECELERATION = 8.0  # m/s^2
+VEHICLE_LENGTH = 4.5
+WHEELBASE = 2.8
+MAX_STEER_ANGLE = math.radians(70)
+# vehicles react to the light of their lane from this far, enough to stop from 100 km/h
+LIGHT_STOP_DISTANCE = 60.0
+FOLLOW_LOOKAHEAD = 40.0
+LANE_HALF_WIDTH = 1.8
+_CELL_KEY_STRIDE = 1 << 32
+
+
+# ==============================================================================
+# -- geometry ------------------------------------------------------------------
+# ==============================================================================
+
+
+class Vector3D:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+
+    def length(self):
+        return math.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
+
+    def __add__(self, other):
+        return type(self)(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return type(self)(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector3D) and (self.x, self.y, self.z) == (other.x, other.y, other.z)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(x={self.x:.6f}, y={self.y:.6f}, z={self.z:.6f})"
+
+
+class Location(Vector3D):
+    def distance(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+
+class Rotation:
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = float(pitch)
+        self.yaw = float(yaw)
+        self.roll = float(roll)
+
+    def get_forward_vector(self):
+        yaw = math.radians(self.yaw)
+        pitch = math.radians(self.pitch)
+        return Vector3D(math.cos(pitch) * math.cos(yaw), math.cos(pitch) * math.sin(yaw), math.sin(pitch))
+
+    def __repr__(self):
+        return f"Rotation(pitch={self.pitch:.6f}, yaw={self.yaw:.6f}, roll={self.roll:.6f})"
+
+
+class Transform:
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def get_forward_vector(self):
+        return self.rotation.get_forward_vector()
+
+    def __repr__(self):
+        return f"Transform({self.location!r}, {self.rotation!r})"
+
+
+def _copy_transform(transform):
+    return Transform(Location(transform.location.x, transform.location.y, transform.location.z),
+                     Rotation(transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll))
+
+
+# ==============================================================================
+# -- control and state ---------------------------------------------------------
+# ==============================================================================
+
+
+class VehicleControl:
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False,
+                 manual_gear_shift=False, gear=0):
+        self.throttle = throttle
+        self.steer = steer
+        self.brake = brake
+        self.hand_brake = hand_brake
+        self.reverse = reverse
+        self.manual_gear_shift = manual_gear_shift
+        self.gear = gear
+
+
+class TrafficLightState:
+    Red = "Red"
+    Yellow = "Yellow"
+    Green = "Green"
+    Off = "Off"
+    Unknown = "Unknown"
+
+
+class WorldSettings:
+    def __init__(self, synchronous_mode=False, fixed_delta_seconds=None, no_rendering_mode=True):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.no_rendering_mode = no_rendering_mode
+
+
+class Timestamp:
+    def __init__(self, frame, elapsed_seconds, delta_seconds, platform_timestamp):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = platform_timestamp
+
+
+class ActorSnapshot:
+    def __init__(self, actor):
+        self.id = actor.id
+        self._transform = _copy_transform(actor._transform)
+        self._velocity = Vector3D(actor._velocity.x, actor._velocity.y, actor._velocity.z)
+
+    def get_transform(self):
+        return self._transform
+
+    def get_velocity(self):
+        return self._velocity
+
+
+class WorldSnapshot:
+    def __init__(self, world):
+        self.id = world.id
+        self.frame = world.frame
+        self.timestamp = Timestamp(world.frame, world.elapsed_seconds, world.delta_seconds, time.time())
+        self._actors = {actor.id: ActorSnapshot(actor) for actor in world._actors.values()}
+
+    def find(self, actor_id):
+        return self._actors.get(actor_id)
+
+    def has_actor(self, actor_id):
+        return actor_id in self._actors
+
+    def __iter__(self):
+        return iter(self._actors.values())
+
+    def __len__(self):
+        return len(self._actors)
+
+
+# ==============================================================================
+# -- blueprints ----------------------------------------------------------------
+# ==============================================================================
+
+
+class ActorAttribute:
+    def __init__(self, id, value, recommended_values=()):
+        self.id = id
+        self.value = str(value)
+        self.recommended_values = list(recommended_values)
+
+    def as_int(self):
+        return int(self.value)
+
+    def as_float(self):
+        return float(self.value)
+
+    def as_str(self):
+        return self.value
+
+    def __str__(self):
+        return self.value
+
+    def __eq__(self, other):
+        if isinstance(other, ActorAttribute):
+            return self.value == other.value
+        return self.value == str(other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+class ActorBlueprint:
+    def __init__(self, id, attributes=None, tags=()):
+        self.id = id
+        self.tags = list(tags)
+        self._attributes = {}
+        for key, (value, recommended) in (attributes or {}).items():
+            self._attributes[key] = ActorAttribute(key, value, recommended)
+
+    def has_attribute(self, id):
+        return id in self._attributes
+
+    def get_attribute(self, id):
+        return self._attributes[id]
+
+    def set_attribute(self, id, value):
+        attribute = self._attributes.get(id)
+        if attribute is None:
+            self._attributes[id] = ActorAttribute(id, value)
+        else:
+            attribute.value = str(value)
+
+    def has_tag(self, tag):
+        return tag in self.tags
+
+    def _copy(self):
+        copy = ActorBlueprint(self.id, tags=self.tags)
+        for key, attribute in self._attributes.items():
+            copy._attributes[key] = ActorAttribute(key, attribute.value, attribute.recommended_values)
+        return copy
+
+    def __iter__(self):
+        return iter(self._attributes.values())
+
+    def __repr__(self):
+        return f"ActorBlueprint(id={self.id})"
+
+
+class BlueprintLibrary:
+    def __init__(self, blueprints):
+        self._blueprints = list(blueprints)
+
+    def filter(self, wildcard_pattern):
+        return BlueprintLibrary(bp for bp in self._blueprints if fnmatch.fnmatch(bp.id, wildcard_pattern))
+
+    def find(self, id):
+        for bp in self._blueprints:
+            if bp.id == id:
+                return bp
+        raise IndexError(f"blueprint '{id}' not found")
+
+    def __getitem__(self, index):
+        return self._blueprints[index]
+
+    def __iter__(self):
+        return iter(self._blueprints)
+
+    def __len__(self):
+        return len(self._blueprints)
+
+
+_COLORS = ["255,255,255", "0,0,0", "200,20,20", "20,60,200", "120,120,120"]
+
+
+def _vehicle_blueprint(id, base_type, generation, wheels=4):
+    attributes = {
+        "base_type": (base_type, ()),
+        "generation": (generation, ()),
+        "number_of_wheels": (wheels, ()),
+        "color": (_COLORS[0], _COLORS),
+        "role_name": ("autopilot", ()),
+    }
+    if wheels == 2:
+        attributes["driver_id"] = ("0", ["0", "1", "2"])
+    return ActorBlueprint(id, attributes, tags=id.split(".")[1:])
+
+
+def _default_blueprints():
+    return [
+        _vehicle_blueprint("vehicle.audi.a2", "car", 1),
+        _vehicle_blueprint("vehicle.audi.tt", "car", 1),
+        _vehicle_blueprint("vehicle.lincoln.mkz_2020", "car", 2),
+        _vehicle_blueprint("vehicle.mercedes.coupe_2020", "car", 2),
+        _vehicle_blueprint("vehicle.tesla.model3", "car", 1),
+        _vehicle_blueprint("vehicle.toyota.prius", "car", 1),
+        _vehicle_blueprint("vehicle.carlamotors.carlacola", "truck", 1),
+        _vehicle_blueprint("vehicle.yamaha.yzf", "motorcycle", 1, wheels=2),
+        ActorBlueprint("sensor.camera.rgb", {"image_size_x": ("800", ()), "image_size_y": ("600", ())}),
+        ActorBlueprint("sensor.other.collision"),
+    ]
+
+
+# ==============================================================================
+# -- actors --------------------------------------------------------------------
+# ==============================================================================
+
+
+class Actor:
+    def __init__(self, world, actor_id, type_id, transform, attributes=None):
+        self._world = world
+        self.id = actor_id
+        self.type_id = type_id
+        self.attributes = dict(attributes or {})
+        self.parent = None
+        self.is_alive = True
+        self._transform = _copy_transform(transform)
+        self._velocity = Vector3D()
+
+    def get_world(self):
+        return self._world
+
+    def get_transform(self):
+        return _copy_transform(self._transform)
+
+    def get_location(self):
+        location = self._transform.location
+        return Location(location.x, location.y, location.z)
+
+    def get_velocity(self):
+        return Vector3D(self._velocity.x, self._velocity.y, self._velocity.z)
+
+    def set_transform(self, transform):
+        self._transform = _copy_transform(transform)
+
+    def set_location(self, location):
+        self._transform.location = Location(location.x, location.y, location.z)
+
+    def destroy(self):
+        return self._world._destroy(self.id)
+
+    def __repr__(self):
+        return f"Actor(id={self.id}, type={self.type_id})"
+
+
+class Vehicle(Actor):
+    def __init__(self, world, actor_id, type_id, transform, attributes=None):
+        super().__init__(world, actor_id, type_id, transform, attributes)
+        self.speed = 0.0  # m/s along the heading
+        self.autopilot = False
+        self.control = VehicleControl()
+
+    def apply_control(self, control):
+        self.control = control
+
+    def get_control(self):
+        return self.control
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        self.autopilot = enabled
+
+    def set_target_velocity(self, velocity):
+        self.speed = math.hypot(velocity.x, velocity.y)
+
+    def _manual_acceleration(self):
+        control = self.control
+        direction = -1.0 if control.reverse else 1.0
+        brake = 1.0 if control.hand_brake else control.brake
+        return direction * (control.throttle * MAX_ACCELERATION - brake * MAX_DECELERATION)
+
+    def _step(self, dt, acceleration):
+        speed = self.speed + acceleration * dt
+        # brakes stop the vehicle, they do not drive it the other way
+        speed = min(0.0, speed) if self.control.reverse else max(0.0, speed)
+        if self.control.steer and speed:
+            turn_rate = speed * math.tan(self.control.steer * MAX_STEER_ANGLE) / WHEELBASE
+            self._transform.rotation.yaw = (self._transform.rotation.yaw + math.degrees(turn_rate * dt)) % 360
+        yaw = math.radians(self._transform.rotation.yaw)
+        self._move(speed, math.cos(yaw) * speed, math.sin(yaw) * speed, dt)
+
+    def _move(self, speed, velocity_x, velocity_y, dt):
+        self._transform.location.x += velocity_x * dt
+        self._transform.location.y += velocity_y * dt
+        self._velocity = Vector3D(velocity_x, velocity_y, 0.0)
+        self.speed = speed
+
+
+class TrafficLight(Actor):
+    def __init__(self, world, actor_id, transform, group, pole_index):
+        super().__init__(world, actor_id, "traffic.traffic_light", transform)
+        self.state = TrafficLightState.Red
+        self.frozen = False
+        self.group = group
+        self.pole_index = pole_index
+        self.elapsed_time = 0.0
+        self.green_time = 10.0
+        self.yellow_time = 3.0
+        self.red_time = 2.0
+        # the stop line of the one lane this light controls, set by World
+        self.stop_transform = None
+
+    def set_state(self, state):
+        if state != self.state:
+            self.elapsed_time = 0.0
+        self.state = state
+
+    def get_state(self):
+        return self.state
+
+    def freeze(self, freeze):
+        self.frozen = freeze
+
+    def is_frozen(self):
+        return self.frozen
+
+    def get_elapsed_time(self):
+        return self.elapsed_time
+
+    def get_green_time(self):
+        return self.green_time
+
+    def get_yellow_time(self):
+        return self.yellow_time
+
+    def get_red_time(self):
+        return self.red_time
+
+    def set_green_time(self, seconds):
+        self.green_time = seconds
+
+    def set_yellow_time(self, seconds):
+        self.yellow_time = seconds
+
+    def set_red_time(self, seconds):
+        self.red_time = seconds
+
+    def get_pole_index(self):
+        return self.pole_index
+
+    def get_group_traffic_lights(self):
+        return list(self.group.lights)
+
+    def get_stop_waypoints(self):
+        return [Waypoint(_copy_transform(self.stop_transform), 2 * LANE_HALF_WIDTH)]
+
+
+class _TrafficLightGroup:
+    # cycles the lights of one intersection: one pole green/yellow, the rest red
+    def __init__(self):
+        self.lights = []
+        self.active = 0
+
+    def step(self, dt):
+        for light in self.lights:
+            light.elapsed_time += dt
+        if any(light.frozen for light in self.lights):
+            return
+        current = self.lights[self.active]
+        if current.state == TrafficLightState.Green and current.elapsed_time >= current.green_time:
+            current.set_state(TrafficLightState.Yellow)
+        elif current.state == TrafficLightState.Yellow and current.elapsed_time >= current.yellow_time:
+            current.set_state(TrafficLightState.Red)
+            self.active = (self.active + 1) % len(self.lights)
+            self.lights[self.active].set_state(TrafficLightState.Green)
+        elif current.state == TrafficLightState.Red and current.elapsed_time >= current.red_time:
+            current.set_state(TrafficLightState.Green)
+
+
+class ActorList(list):
+    def filter(self, wildcard_pattern):
+        return ActorList(actor for actor in self if fnmatch.fnmatch(actor.type_id, wildcard_pattern))
+
+    def find(self, actor_id):
+        for actor in self:
+            if actor.id == actor_id:
+                return actor
+        return None
+
+
+# ==============================================================================
+# -- world ---------------------------------------------------------------------
+# ==============================================================================
+
+
+class Waypoint:
+    def __init__(self, transform, lane_width):
+        self.transform = transform
+        self.lane_width = lane_width
+
+
+class Map:
+    # roads run along the intersection rows and columns of World, one lane each way
+    SPAWN_SPACING = 10.0
+    LANE_OFFSET = 1.75
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_spawn_points(self):
+        points = []
+        xs, ys = World.INTERSECTION_XS, World.INTERSECTION_YS
+        for y in ys:
+            x = xs[0] - 50.0
+            while x <= xs[-1] + 50.0:
+                if min(abs(x - cx) for cx in xs) > 15.0:
+                    points.append(Transform(Location(x, y - self.LANE_OFFSET, 0.6), Rotation(yaw=0.0)))
+                    points.append(Transform(Location(x, y + self.LANE_OFFSET, 0.6), Rotation(yaw=180.0)))
+                x += self.SPAWN_SPACING
+        for x in xs:
+            y = ys[0] - 50.0
+            while y <= ys[-1] + 50.0:
+                if min(abs(y - cy) for cy in ys) > 15.0:
+                    points.append(Transform(Location(x + self.LANE_OFFSET, y, 0.6), Rotation(yaw=90.0)))
+                    points.append(Transform(Location(x - self.LANE_OFFSET, y, 0.6), Rotation(yaw=270.0)))
+                y += self.SPAWN_SPACING
+        return points
+
+
+class World:
+    # intersections on a regular grid, each with 4 lights 8 m off the centre
+    INTERSECTION_XS = (-100.0, 0.0, 100.0, 200.0)
+    INTERSECTION_YS = (-80.0, 20.0, 120.0)
+
+    def __init__(self, map_name=DEFAULT_MAP):
+        self.id = id(self)
+        self._map = Map(map_name)
+        self._settings = WorldSettings()
+        self._ids = itertools.count(1)
+        self._actors = {}
+        self._tick_callbacks = {}
+        self._callback_ids = itertools.count(1)
+        self._light_groups = []
+        # stop lines of all lights, in the order of self._lights, for _red_light_gaps
+        self._lights = []
+        self._blueprints = BlueprintLibrary(_default_blueprints())
+        self.frame = 0
+        self.elapsed_seconds = 0.0
+        self.delta_seconds = 0.0
+        self._last_async_tick = None
+        self.traffic_manager = TrafficManager(8000)
+        self._spectator = self._add(Actor(self, next(self._ids), "spectator", Transform()))
+        self._build_traffic_lights()
+
+    def _add(self, actor):
+        self._actors[actor.id] = actor
+        return actor
+
+    def _build_traffic_lights(self):
+        offsets = ((8.0, 8.0, 180.0), (-8.0, 8.0, 270.0), (-8.0, -8.0, 0.0), (8.0, -8.0, 90.0))
+        for cx in self.INTERSECTION_XS:
+            for cy in self.INTERSECTION_YS:
+                group = _TrafficLightGroup()
+                for pole_index, (dx, dy, yaw) in enumerate(offsets):
+                    transform = Transform(Location(cx + dx, cy + dy, 0.0), Rotation(yaw=yaw))
+                    light = self._add(TrafficLight(self, next(self._ids), transform, group, pole_index))
+                    # a light controls the lane heading its way (yaw), right of the centre line;
+                    # the stop line is level with the light
+                    forward = transform.get_forward_vector()
+                    along = dx * forward.x + dy * forward.y
+                    light.stop_transform = Transform(
+                        Location(cx + Map.LANE_OFFSET * forward.y + along * forward.x,
+                                 cy - Map.LANE_OFFSET * forward.x + along * forward.y, 0.0), Rotation(yaw=yaw))
+                    group.lights.append(light)
+                    self._lights.append(light)
+                group.lights[0].set_state(TrafficLightState.Green)
+                self._light_groups.append(group)
+        stops = [light.stop_transform for light in self._lights]
+        self._stop_x = np.array([stop.location.x for stop in stops])
+        self._stop_y = np.array([stop.location.y for stop in stops])
+        self._stop_forward_x = np.array([stop.get_forward_vector().x for stop in stops])
+        self._stop_forward_y = np.array([stop.get_forward_vector().y for stop in stops])
+
+    def _destroy(self, actor_id):
+        actor = self._actors.pop(actor_id, None)
+        if actor is None:
+            return False
+        actor.is_alive = False
+        return True
+
+    def get_map(self):
+        return self._map
+
+    def get_settings(self):
+        settings = self._settings
+        return WorldSettings(settings.synchronous_mode, settings.fixed_delta_seconds, settings.no_rendering_mode)
+
+    def apply_settings(self, settings):
+        self._settings = WorldSettings(settings.synchronous_mode, settings.fixed_delta_seconds,
+                                       settings.no_rendering_mode)
+        return self.frame
+
+    def get_blueprint_library(self):
+        return BlueprintLibrary(bp._copy() for bp in self._blueprints)
+
+    def get_spectator(self):
+        return self._spectator
+
+    def get_actors(self, actor_ids=None):
+        if actor_ids is None:
+            return ActorList(self._actors.values())
+        return ActorList(self._actors[actor_id] for actor_id in actor_ids if actor_id in self._actors)
+
+    def get_actor(self, actor_id):
+        return self._actors.get(actor_id)
+
+    def get_snapshot(self):
+        return WorldSnapshot(self)
+
+    def on_tick(self, callback):
+        callback_id = next(self._callback_ids)
+        self._tick_callbacks[callback_id] = callback
+        return callback_id
+
+    def remove_on_tick(self, callback_id):
+        self._tick_callbacks.pop(callback_id, None)
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        if blueprint.id.startswith("vehicle."):
+            for actor in self._actors.values():
+                if isinstance(actor, Vehicle) and actor._transform.location.distance(transform.location) < 2.0:
+                    return None
+            attributes = {attribute.id: attribute.value for attribute in blueprint}
+            return self._add(Vehicle(self, next(self._ids), blueprint.id, transform, attributes))
+        actor = self._add(Actor(self, next(self._ids), blueprint.id, transform))
+        actor.parent = attach_to
+        return actor
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        actor = self.try_spawn_actor(blueprint, transform, attach_to)
+        if actor is None:
+            raise RuntimeError("Spawn failed because of collision at spawn position")
+        return actor
+
+    def tick(self, seconds=10.0):
+        if not self._settings.synchronous_mode:
+            raise RuntimeError("tick() is only available in synchronous mode")
+        self._step(self._settings.fixed_delta_seconds or DEFAULT_DELTA_SECONDS)
+        return self.frame
+
+    def wait_for_tick(self, seconds=10.0):
+        # asynchronous mode: the server would have kept running in real time
+        now = time.monotonic()
+        if self._settings.fixed_delta_seconds:
+            dt = self._settings.fixed_delta_seconds
+        elif self._last_async_tick is None:
+            dt = DEFAULT_DELTA_SECONDS
+        else:
+            dt = min(now - self._last_async_tick, 1.0)
+        self._last_async_tick = now
+        self._step(dt)
+        return WorldSnapshot(self)
+
+    def _step(self, dt):
+        vehicles = [actor for actor in self._actors.values() if isinstance(actor, Vehicle)]
+        if vehicles:
+            self._step_vehicles(vehicles, dt)
+        for group in self._light_groups:
+            group.step(dt)
+        self.frame += 1
+        self.elapsed_seconds += dt
+        self.delta_seconds = dt
+        if self._tick_callbacks:
+            snapshot = WorldSnapshot(self)
+            for callback in list(self._tick_callbacks.values()):
+                callback(snapshot)
+
+    def _step_vehicles(self, vehicles, dt):
+        # autopilot vehicles are moved in bulk; all vehicles, including the
+        # manually driven ones, are obstacles for them
+        count = len(vehicles)
+        x = np.fromiter((vehicle._transform.location.x for vehicle in vehicles), float, count)
+        y = np.fromiter((vehicle._transform.location.y for vehicle in vehicles), float, count)
+        yaw = np.radians(np.fromiter((vehicle._transform.rotation.yaw for vehicle in vehicles), float, count))
+        forward_x, forward_y = np.cos(yaw), np.sin(yaw)
+        autopilot = np.fromiter((vehicle.autopilot for vehicle in vehicles), bool, count)
+        manual = [vehicle for vehicle in vehicles if not vehicle.autopilot]
+        manual_accelerations = [vehicle._manual_acceleration() for vehicle in manual]
+
+        driven = np.flatnonzero(autopilot)
+        if len(driven):
+            tm = self.traffic_manager
+            driven_vehicles = [vehicles[i] for i in driven]
+            speed = np.fromiter((vehicle.speed for vehicle in driven_vehicles), float, len(driven))
+            target = np.fromiter((tm._target_speed(vehicle) for vehicle in driven_vehicles), float, len(driven)) / 3.6
+            leading = np.fromiter((tm._leading_distance(vehicle) for vehicle in driven_vehicles), float, len(driven))
+            # keep a 1.5 s headway behind the vehicle ahead and stop 3 m before the stop line of a red light
+            gaps = _gaps_ahead(x, y, forward_x, forward_y)[driven]
+            target = np.minimum(target, np.maximum(0.0, (gaps - leading) / 1.5))
+            light_gaps = self._red_light_gaps(x[driven], y[driven], forward_x[driven], forward_y[driven])
+            target = np.minimum(target, np.maximum(0.0, (light_gaps - 3.0) / 2.0))
+            acceleration = np.clip((target - speed) / 0.5, -MAX_DECELERATION, MAX_ACCELERATION)
+            speed = np.maximum(0.0, speed + acceleration * dt)
+            velocity_x = (forward_x[driven] * speed).tolist()
+            velocity_y = (forward_y[driven] * speed).tolist()
+            for vehicle, new_speed, vx, vy in zip(driven_vehicles, speed.tolist(), velocity_x, velocity_y):
+                vehicle._move(new_speed, vx, vy, dt)
+
+        for vehicle, acceleration in zip(manual, manual_accelerations):
+            vehicle._step(dt, acceleration)
+
+    def _red_light_gaps(self, x, y, forward_x, forward_y):
+        # distance along the heading to the stop line of the nearest red or yellow light in
+        # front that controls the vehicle's lane, inf when none
+        stopping = np.fromiter((light.state != TrafficLightState.Green for light in self._lights), bool,
+                               len(self._lights))
+        if not stopping.any():
+            return np.full(len(x), np.inf)
+        stop_x, stop_y = self._stop_x[stopping], self._stop_y[stopping]
+        dx = stop_x[None, :] - x[:, None]
+        dy = stop_y[None, :] - y[:, None]
+        longitudinal = dx * forward_x[:, None] + dy * forward_y[:, None]
+        lateral = np.abs(dy * forward_x[:, None] - dx * forward_y[:, None])
+        # the light faces the vehicle's direction of travel, within 45 degrees
+        heading = (self._stop_forward_x[stopping][None, :] * forward_x[:, None]
+                   + self._stop_forward_y[stopping][None, :] * forward_y[:, None])
+        in_lane = (longitudinal > 0) & (longitudinal < LIGHT_STOP_DISTANCE) & (lateral < LANE_HALF_WIDTH) \
+            & (heading > math.sqrt(0.5))
+        return np.where(in_lane, longitudinal, np.inf).min(axis=1)
+
+
+def _gaps_ahead(x, y, forward_x, forward_y):
+    # bumper to bumper distance to the nearest vehicle in the same lane ahead,
+    # inf when there is none within FOLLOW_LOOKAHEAD. Vehicles are bucketed
+    # in a grid of FOLLOW_LOOKAHEAD sized cells and only pairs in neighbouring
+    # cells are compared.
+    count = len(x)
+    cell_x = np.floor(x / FOLLOW_LOOKAHEAD).astype(np.int64)
+    cell_y = np.floor(y / FOLLOW_LOOKAHEAD).astype(np.int64) + _CELL_KEY_STRIDE // 2
+    keys = cell_x * _CELL_KEY_STRIDE + cell_y
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    gaps = np.full(count, np.inf)
+    for offset_x in (-1, 0, 1):
+        for offset_y in (-1, 0, 1):
+            neighbour_keys = keys + offset_x * _CELL_KEY_STRIDE + offset_y
+            start = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+            counts = np.searchsorted(sorted_keys, neighbour_keys, side="right") - start
+            total = int(counts.sum())
+            if not total:
+                continue
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            i = np.repeat(np.arange(count), counts)
+            j = order[np.repeat(start, counts) + np.arange(total) - first]
+            dx = x[j] - x[i]
+            dy = y[j] - y[i]
+            longitudinal = dx * forward_x[i] + dy * forward_y[i]
+            lateral = np.abs(dy * forward_x[i] - dx * forward_y[i])
+            ahead = (i != j) & (longitudinal > 0) & (longitudinal < FOLLOW_LOOKAHEAD) & (lateral < LANE_HALF_WIDTH)
+            np.minimum.at(gaps, i[ahead], longitudinal[ahead] - VEHICLE_LENGTH)
+    return gaps
+
+
+# ==============================================================================
+# -- traffic manager -----------------------------------------------------------
+# ==============================================================================
+
+
+class TrafficManager:
+    def __init__(self, port):
+        self.port = port
+        self.speed_difference = 0.0
+        self.desired_speeds = {}
+        self.leading_distances = {}
+        self.paths = {}
+        self.leading_distance = 2.0
+
+    def get_port(self):
+        return self.port
+
+    def _target_speed(self, vehicle):
+        speed = self.desired_speeds.get(vehicle.id)
+        if speed is not None:
+            return speed
+        return DEFAULT_SPEED_LIMIT * (1.0 - self.speed_difference / 100.0)
+
+    def _leading_distance(self, vehicle):
+        return self.leading_distances.get(vehicle.id, self.leading_distance)
+
+    def global_percentage_speed_difference(self, percentage):
+        self.speed_difference = percentage
+
+    def set_desired_speed(self, vehicle, speed):
+        self.desired_speeds[vehicle.id] = speed
+
+    def distance_to_leading_vehicle(self, vehicle, distance):
+        self.leading_distances[vehicle.id] = distance
+
+    def set_global_distance_to_leading_vehicle(self, distance):
+        self.leading_distance = distance
+
+    def set_path(self, vehicle, path):
+        self.paths[vehicle.id] = list(path)
+
+    def ignore_vehicles_percentage(self, vehicle, percentage):
+        pass
+
+    def ignore_lights_percentage(self, vehicle, percentage):
+        pass
+
+    def set_synchronous_mode(self, mode=True):
+        pass
+
+    def set_random_device_seed(self, seed):
+        pass
+
+    def set_respawn_dormant_vehicles(self, enabled):
+        pass
+
+    def set_hybrid_physics_mode(self, enabled):
+        pass
+
+    def set_hybrid_physics_radius(self, radius):
+        pass
+
+
+# ==============================================================================
+# -- commands and client -------------------------------------------------------
+# ==============================================================================
+
+
+class _FutureActor:
+    def __repr__(self):
+        return "FutureActor"
+
+
+class _Command:
+    def __init__(self):
+        self._then = []
+
+    def then(self, command):
+        self._then.append(command)
+        return self
+
+
+class command:
+    FutureActor = _FutureActor()
+
+    class Response:
+        def __init__(self, actor_id=0, error=""):
+            self.actor_id = actor_id
+            self.error = error
+
+        def has_error(self):
+            return bool(self.error)
+
+    class SpawnActor(_Command):
+        def __init__(self, blueprint, transform, parent=None):
+            super().__init__()
+            self.blueprint = blueprint
+            self.transform = transform
+            self.parent = parent
+
+    class DestroyActor(_Command):
+        def __init__(self, actor):
+            super().__init__()
+            self.actor_id = _actor_id(actor)
+
+    class SetAutopilot(_Command):
+        def __init__(self, actor, enabled, tm_port=8000):
+            super().__init__()
+            self.actor_id = _actor_id(actor)
+            self.enabled = enabled
+            self.tm_port = tm_port
+
+    class ApplyVehicleControl(_Command):
+        def __init__(self, actor, control):
+            super().__init__()
+            self.actor_id = _actor_id(actor)
+            self.control = control
+
+
+def _actor_id(actor):
+    if actor is command.FutureActor or isinstance(actor, int):
+        return actor
+    return actor.id
+
+
+class Client:
+    def __init__(self, host="127.0.0.1", port=2000, worker_threads=0):
+        self.host = host
+        self.port = port
+        self._world = World()
+
+    def set_timeout(self, seconds):
+        pass
+
+    def get_server_version(self):
+        return SERVER_VERSION
+
+    def get_client_version(self):
+        return SERVER_VERSION
+
+    def get_world(self):
+        return self._world
+
+    def load_world(self, map_name, reset_settings=True):
+        self._world = World(map_name)
+        return self._world
+
+    def get_available_maps(self):
+        return [f"/Game/Carla/Maps/{DEFAULT_MAP}"]
+
+    def get_trafficmanager(self, client_connection=8000):
+        self._world.traffic_manager.port = client_connection
+        return self._world.traffic_manager
+
+    def apply_batch(self, commands, do_tick=False):
+        self.apply_batch_sync(commands, do_tick)
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        responses = [self._execute(cmd, None) for cmd in commands]
+        if do_tick and self._world._settings.synchronous_mode:
+            self._world.tick()
+        return responses
+
+    def _execute(self, cmd, future_actor_id):
+        world = self._world
+        actor_id = getattr(cmd, "actor_id", None)
+        if actor_id is command.FutureActor:
+            actor_id = future_actor_id
+        if isinstance(cmd, command.SpawnActor):
+            actor = world.try_spawn_actor(cmd.blueprint, cmd.transform)
+            if actor is None:
+                return command.Response(error="Spawn failed because of collision at spawn position")
+            for then in cmd._then:
+                self._execute(then, actor.id)
+            return command.Response(actor_id=actor.id)
+        actor = world.get_actor(actor_id)
+        if actor is None:
+            return command.Response(actor_id=actor_id or 0, error=f"actor {actor_id} not found")
+        if isinstance(cmd, command.DestroyActor):
+            actor.destroy()
+        elif isinstance(cmd, command.SetAutopilot):
+            actor.set_autopilot(cmd.enabled, cmd.tm_port)
+        elif isinstance(cmd, command.ApplyVehicleControl):
+            actor.apply_control(cmd.control)
+        for then in cmd._then:
+            self._execute(then, actor_id)
+        return command.Response(actor_id=actor_id)
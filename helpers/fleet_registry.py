@@ -0,0 +1,48 @@
+# In-process registry of the vehicles on the road.
+# Vehicles join when they are spawned and leave when they are destroyed;
+# subscribers get the current members once and afterwards only the changes,
+# as callback(joined, left) with two sets of jids.
+
+
+class FleetRegistry:
+    def __init__(self):
+        self.members = set()
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        callback(set(self.members), set())
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def join(self, *jids):
+        joined = set(jids) - self.members
+        if joined:
+            self.members |= joined
+            self._notify(joined, set())
+
+    def leave(self, *jids):
+        left = set(jids) & self.members
+        if left:
+            self.members -= left
+            self._notify(set(), left)
+
+    def _notify(self, joined, left):
+        for callback in list(self.subscribers):
+            callback(joined, left)
+
+
+def receivers_updater(agent):
+    # subscriber callback keeping agent.receivers equal to the members minus itself;
+    # a new list is assigned every time so readers never see a half-updated one
+    own_jid = str(agent.jid)
+
+    def update(joined, left):
+        receivers = [jid for jid in agent.receivers if jid not in left]
+        known = set(receivers)
+        receivers += [jid for jid in joined if jid != own_jid and jid not in known]
+        agent.receivers = receivers
+
+    return update
@@ -0,0 +1,105 @@
+import itertools
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# State of the whole fleet, read once per world tick.
+# FleetSnapshotService listens to world.on_tick and copies the transforms and
+# velocities of the tracked vehicles out of the WorldSnapshot the server sent
+# with the tick into contiguous arrays. Agents read their own row from
+# `latest` instead of calling get_transform()/get_velocity() on the server.
+# Every tick builds a new FleetSnapshot and swaps it in, so readers on the
+# agents' thread never see one that is half written by the CARLA thread.
+
+# one vehicle's row; x, y, z make it usable as a location (encode_bsm, SpatialGrid)
+# speed is in km/h, alive is False when the actor was not in the world snapshot
+VehicleState = namedtuple("VehicleState", ["frame", "elapsed_seconds", "alive", "x", "y", "z", "speed"])
+
+
+class FleetSnapshot:
+    def __init__(self, frame, elapsed_seconds, actor_ids, positions, velocities, alive):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.actor_ids = actor_ids
+        self.positions = positions
+        self.velocities = velocities
+        self.speeds = 3.6 * np.sqrt(np.einsum("vk,vk->v", velocities, velocities))
+        self.alive = alive
+        self.rows = {actor_id: row for row, actor_id in enumerate(actor_ids)}
+
+    def state(self, actor_id):
+        # None for vehicles this snapshot does not track
+        row = self.rows.get(actor_id)
+        if row is None:
+            return None
+        if not self.alive[row]:
+            return VehicleState(self.frame, self.elapsed_seconds, False, math.nan, math.nan, math.nan, math.nan)
+        x, y, z = self.positions[row].tolist()
+        return VehicleState(self.frame, self.elapsed_seconds, True, x, y, z, float(self.speeds[row]))
+
+    def __len__(self):
+        return len(self.actor_ids)
+
+
+def read_fleet_snapshot(world_snapshot, actor_ids):
+    count = len(actor_ids)
+    actor_snapshots = [world_snapshot.find(actor_id) for actor_id in actor_ids]
+    alive = np.fromiter((actor_snapshot is not None for actor_snapshot in actor_snapshots), bool, count)
+    positions = np.full((count, 3), np.nan)
+    velocities = np.full((count, 3), np.nan)
+    present = [actor_snapshot for actor_snapshot in actor_snapshots if actor_snapshot is not None]
+    if present:
+        locations = [actor_snapshot.get_transform().location for actor_snapshot in present]
+        positions[alive] = np.fromiter(
+            itertools.chain.from_iterable((loc.x, loc.y, loc.z) for loc in locations), float, 3 * len(present)
+        ).reshape(-1, 3)
+        vectors = [actor_snapshot.get_velocity() for actor_snapshot in present]
+        velocities[alive] = np.fromiter(
+            itertools.chain.from_iterable((v.x, v.y, v.z) for v in vectors), float, 3 * len(present)
+        ).reshape(-1, 3)
+    timestamp = world_snapshot.timestamp
+    return FleetSnapshot(world_snapshot.frame, timestamp.elapsed_seconds, list(actor_ids), positions, velocities, alive)
+
+
+def vehicle_state_from_actor(vehicle, frame=None, with_speed=True):
+    # the same VehicleState asked from the server, for agents without a FleetSnapshotService
+    if not vehicle.is_alive:
+        return VehicleState(frame, None, False, math.nan, math.nan, math.nan, math.nan)
+    location = vehicle.get_transform().location
+    speed = None
+    if with_speed:
+        velocity = vehicle.get_velocity()
+        speed = 3.6 * math.sqrt(velocity.x ** 2 + velocity.y ** 2 + velocity.z ** 2)
+    return VehicleState(frame, None, True, location.x, location.y, location.z, speed)
+
+
+class FleetSnapshotService:
+    def __init__(self, world, actor_ids=()):
+        self.world = world
+        self.actor_ids = list(actor_ids)
+        self.latest = None
+        self.listeners = []
+        self.callback_id = None
+
+    def track(self, actor_ids):
+        # a new list, the CARLA thread may be iterating the current one
+        self.actor_ids = self.actor_ids + [actor_id for actor_id in actor_ids if actor_id not in self.actor_ids]
+
+    def add_listener(self, callback):
+        # callback(fleet_snapshot), called on the CARLA client thread after every tick
+        self.listeners.append(callback)
+
+    def start(self):
+        self.latest = read_fleet_snapshot(self.world.get_snapshot(), self.actor_ids)
+        self.callback_id = self.world.on_tick(self._on_tick)
+
+    def stop(self):
+        if self.callback_id is not None:
+            self.world.remove_on_tick(self.callback_id)
+            self.callback_id = None
+
+    def _on_tick(self, world_snapshot):
+        self.latest = read_fleet_snapshot(world_snapshot, self.actor_ids)
+        for callback in list(self.listeners):
+            callback(self.latest)
@@ -0,0 +1,163 @@
+import csv
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# Throughput, queues and delay at the intersections, measured from the fleet snapshot.
+# Every lane a traffic light controls (TrafficLight.get_stop_waypoints()) gets
+# a stop-line zone: a rectangle as wide as the lane reaching APPROACH_LENGTH
+# metres upstream of the stop line. A vehicle crosses the stop line when it
+# leaves its zone over the front edge; while it is in the zone slower than
+# QUEUED_SPEED it is queued and delayed. The lanes of one light are an
+# approach. The listener runs once per tick on the CARLA client thread and
+# sums the counts per approach into one row every `interval` seconds of
+# simulation time, for the approaches that had traffic; the rows are written
+# as CSV at teardown.
+
+APPROACH_LENGTH = 80.0
+# km/h, a vehicle in a zone slower than this is queued
+QUEUED_SPEED = 5.0
+METRICS_INTERVAL = 10.0
+CSV_COLUMNS = ("time", "intersection", "light", "pole", "crossings", "flow_veh_h", "mean_queue", "max_queue",
+               "max_queue_m", "stopped_delay_s")
+
+# intersection is the smallest light id of the light's group, like the intersection controllers' jids
+Approach = namedtuple("Approach", ["intersection", "light_id", "pole"])
+# one lane of an approach: the centre of its stop line and the unit vector of the direction of travel
+StopLine = namedtuple("StopLine", ["approach", "x", "y", "forward_x", "forward_y", "width"])
+
+
+def read_stop_lines(light_index, records=None):
+    # the approaches and stop lines of the lights of `records` (default every light of the map)
+    approaches = []
+    stop_lines = []
+    for group in light_index.groups(records):
+        group_records = [light_index.records[light_id] for light_id in group if light_id in light_index.records]
+        for light in light_index.actors(group_records):
+            waypoints = light.get_stop_waypoints()
+            if not waypoints:
+                continue
+            for waypoint in waypoints:
+                transform = waypoint.transform
+                forward = transform.get_forward_vector()
+                norm = math.hypot(forward.x, forward.y) or 1.0
+                stop_lines.append(StopLine(len(approaches), transform.location.x, transform.location.y,
+                                           forward.x / norm, forward.y / norm, waypoint.lane_width))
+            approaches.append(Approach(group[0], light.id, light.get_pole_index()))
+    return approaches, stop_lines
+
+
+class IntersectionMetrics:
+    def __init__(self, approaches, stop_lines, interval=METRICS_INTERVAL):
+        self.approaches = approaches
+        self.interval = interval
+        self.x = np.array([line.x for line in stop_lines], float)
+        self.y = np.array([line.y for line in stop_lines], float)
+        self.forward_x = np.array([line.forward_x for line in stop_lines], float)
+        self.forward_y = np.array([line.forward_y for line in stop_lines], float)
+        self.half_width = np.array([line.width / 2 for line in stop_lines], float)
+        self.lane_approach = np.array([line.approach for line in stop_lines], int)
+        # zone of every vehicle row at the previous tick, -1 outside the zones
+        self.previous_lanes = np.zeros(0, int)
+        self.started_at = None
+        self.last_time = None
+        self.interval_start = None
+        self.crossings_total = np.zeros(len(approaches), int)
+        self.rows = []
+        self._reset_interval()
+
+    @classmethod
+    def load(cls, light_index, records=None, interval=METRICS_INTERVAL):
+        approaches, stop_lines = read_stop_lines(light_index, records)
+        return cls(approaches, stop_lines, interval)
+
+    def _reset_interval(self):
+        count = len(self.approaches)
+        self.crossings = np.zeros(count, int)
+        # vehicle-seconds queued, the time integral of the queue
+        self.queued_time = np.zeros(count)
+        self.max_queue = np.zeros(count, int)
+        self.max_queue_length = np.zeros(count)
+
+    def on_snapshot(self, fleet):
+        # FleetSnapshotService listener
+        now = fleet.elapsed_seconds
+        if self.started_at is None:
+            self.started_at = self.last_time = self.interval_start = now
+        dt = max(0.0, now - self.last_time)
+        self.last_time = now
+        count = len(fleet.actor_ids)
+        if not count or not len(self.approaches):
+            return
+
+        # vehicles x stop lines, in the frame of each stop line; dead vehicles are NaN and in no zone
+        dx = fleet.positions[:, 0, None] - self.x[None, :]
+        dy = fleet.positions[:, 1, None] - self.y[None, :]
+        longitudinal = dx * self.forward_x + dy * self.forward_y
+        lateral = np.abs(dx * self.forward_y - dy * self.forward_x)
+        inside = (lateral <= self.half_width) & (longitudinal <= 0) & (longitudinal >= -APPROACH_LENGTH)
+        # a vehicle is in one zone at most, the lane it is most centred in
+        lanes = np.where(inside, lateral, np.inf).argmin(axis=1)
+        lanes[~inside.any(axis=1)] = -1
+
+        previous = self.previous_lanes
+        if len(previous) < count:
+            # the snapshot tracks vehicles spawned since the last tick
+            previous = np.concatenate([previous, np.full(count - len(previous), -1, int)])
+        was_inside = previous >= 0
+        rows = np.flatnonzero(was_inside & (lanes != previous))
+        crossed = rows[longitudinal[rows, previous[rows]] > 0]
+        np.add.at(self.crossings, self.lane_approach[previous[crossed]], 1)
+        self.previous_lanes = lanes
+
+        in_zone = np.flatnonzero(lanes >= 0)
+        queued = in_zone[fleet.speeds[in_zone] < QUEUED_SPEED]
+        queued_approaches = self.lane_approach[lanes[queued]]
+        queue = np.bincount(queued_approaches, minlength=len(self.approaches))
+        self.queued_time += queue * dt
+        np.maximum(self.max_queue, queue, out=self.max_queue)
+        np.maximum.at(self.max_queue_length, queued_approaches, -longitudinal[queued, lanes[queued]])
+
+        if now - self.interval_start >= self.interval:
+            self.close_interval()
+
+    def close_interval(self):
+        duration = self.last_time - self.interval_start if self.last_time is not None else 0.0
+        if duration <= 0:
+            return
+        for index, approach in enumerate(self.approaches):
+            crossings = int(self.crossings[index])
+            # keeps the file compact, a missing row is an approach without traffic in that interval
+            if not crossings and not self.max_queue[index]:
+                continue
+            self.rows.append((round(self.last_time, 2), approach.intersection, approach.light_id, approach.pole,
+                              crossings, round(crossings * 3600.0 / duration, 1),
+                              round(self.queued_time[index] / duration, 2), int(self.max_queue[index]),
+                              round(float(self.max_queue_length[index]), 1), round(float(self.queued_time[index]), 2)))
+        self.crossings_total += self.crossings
+        self.interval_start = self.last_time
+        self._reset_interval()
+
+    def write_csv(self, path):
+        self.close_interval()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            writer.writerows(self.rows)
+
+    def report(self):
+        duration = self.last_time - self.started_at if self.started_at is not None else 0.0
+        total = int(self.crossings_total.sum() + self.crossings.sum())
+        if duration <= 0:
+            print("intersection metrics: no ticks recorded")
+            return
+        print(f"intersection metrics: {total} stop line crossings in {duration:.1f} s of simulation, "
+              f"{total * 3600.0 / duration:.0f} veh/h")
+        per_intersection = {}
+        for approach, crossings in zip(self.approaches, (self.crossings_total + self.crossings).tolist()):
+            per_intersection[approach.intersection] = per_intersection.get(approach.intersection, 0) + crossings
+        for intersection, crossings in sorted(per_intersection.items()):
+            if crossings:
+                print(f"  intersection {intersection}: {crossings} crossings, "
+                      f"{crossings * 3600.0 / duration:.0f} veh/h")
@@ -0,0 +1,134 @@
+import asyncio
+import bisect
+import heapq
+import math
+import time
+
+# End-to-end BSM latency.
+# Senders stamp every BSM with the simulation frame and time.time(); the
+# receiving agents record how old the message is when ParseBSM gets it, in
+# milliseconds of wall clock and in simulation frames.
+# All agents of a launcher share one SimulationClock and one BsmLatency, set
+# by the launcher as agent.clock and agent.latency; clear_world() prints it.
+
+
+# rounding slack when comparing simulated times
+_EPSILON = 1e-6
+
+
+class SimulationClock:
+    # latest simulation frame, updated by the launcher every tick, and the
+    # simulated time from the fleet snapshot, which agents can sleep on
+    def __init__(self):
+        self.frame = None
+        self.elapsed_seconds = None
+        # heap of (wake up time, order, future) of the pending sleep() calls
+        self.sleepers = []
+        self.sleeps = 0
+
+    def update(self, frame):
+        self.frame = frame
+
+    def advance(self, elapsed_seconds):
+        # on the agents' event loop, after every tick
+        self.elapsed_seconds = elapsed_seconds
+        while self.sleepers and self.sleepers[0][0] <= elapsed_seconds + _EPSILON:
+            future = heapq.heappop(self.sleepers)[2]
+            if not future.done():
+                future.set_result(None)
+
+    async def sleep(self, seconds):
+        # `seconds` of simulation time; wall clock until the launcher advanced the clock once
+        if self.elapsed_seconds is None:
+            await asyncio.sleep(seconds)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.sleeps += 1
+        heapq.heappush(self.sleepers, (self.elapsed_seconds + seconds, self.sleeps, future))
+        await future
+
+    def __getstate__(self):
+        # a worker's BsmLatency is sent to the coordinator with its clock, not with the pending sleeps
+        state = dict(self.__dict__)
+        state["sleepers"] = []
+        return state
+
+
+class LatencyHistogram:
+    # log spaced buckets, `buckets_per_decade` per power of ten between
+    # `lowest` and `highest`; percentiles are reported as the upper edge of
+    # the bucket they fall in, so they are accurate to about 12 %
+    def __init__(self, lowest=0.01, highest=100000.0, buckets_per_decade=20):
+        decades = math.log10(highest / lowest)
+        count = int(math.ceil(decades * buckets_per_decade))
+        self.edges = [lowest * 10 ** (i / buckets_per_decade) for i in range(count + 1)]
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0
+        self.maximum = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.total += 1
+        if value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        # other has to use the same buckets
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, percent):
+        if not self.total:
+            return math.nan
+        rank = math.ceil(self.total * percent / 100.0)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.edges[index], self.maximum) if index < len(self.edges) else self.maximum
+        return self.maximum
+
+    def summary(self, unit):
+        if not self.total:
+            return "no samples"
+        return (f"n={self.total} p50={self.percentile(50):.2f} {unit} p95={self.percentile(95):.2f} {unit} "
+                f"p99={self.percentile(99):.2f} {unit} max={self.maximum:.2f} {unit}")
+
+
+class BsmLatency:
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.age_ms = LatencyHistogram()
+        self.age_frames = LatencyHistogram(lowest=1.0)
+        self.same_frame = 0
+        self.unstamped = 0
+
+    def record(self, bsm, received_at=None):
+        if bsm.sent_at is None:
+            self.unstamped += 1
+            return
+        if received_at is None:
+            received_at = time.time()
+        self.age_ms.record(max(0.0, (received_at - bsm.sent_at) * 1000.0))
+        current_frame = self.clock.frame if self.clock is not None else None
+        if bsm.frame is not None and current_frame is not None:
+            frames = current_frame - bsm.frame
+            if frames <= 0:
+                self.same_frame += 1
+            else:
+                self.age_frames.record(frames)
+
+    def merge(self, other):
+        # adds the samples another process recorded, e.g. a worker of --workers
+        self.age_ms.merge(other.age_ms)
+        self.age_frames.merge(other.age_frames)
+        self.same_frame += other.same_frame
+        self.unstamped += other.unstamped
+
+    def report(self, title="BSM latency"):
+        print(f"{title}:")
+        print(f"  age at receipt   {self.age_ms.summary('ms')}")
+        print(f"  frames behind    {self.age_frames.summary('frames')} (+{self.same_frame} in the same frame)")
+        if self.unstamped:
+            print(f"  {self.unstamped} BSMs without a send time")
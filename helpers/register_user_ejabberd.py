@@ -1,17 +1,84 @@
+import asyncio
+import logging
+
+import aiohttp
 import requests
 
+from exceptions.ejabberd_exceptions import ProvisioningError
+
+EJABBERD_API_URL = 'http://localhost:5280/api'
+XMPP_HOST = 'localhost'
+
+REGISTERED = "registered"
+ALREADY_REGISTERED = "already registered"
+
 def register_user(username, password):
-    url = 'http://localhost:5280/api/register'
+    url = f'{EJABBERD_API_URL}/register'
     headers = {
         'Content-Type': 'application/json'
     }
     data = {
         "user": username,
-        "host": "localhost",
+        "host": XMPP_HOST,
         "password": password
     }
 
     response = requests.post(url, headers=headers, json=data, verify=False)
 
+class EjabberdProvisioner:
+    # async account registration over one pooled HTTP session
+    # use as: async with EjabberdProvisioner() as provisioner: ...
+    def __init__(self, api_url=EJABBERD_API_URL, host=XMPP_HOST, concurrency=32, batch_size=256):
+        self.api_url = api_url.rstrip('/')
+        self.host = host
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.session = None
+        self.limit = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        self.limit = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        self.session = None
+
+    async def register(self, username, password):
+        data = {
+            "user": username,
+            "host": self.host,
+            "password": password
+        }
+        async with self.limit:
+            async with self.session.post(f'{self.api_url}/register', json=data) as response:
+                body = await response.text()
+        if response.status == 200:
+            return REGISTERED
+        # ejabberd answers 409 (older versions 500) with "User ... already registered"
+        if response.status == 409 or "already registered" in body or "already exists" in body:
+            return ALREADY_REGISTERED
+        raise ProvisioningError(f"Registering {username}@{self.host} failed with HTTP {response.status}: {body}")
+
+    async def register_many(self, accounts):
+        # accounts: iterable of (username, password), registered in parallel batches
+        accounts = list(accounts)
+        results = {}
+        for start in range(0, len(accounts), self.batch_size):
+            batch = accounts[start:start + self.batch_size]
+            outcomes = await asyncio.gather(*(self.register(username, password) for username, password in batch),
+                                            return_exceptions=True)
+            for (username, _), outcome in zip(batch, outcomes):
+                if isinstance(outcome, BaseException):
+                    logging.error(f"Could not register {username}: {outcome!r}")
+                results[username] = outcome
+        return results
+
+async def provision_fleet(actor_ids, prefix="car", **kwargs):
+    # registers the accounts the simulations use for their agents, <prefix><id> / pass<id>
+    async with EjabberdProvisioner(**kwargs) as provisioner:
+        return await provisioner.register_many((f"{prefix}{actor_id}", f"pass{actor_id}") for actor_id in actor_ids)
+
 if __name__ == '__main__':
-    register_user("car40","pass40")
\ No newline at end of file
+    register_user("car40","pass40")
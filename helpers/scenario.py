@@ -0,0 +1,338 @@
+import json
+import os
+from collections import namedtuple
+
+from numpy import random
+
+from exceptions.scenario_exceptions import InvalidScenario
+from helpers.carla_backend import BACKEND, carla
+from helpers.disk_cache import load_cached, store_cached
+
+# Declarative scenario files (JSON) for the simulation scripts.
+# A scenario describes the map, the fixed time step, the traffic lights, the
+# spectator camera, which blueprints to use, the traffic manager settings and
+# where the vehicles spawn, plus V2V defaults for the command line options:
+#
+# {
+#   "name": "crash_prevention",
+#   "map": null,
+#   "fixed_delta_seconds": 0.03,
+#   "traffic_lights": {"state": "Green", "frozen": true},
+#   "camera": {"location": [134.66, 57, 30.37], "rotation": [-33.9, 131.84, 0.0]},
+#   "blueprints": {"filter": "vehicle*", "base_type": "car"},
+#   "traffic_manager": {"global_percentage_speed_difference": -100.0,
+#                       "vehicle": {"desired_speed": 100.0, "distance_to_leading_vehicle": 1}},
+#   "spawn": [{"points": [[19.0, 141.3, 0.6, 0.0, 0.0, 0.0]]},
+#             {"grid": {"origin": [19.0, 137.4, 0.6], "rows": 2, "columns": 8,
+#                       "row_step": [0, -3.9, 0], "column_step": [-6, 0, 0]}},
+#             {"map_spawn_points": {"count": 100}, "traffic_manager": {"desired_speed": 60.0}}],
+#   "v2v": {"bsm_rate": 10, "comm_radius": 150}
+# }
+#
+# With V2V_CARLA_BACKEND=fake a launcher's default scenario is replaced by
+# its "<name>_fake.json" variant when there is one, since the fake world's
+# roads are not the map's.
+#
+# Points are x, y, z and optionally pitch, yaw, roll. Grids and point lists
+# are expanded and validated once and cached on disk next to the file's mtime,
+# so a 500 car scenario does not pay for it on every start. Spawn points of
+# the map are only known once connected and are resolved by spawn_transforms().
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scenarios")
+# bump when the parsed representation or its validation changes, invalidates cached scenarios
+SCENARIO_FORMAT = 2
+
+TRAFFIC_LIGHT_STATES = ("Red", "Yellow", "Green", "Off")
+
+Scenario = namedtuple("Scenario", ["name", "map", "fixed_delta_seconds", "traffic_lights", "camera", "blueprints",
+                                   "global_speed_difference", "vehicles", "map_spawn_points", "v2v"])
+# pose is (x, y, z, pitch, yaw, roll), tm the traffic manager settings of the vehicle
+VehicleSpec = namedtuple("VehicleSpec", ["pose", "tm"])
+MapSpawnPoints = namedtuple("MapSpawnPoints", ["count", "start", "tm"])
+TrafficManagerSettings = namedtuple("TrafficManagerSettings",
+                                    ["desired_speed", "distance_to_leading_vehicle", "ignore_vehicles_percentage",
+                                     "path"])
+BlueprintSelection = namedtuple("BlueprintSelection", ["filter", "generation", "base_type", "id_contains",
+                                                       "same_for_all"])
+V2VSettings = namedtuple("V2VSettings", ["bsm_rate", "comm_radius", "broadcast"])
+
+_TOP_LEVEL_KEYS = {"name", "map", "fixed_delta_seconds", "traffic_lights", "camera", "blueprints", "traffic_manager",
+                   "spawn", "v2v"}
+_TM_KEYS = set(TrafficManagerSettings._fields)
+_NO_TM = TrafficManagerSettings(None, None, None, None)
+
+
+def default_scenario_name(name):
+    # the fake backend has its own road grid, a scenario's "<name>_fake" variant is laid out on it
+    if name and BACKEND == "fake" and os.path.exists(os.path.join(SCENARIO_DIR, f"{name}_fake.json")):
+        return f"{name}_fake"
+    return name
+
+
+def resolve_scenario_path(name):
+    # a path, or the name of a file in scenarios/ with or without .json
+    if os.path.exists(name):
+        return name
+    candidate = os.path.join(SCENARIO_DIR, name if name.endswith(".json") else f"{name}.json")
+    if os.path.exists(candidate):
+        return candidate
+    raise InvalidScenario(f"Scenario '{name}' not found")
+
+
+def load_scenario(name, use_cache=True):
+    path = os.path.abspath(resolve_scenario_path(name))
+    stat = os.stat(path)
+    key = (SCENARIO_FORMAT, stat.st_mtime_ns, stat.st_size)
+    if use_cache:
+        scenario = load_cached("scenarios", path, key)
+        if scenario is not None:
+            return scenario
+    with open(path) as f:
+        try:
+            document = json.load(f)
+        except ValueError as e:
+            raise InvalidScenario(f"{path}: not valid JSON ({e})")
+    scenario = parse_scenario(document, path)
+    if use_cache:
+        store_cached("scenarios", path, key, scenario)
+    return scenario
+
+
+def parse_scenario(document, source="scenario"):
+    _expect(isinstance(document, dict), source, "must be a JSON object")
+    unknown = set(document) - _TOP_LEVEL_KEYS
+    _expect(not unknown, source, f"unknown keys {sorted(unknown)}")
+
+    name = document.get("name", os.path.splitext(os.path.basename(source))[0])
+    _expect(isinstance(name, str), source, "name must be a string")
+    map_name = document.get("map")
+    _expect(map_name is None or isinstance(map_name, str), source, "map must be a string")
+    fixed_delta_seconds = document.get("fixed_delta_seconds", 0.03)
+    _expect(_is_number(fixed_delta_seconds) and fixed_delta_seconds > 0, source,
+            "fixed_delta_seconds must be a positive number")
+
+    traffic_lights = document.get("traffic_lights")
+    if traffic_lights is not None:
+        where = f"{source}: traffic_lights"
+        _expect(isinstance(traffic_lights, dict) and set(traffic_lights) <= {"state", "frozen"}, where,
+                "must be an object with 'state' and 'frozen'")
+        state = traffic_lights.get("state", "Green")
+        _expect(state in TRAFFIC_LIGHT_STATES, where, f"state must be one of {', '.join(TRAFFIC_LIGHT_STATES)}")
+        frozen = traffic_lights.get("frozen", True)
+        _expect(isinstance(frozen, bool), where, "frozen must be true or false")
+        traffic_lights = (state, frozen)
+
+    camera = document.get("camera")
+    if camera is not None:
+        where = f"{source}: camera"
+        _expect(isinstance(camera, dict) and set(camera) <= {"location", "rotation"}, where,
+                "must be an object with 'location' and 'rotation'")
+        camera = _vector(camera.get("location"), f"{where}.location") + _vector(camera.get("rotation", [0, 0, 0]),
+                                                                              f"{where}.rotation")
+
+    blueprints = _blueprints(document.get("blueprints", {}), f"{source}: blueprints")
+
+    traffic_manager = document.get("traffic_manager", {})
+    where = f"{source}: traffic_manager"
+    _expect(isinstance(traffic_manager, dict)
+            and set(traffic_manager) <= {"global_percentage_speed_difference", "vehicle"}, where,
+            "must be an object with 'global_percentage_speed_difference' and 'vehicle'")
+    global_speed_difference = traffic_manager.get("global_percentage_speed_difference")
+    _expect(global_speed_difference is None or _is_number(global_speed_difference), where,
+            "global_percentage_speed_difference must be a number")
+    default_tm = _tm_settings(traffic_manager.get("vehicle", {}), _NO_TM, f"{where}.vehicle")
+
+    spawn = document.get("spawn")
+    _expect(isinstance(spawn, list) and spawn, source, "spawn must be a non-empty list")
+    vehicles = []
+    map_spawn_points = []
+    for index, group in enumerate(spawn):
+        where = f"{source}: spawn[{index}]"
+        _expect(isinstance(group, dict), where, "must be an object")
+        generators = [key for key in ("points", "grid", "map_spawn_points") if key in group]
+        _expect(len(generators) == 1, where, "needs exactly one of 'points', 'grid' or 'map_spawn_points'")
+        _expect(set(group) <= {generators[0], "traffic_manager"}, where, f"unknown keys {sorted(group)}")
+        tm = _tm_settings(group.get("traffic_manager", {}), default_tm, f"{where}.traffic_manager")
+        if generators[0] == "points":
+            points = group["points"]
+            _expect(isinstance(points, list) and points, where, "points must be a non-empty list")
+            vehicles.extend(VehicleSpec(_pose(point, f"{where}.points[{i}]"), tm) for i, point in enumerate(points))
+        elif generators[0] == "grid":
+            vehicles.extend(VehicleSpec(pose, tm) for pose in _grid(group["grid"], f"{where}.grid"))
+        else:
+            generator = group["map_spawn_points"]
+            _expect(isinstance(generator, dict) and set(generator) <= {"count", "start"}, where,
+                    "map_spawn_points must be an object with 'count' and 'start'")
+            count = generator.get("count")
+            start = generator.get("start", 0)
+            _expect(_is_count(count) and count > 0, where, "map_spawn_points.count must be a positive integer")
+            _expect(_is_count(start), where, "map_spawn_points.start must be a non-negative integer")
+            map_spawn_points.append(MapSpawnPoints(count, start, tm))
+
+    v2v = document.get("v2v", {})
+    where = f"{source}: v2v"
+    _expect(isinstance(v2v, dict) and set(v2v) <= set(V2VSettings._fields), where,
+            f"must be an object with {', '.join(V2VSettings._fields)}")
+    for key in ("bsm_rate", "comm_radius"):
+        value = v2v.get(key)
+        _expect(value is None or (_is_number(value) and value > 0), where, f"{key} must be a positive number")
+    _expect(isinstance(v2v.get("broadcast", False), bool), where, "broadcast must be true or false")
+    # a broadcast BSM reaches every vehicle in the room, there is no radius to apply
+    _expect(not (v2v.get("broadcast") and v2v.get("comm_radius") is not None), where,
+            "broadcast and comm_radius cannot be combined")
+    v2v = V2VSettings(v2v.get("bsm_rate"), v2v.get("comm_radius"), v2v.get("broadcast", False))
+
+    return Scenario(name, map_name, fixed_delta_seconds, traffic_lights, camera, blueprints, global_speed_difference,
+                    vehicles, map_spawn_points, v2v)
+
+
+def _expect(condition, where, message):
+    if not condition:
+        raise InvalidScenario(f"{where}: {message}")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _vector(value, where):
+    _expect(isinstance(value, list) and len(value) == 3 and all(_is_number(v) for v in value), where,
+            "expected [x, y, z] numbers")
+    return tuple(float(v) for v in value)
+
+
+def _pose(value, where):
+    # [x, y, z] or [x, y, z, pitch, yaw, roll]
+    _expect(isinstance(value, list) and len(value) in (3, 6) and all(_is_number(v) for v in value), where,
+            "expected [x, y, z] or [x, y, z, pitch, yaw, roll] numbers")
+    pose = tuple(float(v) for v in value)
+    return pose if len(pose) == 6 else pose + (0.0, 0.0, 0.0)
+
+
+def _grid(grid, where):
+    _expect(isinstance(grid, dict), where, "must be an object")
+    allowed = {"origin", "rotation", "rows", "columns", "row_step", "column_step"}
+    _expect(set(grid) <= allowed, where, f"unknown keys {sorted(set(grid) - allowed)}")
+    origin = _vector(grid.get("origin"), f"{where}.origin")
+    rotation = _vector(grid.get("rotation", [0, 0, 0]), f"{where}.rotation")
+    rows = grid.get("rows", 1)
+    columns = grid.get("columns", 1)
+    _expect(_is_count(rows) and rows > 0 and _is_count(columns) and columns > 0, where,
+            "rows and columns must be positive integers")
+    row_step = _vector(grid.get("row_step", [0, 0, 0]), f"{where}.row_step")
+    column_step = _vector(grid.get("column_step", [0, 0, 0]), f"{where}.column_step")
+    poses = []
+    for row in range(rows):
+        for column in range(columns):
+            poses.append(tuple(origin[k] + row * row_step[k] + column * column_step[k] for k in range(3)) + rotation)
+    return poses
+
+
+def _tm_settings(settings, defaults, where):
+    _expect(isinstance(settings, dict) and set(settings) <= _TM_KEYS, where,
+            f"must be an object with {', '.join(sorted(_TM_KEYS))}")
+    for key in ("desired_speed", "distance_to_leading_vehicle", "ignore_vehicles_percentage"):
+        value = settings.get(key)
+        _expect(value is None or (_is_number(value) and value >= 0), where, f"{key} must be a non-negative number")
+    path = settings.get("path")
+    if path is not None:
+        _expect(isinstance(path, list) and path, where, "path must be a non-empty list of [x, y, z]")
+        path = tuple(_vector(point, f"{where}.path[{i}]") for i, point in enumerate(path))
+    merged = defaults._asdict()
+    merged.update({key: value for key, value in settings.items() if key != "path"})
+    if path is not None:
+        merged["path"] = path
+    return TrafficManagerSettings(**merged)
+
+
+def _blueprints(selection, where):
+    allowed = set(BlueprintSelection._fields)
+    _expect(isinstance(selection, dict) and set(selection) <= allowed, where,
+            f"must be an object with {', '.join(sorted(allowed))}")
+    bp_filter = selection.get("filter", "vehicle*")
+    generation = str(selection.get("generation", "all"))
+    base_type = selection.get("base_type")
+    id_contains = selection.get("id_contains")
+    same_for_all = selection.get("same_for_all", False)
+    _expect(isinstance(bp_filter, str), where, "filter must be a string")
+    _expect(generation.lower() in ("all", "1", "2"), where, "generation must be 'all', 1 or 2")
+    _expect(base_type is None or isinstance(base_type, str), where, "base_type must be a string")
+    _expect(id_contains is None or isinstance(id_contains, str), where, "id_contains must be a string")
+    _expect(isinstance(same_for_all, bool), where, "same_for_all must be true or false")
+    return BlueprintSelection(bp_filter, generation, base_type, id_contains, same_for_all)
+
+
+# -- applying a scenario to the world ------------------------------------------
+
+
+def to_transform(pose):
+    x, y, z, pitch, yaw, roll = pose
+    return carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+
+
+def load_scenario_map(client, scenario):
+    # only reloads when the scenario asks for another map than the one running
+    world = client.get_world()
+    if scenario.map and not world.get_map().name.endswith(scenario.map):
+        world = client.load_world(scenario.map)
+    return world
+
+
+def spawn_transforms(scenario, world):
+    # [(carla.Transform, TrafficManagerSettings)] for every vehicle of the scenario
+    spawns = [(to_transform(vehicle.pose), vehicle.tm) for vehicle in scenario.vehicles]
+    if scenario.map_spawn_points:
+        map_points = world.get_map().get_spawn_points()
+        for generator in scenario.map_spawn_points:
+            points = map_points[generator.start:generator.start + generator.count]
+            if len(points) < generator.count:
+                raise InvalidScenario(f"{scenario.name}: map has {len(map_points)} spawn points, "
+                                      f"{generator.start + generator.count} requested")
+            spawns.extend((point, generator.tm) for point in points)
+    return spawns
+
+
+def choose_blueprints(blueprints, selection, count):
+    # one blueprint per vehicle, or the same one for all of them; blueprints
+    # come from BlueprintCatalogue.select() (helpers/blueprint_cache.py)
+    # by index, numpy's choice() cannot pick from a list of tuples
+    if selection.same_for_all:
+        return [blueprints[random.randint(len(blueprints))]] * count
+    return [blueprints[random.randint(len(blueprints))] for _ in range(count)]
+
+
+def apply_traffic_lights(world, scenario):
+    if scenario.traffic_lights is None:
+        return
+    state, frozen = scenario.traffic_lights
+    for tl in world.get_actors().filter('traffic.traffic_light'):
+        tl.set_state(getattr(carla.TrafficLightState, state))
+        tl.freeze(frozen)
+
+
+def apply_traffic_manager(traffic_manager, world, scenario, vehicle_settings):
+    # vehicle_settings maps actor ids to their TrafficManagerSettings
+    if scenario.global_speed_difference is not None:
+        traffic_manager.global_percentage_speed_difference(scenario.global_speed_difference)
+    for actor_id, tm in vehicle_settings.items():
+        vehicle = world.get_actor(actor_id)
+        if vehicle is None:
+            continue
+        if tm.desired_speed is not None:
+            traffic_manager.set_desired_speed(vehicle, tm.desired_speed)
+        if tm.distance_to_leading_vehicle is not None:
+            traffic_manager.distance_to_leading_vehicle(vehicle, tm.distance_to_leading_vehicle)
+        if tm.ignore_vehicles_percentage is not None:
+            traffic_manager.ignore_vehicles_percentage(vehicle, tm.ignore_vehicles_percentage)
+        if tm.path is not None:
+            traffic_manager.set_path(vehicle, [carla.Location(x=x, y=y, z=z) for x, y, z in tm.path])
+
+
+def spectator_transform(scenario):
+    if scenario.camera is None:
+        return None
+    return to_transform(scenario.camera)
@@ -0,0 +1,48 @@
+import math
+from collections import namedtuple
+
+from exceptions.spat_exceptions import InvalidSpat
+
+# SPaT (signal phase and timing) messages of the semaphore agents, plain text:
+#
+#   Semaphore:<state>,<x>,<y>[,<time to change>[,<departure offset>]]
+#
+# state is the light's TrafficLightState name, x and y its location.
+# time to change is the simulation seconds until the light switches state,
+# empty or left out when it is not known (a frozen light switched by hand).
+# departure offset is only in the green SPaT to a vehicle queued at the light:
+# the seconds it waits before launching, from its position in the queue.
+# Older vehicles only read the first three fields.
+SPAT_PREFIX = "Semaphore:"
+
+# time_to_change is None when the sender did not know it, departure_offset when it was not sent
+Spat = namedtuple("Spat", ["state", "x", "y", "time_to_change", "departure_offset"])
+
+
+def encode_spat(state, x, y, time_to_change=None, departure_offset=None):
+    body = f"{SPAT_PREFIX}{state},{x},{y}"
+    if time_to_change is not None or departure_offset is not None:
+        body += "," if time_to_change is None else f",{time_to_change:.2f}"
+    if departure_offset is not None:
+        body += f",{departure_offset:.2f}"
+    return body
+
+
+def decode_spat(body):
+    if not body.startswith(SPAT_PREFIX):
+        raise InvalidSpat("SPaT body does not start with 'Semaphore:'")
+    fields = body[len(SPAT_PREFIX):].split(",")
+    if len(fields) < 3:
+        raise InvalidSpat(f"SPaT body has {len(fields)} fields, expected at least 3")
+    try:
+        x = float(fields[1])
+        y = float(fields[2])
+        time_to_change = float(fields[3]) if len(fields) > 3 and fields[3] else None
+        departure_offset = float(fields[4]) if len(fields) > 4 and fields[4] else None
+    except ValueError:
+        raise InvalidSpat("SPaT location or time is not a number")
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise InvalidSpat("SPaT location is not finite")
+    if departure_offset is not None and not (math.isfinite(departure_offset) and departure_offset >= 0):
+        raise InvalidSpat("SPaT departure offset must be a non-negative number")
+    return Spat(fields[0], x, y, time_to_change, departure_offset)
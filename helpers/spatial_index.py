@@ -0,0 +1,79 @@
+import math
+
+# Uniform grid over the x/y plane. Keys are whatever the caller uses to
+# identify an entity (agent jid, actor id, ...) and positions are any objects
+# with x and y attributes (carla.Location, carla.Vector3D, ...).
+# A radius query only looks at the cells overlapping the query circle, so with
+# cell_size close to the query radius it touches at most 9 cells.
+
+
+class SpatialGrid:
+    def __init__(self, cell_size=100.0):
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        self.cell_size = float(cell_size)
+        # (cells, positions) kept in one tuple so a rebuild swaps both at once
+        self._index = ({}, {})
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def rebuild(self, positions):
+        # build into fresh containers and swap, so a reader in another thread
+        # sees either the old or the new index, never a half-built one
+        cells = {}
+        stored = {}
+        cell_size = self.cell_size
+        for key, position in positions.items():
+            x, y = position.x, position.y
+            stored[key] = (x, y)
+            cell = (math.floor(x / cell_size), math.floor(y / cell_size))
+            bucket = cells.get(cell)
+            if bucket is None:
+                cells[cell] = [key]
+            else:
+                bucket.append(key)
+        self._index = (cells, stored)
+
+    def update(self, key, position):
+        self.remove(key)
+        cells, positions = self._index
+        x, y = position.x, position.y
+        positions[key] = (x, y)
+        cells.setdefault(self._cell(x, y), []).append(key)
+
+    def remove(self, key):
+        cells, positions = self._index
+        old = positions.pop(key, None)
+        if old is None:
+            return
+        cell = self._cell(*old)
+        bucket = cells.get(cell)
+        if bucket is not None:
+            bucket.remove(key)
+            if not bucket:
+                del cells[cell]
+
+    def position(self, key):
+        return self._index[1].get(key)
+
+    def query_radius(self, position, radius):
+        cells, positions = self._index
+        x, y = position.x, position.y
+        radius_sq = radius * radius
+        min_cx, min_cy = self._cell(x - radius, y - radius)
+        max_cx, max_cy = self._cell(x + radius, y + radius)
+        found = []
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                for key in cells.get((cx, cy), ()):
+                    px, py = positions[key]
+                    if (px - x) ** 2 + (py - y) ** 2 <= radius_sq:
+                        found.append(key)
+        return found
+
+    def __contains__(self, key):
+        return key in self._index[1]
+
+    def __len__(self):
+        return len(self._index[1])
@@ -0,0 +1,52 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Vectorized version of the lane change "vehicle approaching" check.
+# positions: (vehicles, history, 3) array, oldest sample first, NaN padded
+# speeds: (vehicles,) km/h as reported in the BSMs
+# timestamps: optional (vehicles, history) sample times in seconds, when not
+# given the samples are assumed to be `sample_period` seconds apart
+
+ThreatAssessment = namedtuple("ThreatAssessment", ["distance", "closing_speed", "time_to_collision", "approaching"])
+
+# a vehicle is approaching when its distance to us hit a new minimum in at
+# least this many samples and it is faster than us
+MIN_CLOSING_SAMPLES = 4
+_FAR_AWAY = 10000.0
+
+
+def assess_threats(positions, speeds, my_position, my_speed, timestamps=None, sample_period=0.5):
+    positions = np.asarray(positions, dtype=float)
+    vehicles, history = positions.shape[:2]
+    if vehicles == 0:
+        empty = np.zeros(0)
+        return ThreatAssessment(empty, empty, empty, np.zeros(0, dtype=bool))
+
+    offsets = positions - np.asarray(my_position, dtype=float)
+    distances = np.sqrt(np.einsum("vhk,vhk->vh", offsets, offsets))
+
+    # count the samples that set a new minimum distance
+    padded = np.concatenate([np.full((vehicles, 1), _FAR_AWAY), distances], axis=1)
+    previous_minimum = np.fmin.accumulate(padded, axis=1)[:, :-1]
+    new_minimums = np.count_nonzero(distances < previous_minimum, axis=1)
+
+    valid = ~np.isnan(distances)
+    samples = np.count_nonzero(valid, axis=1)
+    oldest_index = (history - np.maximum(samples, 1))[:, None]
+    oldest = np.take_along_axis(distances, oldest_index, axis=1)[:, 0]
+    newest = distances[:, -1]
+    if timestamps is None:
+        elapsed = np.maximum(samples - 1, 0) * sample_period
+    else:
+        timestamps = np.asarray(timestamps, dtype=float)
+        elapsed = np.nan_to_num(timestamps[:, -1] - np.take_along_axis(timestamps, oldest_index, axis=1)[:, 0])
+    closing_speed = np.zeros(vehicles)
+    np.divide(oldest - newest, elapsed, out=closing_speed, where=elapsed > 0)
+    closing_speed = np.nan_to_num(closing_speed)
+
+    time_to_collision = np.full(vehicles, np.inf)
+    np.divide(newest, closing_speed, out=time_to_collision, where=closing_speed > 0)
+
+    approaching = (np.asarray(speeds) > my_speed) & (new_minimums >= MIN_CLOSING_SAMPLES)
+    return ThreatAssessment(newest, closing_speed, time_to_collision, approaching)
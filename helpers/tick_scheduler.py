@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+# Fires BSM generation on simulation time instead of the agents' wall clock.
+# The scheduler listens to the FleetSnapshotService and, whenever the
+# simulated time crosses the next 1/rate boundary, hands each subscribed
+# agent its VehicleState from that tick's FleetSnapshot through a one-slot
+# queue. An agent that has not consumed the previous state gets it replaced
+# by the newer one.
+#
+# Fleet snapshots are built on the CARLA client thread (world.on_tick), so
+# the states are passed to the agents' event loop with call_soon_threadsafe.
+# Agents call task_done() on their queue once the BSM is sent; in synchronous
+# mode the launcher awaits wait_sent(frame) so the simulation does not advance
+# before every agent has sent the BSM of that frame.
+
+# rounding slack when comparing simulated times
+_EPSILON = 1e-6
+
+
+class TickScheduler:
+    def __init__(self, fleet, rate=10.0, loop=None):
+        self.fleet = fleet
+        self.period = 1.0 / rate
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.subscribers = {}
+        self.next_due = None
+        self.running = False
+        self.processed_frame = None
+        self.frame_processed = asyncio.Event()
+        self.fired = 0
+        self.replaced = 0
+
+    def start(self):
+        if not self.running:
+            self.fleet.add_listener(self._on_tick)
+            self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def subscribe(self, actor_id):
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers[actor_id] = queue
+        return queue
+
+    def unsubscribe(self, actor_id):
+        self.subscribers.pop(actor_id, None)
+
+    def _on_tick(self, snapshot):
+        if not self.running:
+            return
+        elapsed = snapshot.elapsed_seconds
+        if self.next_due is None:
+            self.next_due = elapsed
+        if elapsed + _EPSILON < self.next_due:
+            self.loop.call_soon_threadsafe(self._publish, snapshot.frame, {})
+            return
+        # slow ticks skip boundaries instead of firing several times in one frame
+        while self.next_due <= elapsed + _EPSILON:
+            self.next_due += self.period
+        states = {actor_id: snapshot.state(actor_id) for actor_id in list(self.subscribers)}
+        self.fired += 1
+        self.loop.call_soon_threadsafe(self._publish, snapshot.frame, states)
+
+    def _publish(self, frame, states):
+        for actor_id, state in states.items():
+            queue = self.subscribers.get(actor_id)
+            if queue is None:
+                continue
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                self.replaced += 1
+            queue.put_nowait(state)
+            if state is not None and not state.alive:
+                self.unsubscribe(actor_id)
+        self.processed_frame = frame
+        self.frame_processed.set()
+
+    async def wait_sent(self, frame, timeout=1.0):
+        try:
+            await asyncio.wait_for(self._wait_sent(frame), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"BSMs of frame {frame} not sent within {timeout} s")
+
+    async def _wait_sent(self, frame):
+        while self.processed_frame is None or self.processed_frame < frame:
+            self.frame_processed.clear()
+            await self.frame_processed.wait()
+        await asyncio.gather(*(queue.join() for queue in list(self.subscribers.values())))
+
+    def report(self):
+        print(f"tick scheduler: fired {self.fired} times at {1.0 / self.period:g} Hz, "
+              f"{self.replaced} states replaced before their agent sent them")
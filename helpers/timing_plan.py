@@ -0,0 +1,204 @@
+import json
+import math
+import os
+from collections import namedtuple
+
+from exceptions.scenario_exceptions import InvalidTimingPlan
+
+# Fixed-time signal plans (JSON) for the intersection controllers.
+# Every intersection runs the same cycle unless an entry of "intersections"
+# is near it; a phase turns the listed poles (TrafficLight.get_pole_index())
+# green, then yellow, then all lights of the intersection red for the
+# clearance time. Without "phases" every pole gets a phase of its own, in pole
+# order, like CARLA's default cycle. Times are seconds of simulation time and
+# the cycle starts at `offset`. With `launch_headway` the vehicles queued at a
+# light that turns green are told to launch one after the other, that many
+# seconds apart from the front of the queue (platoon launch):
+#
+# {
+#   "name": "fixed_time",
+#   "green_time": 10, "yellow_time": 3, "all_red_time": 2,
+#   "offset": 0,
+#   "launch_headway": 0.5,
+#   "phases": [[0, 2], [1, 3]],
+#   "intersections": [{"near": [110, 27], "offset": 6,
+#                      "phases": [{"poles": [0, 2], "green_time": 20}, [1, 3]]}]
+# }
+
+TIMING_PLAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "timing_plans")
+# an "intersections" entry applies to the intersection whose centre is within this many metres of "near"
+NEAR_DISTANCE = 30.0
+
+# phases is None (one phase per pole) or a tuple of Phase; intersections a tuple of IntersectionPlan
+TimingPlan = namedtuple("TimingPlan", ["name", "phases", "offset", "times", "launch_headway", "intersections"])
+IntersectionPlan = namedtuple("IntersectionPlan", ["near", "phases", "offset", "times", "launch_headway"])
+PhaseTimes = namedtuple("PhaseTimes", ["green_time", "yellow_time", "all_red_time"])
+# times left None in a parsed plan are taken from the plan or its intersection entry
+Phase = namedtuple("Phase", ["poles", "green_time", "yellow_time", "all_red_time"])
+# the resolved plan of one intersection, launch_headway is None without platoon launch
+Schedule = namedtuple("Schedule", ["phases", "offset", "cycle_time", "launch_headway"])
+
+_DEFAULT_TIMES = PhaseTimes(10.0, 3.0, 2.0)
+_TOP_LEVEL_KEYS = {"name", "phases", "offset", "launch_headway", "intersections"} | set(PhaseTimes._fields)
+_INTERSECTION_KEYS = {"near", "phases", "offset", "launch_headway"} | set(PhaseTimes._fields)
+
+
+def resolve_timing_plan_path(name):
+    # a path, or the name of a file in timing_plans/ with or without .json
+    if os.path.exists(name):
+        return name
+    candidate = os.path.join(TIMING_PLAN_DIR, name if name.endswith(".json") else f"{name}.json")
+    if os.path.exists(candidate):
+        return candidate
+    raise InvalidTimingPlan(f"Timing plan '{name}' not found")
+
+
+def load_timing_plan(name):
+    path = resolve_timing_plan_path(name)
+    with open(path) as f:
+        try:
+            document = json.load(f)
+        except ValueError as e:
+            raise InvalidTimingPlan(f"{path}: not valid JSON ({e})")
+    return parse_timing_plan(document, path)
+
+
+def parse_timing_plan(document, source="timing plan"):
+    _expect(isinstance(document, dict), source, "must be a JSON object")
+    unknown = set(document) - _TOP_LEVEL_KEYS
+    _expect(not unknown, source, f"unknown keys {sorted(unknown)}")
+    name = document.get("name", os.path.splitext(os.path.basename(source))[0])
+    _expect(isinstance(name, str), source, "name must be a string")
+    times = _times(document, _DEFAULT_TIMES, source)
+    offset = _offset(document, 0.0, source)
+    launch_headway = _launch_headway(document, None, source)
+    phases = _phases(document.get("phases"), source)
+
+    intersections = document.get("intersections", [])
+    _expect(isinstance(intersections, list), source, "intersections must be a list")
+    parsed = []
+    for index, intersection in enumerate(intersections):
+        where = f"{source}: intersections[{index}]"
+        _expect(isinstance(intersection, dict), where, "must be an object")
+        unknown = set(intersection) - _INTERSECTION_KEYS
+        _expect(not unknown, where, f"unknown keys {sorted(unknown)}")
+        near = intersection.get("near")
+        _expect(isinstance(near, list) and len(near) == 2 and all(_is_number(v) for v in near), where,
+                "near must be [x, y] numbers")
+        parsed.append(IntersectionPlan((float(near[0]), float(near[1])),
+                                       _phases(intersection.get("phases"), where) if "phases" in intersection
+                                       else phases,
+                                       _offset(intersection, offset, where), _times(intersection, times, where),
+                                       _launch_headway(intersection, launch_headway, where)))
+    return TimingPlan(name, phases, offset, times, launch_headway, tuple(parsed))
+
+
+def _expect(condition, where, message):
+    if not condition:
+        raise InvalidTimingPlan(f"{where}: {message}")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _times(document, defaults, where):
+    values = []
+    for key, default in zip(PhaseTimes._fields, defaults):
+        value = document.get(key, default)
+        _expect(_is_number(value) and value >= 0, where, f"{key} must be a non-negative number")
+        values.append(float(value))
+    times = PhaseTimes(*values)
+    _expect(times.green_time > 0, where, "green_time must be positive")
+    return times
+
+
+def _offset(document, default, where):
+    offset = document.get("offset", default)
+    _expect(_is_number(offset), where, "offset must be a number")
+    return float(offset)
+
+
+def _launch_headway(document, default, where):
+    headway = document.get("launch_headway", default)
+    _expect(headway is None or (_is_number(headway) and headway >= 0), where,
+            "launch_headway must be a non-negative number or null")
+    return None if headway is None else float(headway)
+
+
+def _phases(phases, where):
+    # a tuple of Phase, times left None are filled in by schedule_for()
+    if phases is None:
+        return None
+    _expect(isinstance(phases, list) and phases, where, "phases must be a non-empty list")
+    parsed = []
+    for index, phase in enumerate(phases):
+        phase_where = f"{where}.phases[{index}]"
+        if isinstance(phase, list):
+            phase = {"poles": phase}
+        _expect(isinstance(phase, dict) and set(phase) <= {"poles"} | set(PhaseTimes._fields), phase_where,
+                "must be a list of pole indices or an object with 'poles' and times")
+        poles = phase.get("poles")
+        _expect(isinstance(poles, list) and poles
+                and all(isinstance(p, int) and not isinstance(p, bool) and p >= 0 for p in poles), phase_where,
+                "poles must be a non-empty list of pole indices")
+        times = []
+        for key in PhaseTimes._fields:
+            value = phase.get(key)
+            _expect(value is None or (_is_number(value) and value >= 0), phase_where,
+                    f"{key} must be a non-negative number")
+            times.append(None if value is None else float(value))
+        _expect(times[0] != 0, phase_where, "green_time must be positive")
+        parsed.append(Phase(tuple(sorted(set(poles))), *times))
+    return tuple(parsed)
+
+
+def schedule_for(plan, center, poles):
+    # the Schedule of the intersection at center (x, y) whose lights have these pole indices
+    chosen = None
+    closest = NEAR_DISTANCE
+    for intersection in plan.intersections:
+        distance = math.hypot(intersection.near[0] - center[0], intersection.near[1] - center[1])
+        if distance <= closest:
+            chosen, closest = intersection, distance
+    source = plan if chosen is None else chosen
+    phases, offset, times = source.phases, source.offset, source.times
+    if phases is None:
+        phases = tuple(Phase((pole,), None, None, None) for pole in sorted(set(poles)))
+    resolved = tuple(Phase(phase.poles,
+                           *(default if value is None else value for value, default in zip(phase[1:], times)))
+                     for phase in phases)
+    cycle_time = sum(phase.green_time + phase.yellow_time + phase.all_red_time for phase in resolved)
+    return Schedule(resolved, offset, cycle_time, source.launch_headway)
+
+
+def signal_states(schedule, elapsed_seconds, poles):
+    # {pole: (state, seconds until it changes)} at elapsed_seconds of simulation time, state is
+    # "Green", "Yellow" or "Red"; the time is None for a pole that is in no phase and stays red
+    segments = [(duration, phase.poles, state) for phase in schedule.phases
+                for state, duration in (("Green", phase.green_time), ("Yellow", phase.yellow_time),
+                                        ("Red", phase.all_red_time)) if duration > 0]
+    t = (elapsed_seconds - schedule.offset) % schedule.cycle_time
+    current = 0
+    # the last segment also takes float rounding at the very end of the cycle
+    while current < len(segments) - 1 and t >= segments[current][0]:
+        t -= segments[current][0]
+        current += 1
+    left_in_segment = max(0.0, segments[current][0] - t)
+
+    def state_in(pole, segment):
+        return segment[2] if pole in segment[1] else "Red"
+
+    signals = {}
+    for pole in poles:
+        state = state_in(pole, segments[current])
+        time_to_change = left_in_segment
+        for step in range(1, len(segments) + 1):
+            segment = segments[(current + step) % len(segments)]
+            if state_in(pole, segment) != state:
+                break
+            time_to_change += segment[0]
+        else:
+            time_to_change = None
+        signals[pole] = (state, time_to_change)
+    return signals
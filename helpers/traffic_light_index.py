@@ -0,0 +1,91 @@
+import math
+from collections import namedtuple
+
+from helpers.disk_cache import load_cached, store_cached
+from helpers.spatial_index import SpatialGrid
+
+# Static index of the traffic lights of a map.
+# Finding the light closest to a point used to call get_location() on every
+# traffic light actor. The positions and intersection groups of all lights are
+# read once, cached on disk under the server version, map name and light ids
+# (actor ids change when the map is reloaded) and put in a SpatialGrid, so
+# nearest-k and radius queries only look at the cells around the point.
+
+# bump when TrafficLightRecord changes, invalidates cached indexes
+TRAFFIC_LIGHT_INDEX_FORMAT = 1
+# about the size of an intersection, a radius query of one intersection touches few cells
+CELL_SIZE = 50.0
+
+# group holds the ids of all lights of the same intersection (get_group_traffic_lights), sorted
+TrafficLightRecord = namedtuple("TrafficLightRecord", ["id", "x", "y", "z", "group"])
+
+
+def read_traffic_light_records(traffic_lights):
+    records = []
+    for light in traffic_lights:
+        location = light.get_location()
+        group = tuple(sorted(member.id for member in light.get_group_traffic_lights()))
+        records.append(TrafficLightRecord(light.id, location.x, location.y, location.z, group))
+    records.sort(key=lambda record: record.id)
+    return records
+
+
+class TrafficLightIndex:
+    def __init__(self, records, world=None):
+        self.records = {record.id: record for record in records}
+        self.world = world
+        self.grid = SpatialGrid(cell_size=CELL_SIZE)
+        self.grid.rebuild(self.records)
+        if records:
+            self.bounds = (min(r.x for r in records), min(r.y for r in records),
+                           max(r.x for r in records), max(r.y for r in records))
+        else:
+            self.bounds = None
+
+    @classmethod
+    def load(cls, client, world, use_cache=True):
+        traffic_lights = world.get_actors().filter('traffic.traffic_light')
+        name = world.get_map().name
+        key = (TRAFFIC_LIGHT_INDEX_FORMAT, client.get_server_version(), name,
+               tuple(sorted(light.id for light in traffic_lights)))
+        records = load_cached("traffic_lights", name, key) if use_cache else None
+        if records is None:
+            records = read_traffic_light_records(traffic_lights)
+            if use_cache:
+                store_cached("traffic_lights", name, key, records)
+        return cls(records, world)
+
+    def _by_distance(self, ids, location):
+        records = [self.records[light_id] for light_id in ids]
+        records.sort(key=lambda r: (r.x - location.x) ** 2 + (r.y - location.y) ** 2)
+        return records
+
+    def within_radius(self, location, radius):
+        # records of the lights within `radius` metres, closest first
+        return self._by_distance(self.grid.query_radius(location, radius), location)
+
+    def nearest(self, location, k=1):
+        # the k closest records, closest first; widens the search until k lights are found
+        if self.bounds is None:
+            return []
+        min_x, min_y, max_x, max_y = self.bounds
+        # no light is farther away than the farthest corner of the bounding box
+        farthest = math.hypot(max(abs(location.x - min_x), abs(location.x - max_x)),
+                              max(abs(location.y - min_y), abs(location.y - max_y)))
+        radius = CELL_SIZE
+        while True:
+            found = self.grid.query_radius(location, radius)
+            if len(found) >= k or radius >= farthest:
+                return self._by_distance(found, location)[:k]
+            radius *= 2
+
+    def groups(self, records=None):
+        # the intersection groups of `records` (default all lights), each as a tuple of light ids
+        if records is None:
+            records = self.records.values()
+        return sorted({record.group for record in records})
+
+    def actors(self, records):
+        # the live carla.TrafficLight actors of the records, in the same order
+        by_id = {light.id: light for light in self.world.get_actors([record.id for record in records])}
+        return [by_id[record.id] for record in records if record.id in by_id]
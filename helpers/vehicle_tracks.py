@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Position history of the vehicles heard over BSM.
+# Storage is preallocated: `max_vehicles` slots of `history` samples, each
+# sample holding timestamp, x, y, z and speed. Every slot is a ring buffer,
+# so an update writes one row in place and allocates nothing.
+# Writers (the SPADE thread) and readers (the pygame HUD) only share the lock
+# for the duration of a row write or an array copy; snapshot() hands out
+# copies that the reader can use without holding anything.
+
+TIMESTAMP, X, Y, Z, SPEED = range(5)
+_COLUMNS = 5
+
+# positions are (vehicles, history, 3) and timestamps (vehicles, history),
+# oldest sample first and NaN padded at the front; speeds are the latest ones
+TrackSnapshot = namedtuple("TrackSnapshot", ["names", "timestamps", "positions", "speeds", "samples"])
+
+
+class VehicleTracks:
+    def __init__(self, history=5, max_vehicles=256):
+        self.history = history
+        self.max_vehicles = max_vehicles
+        self.data = np.full((max_vehicles, history, _COLUMNS), np.nan)
+        self.heads = [0] * max_vehicles
+        self.counts = [0] * max_vehicles
+        self.last_update = [0.0] * max_vehicles
+        self.names = [None] * max_vehicles
+        self.slots = {}
+        self._free_slots = list(range(max_vehicles - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    def _claim_slot(self, name):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            # store is full, reuse the slot of the vehicle we heard from longest ago
+            slot = min(self.slots.values(), key=self.last_update.__getitem__)
+            del self.slots[self.names[slot]]
+            self._clear_slot(slot)
+        self.slots[name] = slot
+        self.names[slot] = name
+        return slot
+
+    def _clear_slot(self, slot):
+        self.data[slot] = np.nan
+        self.heads[slot] = 0
+        self.counts[slot] = 0
+        self.names[slot] = None
+
+    def update(self, name, x, y, z, speed, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            slot = self.slots.get(name)
+            if slot is None:
+                slot = self._claim_slot(name)
+            head = self.heads[slot]
+            self.data[slot, head] = (timestamp, x, y, z, speed)
+            self.heads[slot] = (head + 1) % self.history
+            if self.counts[slot] < self.history:
+                self.counts[slot] += 1
+            self.last_update[slot] = timestamp
+
+    def remove(self, name):
+        with self._lock:
+            slot = self.slots.pop(name, None)
+            if slot is not None:
+                self._clear_slot(slot)
+                self._free_slots.append(slot)
+
+    def snapshot(self):
+        with self._lock:
+            names = list(self.slots)
+            used = np.fromiter(self.slots.values(), dtype=np.intp, count=len(names))
+            data = self.data[used]
+            heads = np.array([self.heads[slot] for slot in used], dtype=np.intp)
+            samples = np.array([self.counts[slot] for slot in used], dtype=np.intp)
+        # rotate every ring so its oldest sample comes first
+        order = (heads[:, None] + np.arange(self.history)) % self.history
+        data = np.take_along_axis(data, order[:, :, None], axis=1)
+        return TrackSnapshot(names, data[:, :, TIMESTAMP], data[:, :, X:Z + 1], data[:, -1, SPEED], samples)
+
+    def __len__(self):
+        return len(self.slots)
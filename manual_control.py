@@ -72,9 +72,11 @@ import sys
 import threading
 
 import spade
-from helpers.register_user_ejabberd import register_user
+from helpers.register_user_ejabberd import provision_fleet
 
 from spade_classes.crash_prevention_spade import CarAgent
+from spade_classes.muc_broadcast import BSM_ROOM_JID
+from spade_classes.fleet_registry_spade import FLEET_REGISTRY_JID
 
 
 try:
@@ -159,7 +161,7 @@ except ImportError:
 # -- Global functions ----------------------------------------------------------
 # ==============================================================================
 
-async def create_spade_agent():
+async def create_spade_agent(bsm_room=None):
     global world
     while not world:
         print("waiting for world")
@@ -167,33 +169,20 @@ async def create_spade_agent():
     # create agent
     car_id = world.player.id
     car_obj = world.player
-    agent = CarAgent(f"car{car_id}@localhost", f"pass{car_id}", car_obj)
+    agent = CarAgent(f"car{car_id}@localhost", f"pass{car_id}", car_obj, bsm_room=bsm_room,
+                     fleet_registry_jid=FLEET_REGISTRY_JID)
     try:
         await agent.start(auto_register=False)
     except spade.agent.AuthenticationFailure:
-        register_user(f"car{car_id}", f"pass{car_id}")
+        await provision_fleet([car_id])
         await agent.start()
-    while True:
-        receiver_vehicles = get_receiver_vehicles()
-        if receiver_vehicles:
-            agent.receivers = receiver_vehicles
-            print("Loaded vehicles")
-        if not agent.is_alive():
-            break
-        await asyncio.sleep(2)
-
-
-def get_receiver_vehicles():
-    all_actors = world.world.get_actors()
-    vehicle_actors = all_actors.filter('vehicle.*')
-    receiver_vehicles = []
-    for vh in vehicle_actors:
-        if vh.id != world.player.id:
-            receiver_vehicles.append(f"car{vh.id}@localhost")
-    return receiver_vehicles
-
-def run_spade():
-    asyncio.run(create_spade_agent())
+    # receivers are pushed by the fleet registry of the simulation launcher
+    while agent.is_alive():
+        await asyncio.sleep(1)
+
+
+def run_spade(bsm_room=None):
+    asyncio.run(create_spade_agent(bsm_room))
 
 def find_weather_presets():
     rgx = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
@@ -1410,6 +1399,10 @@ def main():
         '--sync',
         action='store_true',
         help='Activate synchronous mode execution')
+    argparser.add_argument(
+        '--broadcast',
+        action='store_true',
+        help='Publish BSMs once to a shared MUC room instead of sending to every receiver')
     args = argparser.parse_args()
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
@@ -1422,7 +1415,7 @@ def main():
     print(__doc__)
 
     try:
-        spade_thread = threading.Thread(target=run_spade)
+        spade_thread = threading.Thread(target=run_spade, args=(BSM_ROOM_JID if args.broadcast else None,))
         spade_thread.start()
         game_loop(args)
 
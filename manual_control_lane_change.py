@@ -72,9 +72,13 @@ import sys
 import threading
 
 import spade
-from helpers.register_user_ejabberd import register_user
+from helpers.register_user_ejabberd import provision_fleet
 
 from spade_classes.lane_change_simulation_spade import CarAgent
+from spade_classes.muc_broadcast import BSM_ROOM_JID
+from spade_classes.fleet_registry_spade import FLEET_REGISTRY_JID
+from helpers.threat_assessment import assess_threats
+from helpers.vehicle_tracks import VehicleTracks
 
 
 try:
@@ -159,29 +163,20 @@ except ImportError:
 # -- Global functions ----------------------------------------------------------
 # ==============================================================================
 
-dict_positions = {}
-dict_vehicle_speed_list = {}
-
-def getting_closer(positions, my_position):
-    distance = 10000
-    count = 0
-    for pos in positions:
-        dist_to_compare = pos.distance(my_position)
-        if dist_to_compare < distance:
-            distance = dist_to_compare
-            count += 1
-    if count >= 4:
-        return True
-    else:
-        return False
+# filled by the spade thread, read by the HUD through snapshot()
+tracked_vehicles = VehicleTracks(history=5)
 
 def get_vehicle_approaching_status(my_speed, my_position):
-    global dict_vehicle_speed_list
-    for key in dict_vehicle_speed_list:
-        if dict_vehicle_speed_list[key] > my_speed and getting_closer(dict_positions[key], my_position):
-            return "WARNING - CAR IS GETTING CLOSE"
+    if not len(tracked_vehicles):
+        return "No threat"
+    tracks = tracked_vehicles.snapshot()
+    assessment = assess_threats(tracks.positions, tracks.speeds, my_position, my_speed, timestamps=tracks.timestamps)
+    if assessment.approaching.any():
+        time_to_collision = assessment.time_to_collision[assessment.approaching].min()
+        return f"WARNING - CAR IS GETTING CLOSE (TTC {time_to_collision:.1f} s)"
     return "No threat"
-async def create_spade_agent():
+
+async def create_spade_agent(bsm_room=None):
     global world
     while not world:
         print("waiting for world")
@@ -189,38 +184,20 @@ async def create_spade_agent():
     # create agent
     car_id = world.player.id
     car_obj = world.player
-    agent = CarAgent(f"car{car_id}@localhost", f"pass{car_id}", car_obj)
+    agent = CarAgent(f"car{car_id}@localhost", f"pass{car_id}", car_obj, bsm_room=bsm_room,
+                     fleet_registry_jid=FLEET_REGISTRY_JID, tracks=tracked_vehicles)
     try:
         await agent.start(auto_register=False)
     except spade.agent.AuthenticationFailure:
-        register_user(f"car{car_id}", f"pass{car_id}")
+        await provision_fleet([car_id])
         await agent.start()
-    while True:
-        receiver_vehicles = get_receiver_vehicles()
-        if receiver_vehicles:
-            agent.receivers = receiver_vehicles
-            print("Loaded vehicles")
-        if not agent.is_alive():
-            break
-        global dict_positions
-        global dict_vehicle_speed_list
-        global my_speed
-        dict_positions = agent.dict_positions
-        dict_vehicle_speed_list = agent.dict_vehicle_speed_list
+    # receivers are pushed by the fleet registry of the simulation launcher
+    while agent.is_alive():
         await asyncio.sleep(1)
 
 
-def get_receiver_vehicles():
-    all_actors = world.world.get_actors()
-    vehicle_actors = all_actors.filter('vehicle.*')
-    receiver_vehicles = []
-    for vh in vehicle_actors:
-        if vh.id != world.player.id:
-            receiver_vehicles.append(f"car{vh.id}@localhost")
-    return receiver_vehicles
-
-def run_spade():
-    asyncio.run(create_spade_agent())
+def run_spade(bsm_room=None):
+    asyncio.run(create_spade_agent(bsm_room))
 
 def find_weather_presets():
     rgx = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
@@ -797,7 +774,7 @@ class HUD(object):
             'Location:% 20s' % ('(% 5.1f, % 5.1f, % 5.1f)' % (t.location.x, t.location.y, t.rotation.yaw)),
             'GNSS:% 24s' % ('(% 2.6f, % 3.6f)' % (world.gnss_sensor.lat, world.gnss_sensor.lon)),
             'Height:  % 18.0f m' % t.location.z,
-            f'Vehicle approaching: {get_vehicle_approaching_status(my_speed, carla.Location(x=t.location.x, y=t.location.y, z=t.location.z))}',
+            f'Vehicle approaching: {get_vehicle_approaching_status(my_speed, (t.location.x, t.location.y, t.location.z))}',
             '']
         if isinstance(c, carla.VehicleControl):
             self._info_text += [
@@ -1437,6 +1414,10 @@ def main():
         '--sync',
         action='store_true',
         help='Activate synchronous mode execution')
+    argparser.add_argument(
+        '--broadcast',
+        action='store_true',
+        help='Publish BSMs once to a shared MUC room instead of sending to every receiver')
     args = argparser.parse_args()
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
@@ -1449,7 +1430,7 @@ def main():
     print(__doc__)
 
     try:
-        spade_thread = threading.Thread(target=run_spade)
+        spade_thread = threading.Thread(target=run_spade, args=(BSM_ROOM_JID if args.broadcast else None,))
         spade_thread.start()
         game_loop(args)
 
@@ -2,35 +2,45 @@
 import asyncio
 import select
 import sys
-import carla
+from helpers.carla_backend import carla
 
 import argparse
 import logging
 
-import spade
-from helpers.register_user_ejabberd import register_user
+from helpers.agent_lifecycle import start_agents, stop_agents
+from helpers.timing_plan import load_timing_plan
+from helpers.traffic_light_index import TrafficLightIndex
 
-from spade_classes.semaphore_simulation_spade import SemaphoreAgent
+from spade_classes.semaphore_simulation_spade import SemaphoreAgent, create_intersection_agents
+from spade_classes.fleet_registry_spade import FLEET_REGISTRY_JID
 from aioconsole import ainput
 
-def find_closes_semaphore(carla_location, traffic_lights):
-    closest_light = None
-    closest_distance = float('inf')
-    for light in traffic_lights:
-        light_location = light.get_location()
-        distance = light_location.distance(carla_location)
-        if distance < closest_distance:
-            closest_distance = distance
-            closest_light = light
-    return closest_light
+def find_closes_semaphore(carla_location, light_index):
+    closest = light_index.nearest(carla_location)
+    if not closest:
+        return None
+    return light_index.actors(closest)[0]
 
-def get_receiver_vehicles(world):
-    all_actors = world.get_actors()
-    vehicle_actors = all_actors.filter('vehicle.*')
-    receiver_vehicles = []
-    for vh in vehicle_actors:
-        receiver_vehicles.append(f"car{vh.id}@localhost")
-    return receiver_vehicles
+async def start_semaphore_controllers(traffic_lights):
+    # one SemaphoreAgent per traffic light, logged in concurrently
+    # the vehicles to inform are pushed by the fleet registry of semaphore_simulation.py
+    agents = [SemaphoreAgent(f"semaphore{light.id}@localhost", f"pass{light.id}", light,
+                             fleet_registry_jid=FLEET_REGISTRY_JID) for light in traffic_lights]
+    return await start_agents(agents)
+
+async def start_region_controllers(carla_location, radius, light_index):
+    # controllers for every traffic light within radius metres of carla_location
+    return await start_semaphore_controllers(light_index.actors(light_index.within_radius(carla_location, radius)))
+
+async def run_timing_plan(world, light_index, plan, carla_location, radius=None):
+    records = None if radius is None else light_index.within_radius(carla_location, radius)
+    agents = await start_agents(create_intersection_agents(world, light_index, plan, records,
+                                                           fleet_registry_jid=FLEET_REGISTRY_JID))
+    print(f"{len(agents)} intersection controllers running timing plan {plan.name}")
+    while await ainput("Enter 'x' for exit: ") != "x":
+        pass
+    await stop_agents(agents)
+    print(f"sent {sum(agent.spat_sent for agent in agents)} SPaT messages")
 
 async def main():
     argparser = argparse.ArgumentParser(
@@ -46,6 +56,29 @@ async def main():
         default=2000,
         type=int,
         help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '-x',
+        metavar='X',
+        default=110.0,
+        type=float,
+        help='x of the point the controlled light is closest to (default: 110)')
+    argparser.add_argument(
+        '-y',
+        metavar='Y',
+        default=27.0,
+        type=float,
+        help='y of the point the controlled light is closest to (default: 27)')
+    argparser.add_argument(
+        '--radius',
+        metavar='M',
+        default=None,
+        type=float,
+        help='Also start a controller for every traffic light within this many metres of the point (default: only the closest light)')
+    argparser.add_argument(
+        '--plan',
+        metavar='FILE',
+        default=None,
+        help='Switch the lights from this timing plan (file or name in timing_plans/) with one controller per intersection, of the map or within --radius (default: keyboard control)')
     args = argparser.parse_args()
 
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -54,19 +87,22 @@ async def main():
 
     world = client.get_world()
 
-    traffic_lights = world.get_actors().filter('traffic.traffic_light')
-    target_location = carla.Location(x=110, y=27, z=0)
-    target_semaphore = find_closes_semaphore(target_location, traffic_lights)
+    light_index = TrafficLightIndex.load(client, world)
+    target_location = carla.Location(x=args.x, y=args.y, z=0)
+    if args.plan is not None:
+        await run_timing_plan(world, light_index, load_timing_plan(args.plan), target_location, args.radius)
+        return
+    target_semaphore = find_closes_semaphore(target_location, light_index)
     if not target_semaphore:
         return
+    if args.radius is None:
+        agents = await start_semaphore_controllers([target_semaphore])
     else:
-        agent = SemaphoreAgent(f"semaphore{target_semaphore.id}@localhost", f"pass{target_semaphore.id}", target_semaphore)
-        try:
-            await agent.start(auto_register=False)
-        except spade.agent.AuthenticationFailure:
-                register_user(f"semaphore{target_semaphore.id}@localhost", f"pass{target_semaphore.id}")
-                await agent.start()
-        agent.receivers = get_receiver_vehicles(world)
+        # the keyboard switches the closest light, the others in the region only report their state
+        radius = max(args.radius, target_semaphore.get_location().distance(target_location))
+        agents = await start_region_controllers(target_location, radius, light_index)
+    print(f"controlling {len(agents)} traffic lights, switching light {target_semaphore.id}")
+    target_agents = [agent for agent in agents if agent.semaphore.id == target_semaphore.id]
     while True:
         command_from_user = await ainput("Enter 'g' for green light, 'r' for red light and 'x' for exit: ")
         if command_from_user == "g":
@@ -75,7 +111,11 @@ async def main():
             target_semaphore.set_state(carla.TrafficLightState.Red)
         else:
             break
-    await agent.stop()
+        # send the new state now instead of at the agent's next read of the light
+        for agent in target_agents:
+            agent.light_switched()
+    await stop_agents(agents)
+    print(f"sent {sum(agent.spat_sent for agent in agents)} SPaT messages")
 
 if __name__ == '__main__':
     # first run semaphore_simulation.py
@@ -0,0 +1,14 @@
+import sys
+
+from simulation_runner.plugins import PLUGINS
+from simulation_runner.runner import run_simulation
+
+# python -m simulation_runner <simulation> [options], e.g.
+# python -m simulation_runner crash_prevention --scenario dense_traffic --transport bus
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in PLUGINS:
+        print(f"usage: python -m simulation_runner {{{','.join(PLUGINS)}}} [options]")
+        sys.exit(2)
+    plugin = PLUGINS[sys.argv[1]]()
+    run_simulation(plugin, argv=sys.argv[2:])
@@ -0,0 +1,139 @@
+from helpers.agent_lifecycle import start_agents
+from helpers.fleet_registry import receivers_updater
+from helpers.intersection_metrics import IntersectionMetrics, METRICS_INTERVAL
+from helpers.timing_plan import load_timing_plan
+from helpers.traffic_light_index import TrafficLightIndex
+from spade_classes.fleet_registry_spade import FLEET_REGISTRY_JID
+from spade_classes.muc_broadcast import BSM_ROOM_JID
+from spade_classes import crash_prevention_spade, lane_change_simulation_spade, semaphore_simulation_spade
+
+# The parts of a simulation SimulationRunner does not know about: its default
+# scenario, the agent class and how the agents learn their receivers.
+
+
+class SimulationPlugin:
+    name = None
+    default_scenario = None
+    # adds --bsm-rate/--comm-radius, the tick scheduler and the fleet index
+    sends_bsms = True
+
+    def add_arguments(self, argparser):
+        pass
+
+    def create_agent(self, runner, actor_id, car):
+        raise NotImplementedError
+
+    def join_fleet(self, runner, fleet_registry):
+        # called before the agents join the registry
+        pass
+
+    def agents_started(self, runner):
+        # every agent sends to every other vehicle of this script
+        for agent in runner.agents:
+            agent.receivers = [f"{a.name}@localhost" for a in runner.agents if a != agent]
+
+    async def start_services(self, runner):
+        # agents that are not vehicles, started once the world is prepared; returns the started agents
+        return []
+
+    def services_stopped(self, runner):
+        # called at the end of teardown, once every agent stopped and the world stopped ticking
+        pass
+
+
+class CrashPreventionPlugin(SimulationPlugin):
+    name = "crash_prevention"
+    default_scenario = "crash_prevention"
+
+    def create_agent(self, runner, actor_id, car):
+        args = runner.args
+        return crash_prevention_spade.CarAgent(f"car{actor_id}@localhost", f"pass{actor_id}", car,
+                                               bsm_room=BSM_ROOM_JID if args.broadcast else None,
+                                               comm_radius=args.comm_radius, bus=runner.message_bus)
+
+
+class LaneChangePlugin(SimulationPlugin):
+    name = "lane_change"
+    default_scenario = "lane_change"
+
+    def create_agent(self, runner, actor_id, car):
+        args = runner.args
+        return lane_change_simulation_spade.CarAgent(f"car{actor_id}@localhost", f"pass{actor_id}", car,
+                                                     bsm_room=BSM_ROOM_JID if args.broadcast else None,
+                                                     comm_radius=args.comm_radius, bus=runner.message_bus)
+
+    def join_fleet(self, runner, fleet_registry):
+        # receivers follow the registry, so manually driven cars joining later are included
+        for agent in runner.agents:
+            fleet_registry.subscribe(receivers_updater(agent))
+
+    def agents_started(self, runner):
+        pass
+
+
+class SemaphorePlugin(SimulationPlugin):
+    name = "semaphore"
+    default_scenario = "semaphore"
+    # the cars only react to the semaphore controller's messages
+    sends_bsms = False
+
+    def __init__(self):
+        # IntersectionMetrics when started with --metrics
+        self.metrics = None
+
+    def add_arguments(self, argparser):
+        argparser.add_argument(
+            '--plan',
+            metavar='FILE',
+            default=None,
+            help='Run an intersection controller per traffic light group in this process, switching the lights '
+                 'from this timing plan file or name in timing_plans/ (default: none, use semaphore_control.py)')
+        argparser.add_argument(
+            '--metrics',
+            metavar='FILE',
+            default=None,
+            help='Measure stop line crossings, queues and delay per intersection approach and write them to this '
+                 'CSV file at exit (default: off)')
+        argparser.add_argument(
+            '--metrics-interval',
+            metavar='S',
+            default=METRICS_INTERVAL,
+            type=float,
+            help=f'Simulation seconds summed into one row of the --metrics file (default: {METRICS_INTERVAL:g})')
+
+    def create_agent(self, runner, actor_id, car):
+        return semaphore_simulation_spade.CarAgent(f"car{actor_id}@localhost", f"pass{actor_id}", car,
+                                                   bsm_room=BSM_ROOM_JID if runner.args.broadcast else None,
+                                                   bus=runner.message_bus)
+
+    async def start_services(self, runner):
+        if runner.args.plan is None and runner.args.metrics is None:
+            return []
+        light_index = TrafficLightIndex.load(runner.client, runner.world)
+        if runner.args.metrics is not None:
+            self.metrics = IntersectionMetrics.load(light_index, interval=runner.args.metrics_interval)
+            runner.fleet_snapshot.add_listener(self.metrics.on_snapshot)
+            print(f"measuring {len(self.metrics.approaches)} intersection approaches")
+        if runner.args.plan is None:
+            return []
+        plan = load_timing_plan(runner.args.plan)
+        # the controllers stay in this process; with --workers runner.message_bus is the coordinator's
+        # ShardBus, which forwards their SPaT to the worker hosting each car
+        controllers = semaphore_simulation_spade.create_intersection_agents(
+            runner.world, light_index, plan, fleet_registry_jid=FLEET_REGISTRY_JID, bus=runner.message_bus)
+        for controller in controllers:
+            controller.fleet_snapshot = runner.fleet_snapshot
+            controller.clock = runner.sim_clock
+        started = await start_agents(controllers, runner.args.startup_concurrency)
+        print(f"{len(started)} intersection controllers running timing plan {plan.name}")
+        return started
+
+    def services_stopped(self, runner):
+        if self.metrics is None:
+            return
+        self.metrics.write_csv(runner.args.metrics)
+        self.metrics.report()
+        print(f"intersection metrics written to {runner.args.metrics}")
+
+
+PLUGINS = {plugin.name: plugin for plugin in (CrashPreventionPlugin, LaneChangePlugin, SemaphorePlugin)}
@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import logging
+
+from numpy import random
+
+from helpers.agent_lifecycle import PhaseTimer, start_agents, stop_agents
+from helpers.blueprint_cache import BlueprintCatalogue
+from helpers.carla_backend import carla
+from helpers.control_queue import ControlQueue
+from helpers.fleet_snapshot import FleetSnapshotService
+from helpers.latency import BsmLatency, SimulationClock
+from helpers.register_user_ejabberd import provision_fleet
+from helpers.scenario import (default_scenario_name, load_scenario, load_scenario_map, choose_blueprints,
+                              spawn_transforms, apply_traffic_lights, apply_traffic_manager, spectator_transform)
+from helpers.spatial_index import SpatialGrid
+from helpers.tick_scheduler import TickScheduler
+from simulation_runner.sharding import ShardPool, create_coordinator_bus
+from spade_classes.fleet_registry_spade import FleetRegistryAgent, FLEET_REGISTRY_JID
+from spade_classes.message_bus import MessageBus, TRANSPORTS, TRANSPORT_BUS, TRANSPORT_XMPP
+
+# Lifecycle shared by all simulation scripts:
+# connect -> configure -> spawn -> start agents -> prepare world -> tick -> teardown.
+# What differs between the simulations (agent class, extra options, how
+# agents learn their receivers) lives in a SimulationPlugin
+# (simulation_runner/plugins.py); everything else, and every optimisation to
+# spawning, ticking and teardown, is written once here.
+
+AGENT_STOP_TIMEOUT = 10.0
+# flush interval of the control queue when this script does not tick the world
+CONTROL_FLUSH_PERIOD = 0.05
+SEED = 33
+
+
+def build_argparser(plugin, description=None):
+    argparser = argparse.ArgumentParser(
+        description=description)
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP of the host server (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '--tm-port',
+        metavar='P',
+        default=8000,
+        type=int,
+        help='Port to communicate with TM (default: 8000)')
+    argparser.add_argument(
+        '--asynch',
+        action='store_true',
+        help='Activate asynchronous mode execution')
+    argparser.add_argument(
+        '--hybrid',
+        action='store_true',
+        help='Activate hybrid mode for Traffic Manager')
+    argparser.add_argument(
+        '--respawn',
+        action='store_true',
+        default=False,
+        help='Automatically respawn dormant vehicles (only in large maps)')
+    default_scenario = default_scenario_name(plugin.default_scenario)
+    argparser.add_argument(
+        '--scenario',
+        metavar='FILE',
+        default=default_scenario,
+        help=f'Scenario file, or the name of one in scenarios/ (default: {default_scenario})')
+    argparser.add_argument(
+        '--broadcast',
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help='Publish BSMs once to a shared MUC room instead of sending to every receiver, --no-broadcast sends '
+             'to every receiver (default: from the scenario)')
+    argparser.add_argument(
+        '--startup-concurrency',
+        metavar='N',
+        default=16,
+        type=int,
+        help='Number of agents logging in to the XMPP server at the same time (default: 16)')
+    argparser.add_argument(
+        '--provision',
+        action='store_true',
+        help='Register all agent accounts on ejabberd in bulk before the agents log in')
+    argparser.add_argument(
+        '--transport',
+        metavar='T',
+        default=TRANSPORT_XMPP,
+        choices=TRANSPORTS,
+        help='Agent message transport, "xmpp" or the in-process "bus" (default: xmpp)')
+    argparser.add_argument(
+        '--workers',
+        metavar='N',
+        default=1,
+        type=int,
+        help='Run the vehicle agents in N worker processes, 1 keeps them in this process (default: 1)')
+    if plugin.sends_bsms:
+        argparser.add_argument(
+            '--bsm-rate',
+            metavar='HZ',
+            default=None,
+            type=float,
+            help='Send BSMs on simulation ticks at this simulated rate, e.g. 10 (default: from the scenario, else every 0.5 s of wall clock)')
+        argparser.add_argument(
+            '--comm-radius',
+            metavar='M',
+            default=None,
+            type=float,
+            help='Only send BSMs to vehicles within this many metres (default: from the scenario, else unlimited)')
+    plugin.add_arguments(argparser)
+    return argparser
+
+
+def refresh_fleet_index(fleet_index, fleet):
+    positions = {}
+    for actor_id in fleet.actor_ids:
+        state = fleet.state(actor_id)
+        if state.alive:
+            positions[f"car{actor_id}@localhost"] = state
+    fleet_index.rebuild(positions)
+
+
+class SimulationRunner:
+    def __init__(self, plugin, args):
+        self.plugin = plugin
+        self.args = args
+        self.scenario = load_scenario(args.scenario)
+        # V2V options not given on the command line come from the scenario
+        if args.broadcast is None:
+            args.broadcast = self.scenario.v2v.broadcast
+        if plugin.sends_bsms:
+            if args.bsm_rate is None:
+                args.bsm_rate = self.scenario.v2v.bsm_rate
+            if args.comm_radius is None:
+                args.comm_radius = self.scenario.v2v.comm_radius
+        self.client = None
+        self.world = None
+        self.traffic_manager = None
+        self.synchronous_master = False
+        self.agents = []
+        # agents that are not vehicles, like the fleet registry
+        self.service_agents = []
+        self.vehicles_list = []
+        # actor id -> TrafficManagerSettings from the scenario
+        self.vehicle_settings = {}
+        self.world_clean = False
+        self.camera = None
+        # in-process MessageBus when started with --transport bus, with --workers the coordinator's shard of a ShardBus
+        self.message_bus = None
+        if args.transport == TRANSPORT_BUS:
+            self.message_bus = create_coordinator_bus(args.workers) if args.workers > 1 else MessageBus()
+        # BSMs are stamped with the frame from sim_clock, receivers record their age in bsm_latency
+        self.sim_clock = SimulationClock()
+        self.bsm_latency = BsmLatency(self.sim_clock)
+        # agents' autopilot and control changes, sent as one batch per tick
+        self.control_queue = None
+        # vehicle states read once per tick, for the agents and the fleet index
+        self.fleet_snapshot = None
+        # sends BSMs on simulation ticks when started with --bsm-rate
+        self.tick_scheduler = None
+        self.fleet_index = None
+        # worker processes hosting the vehicle agents when started with --workers N
+        self.shards = None
+        self.startup_timer = PhaseTimer()
+
+    async def run(self):
+        try:
+            self.connect()
+            self.configure()
+            batch, spawns = self.spawn_batch()
+            await self.spawn(batch, spawns)
+            await self.start_agents()
+            self.prepare_world()
+            self.service_agents.extend(await self.plugin.start_services(self))
+            await self.tick_loop()
+        finally:
+            await self.teardown()
+
+    def connect(self):
+        self.client = carla.Client(self.args.host, self.args.port)
+        self.client.set_timeout(10.0)
+        random.seed(SEED)
+        self.world = load_scenario_map(self.client, self.scenario)
+        traffic_manager = self.client.get_trafficmanager(self.args.tm_port)
+        traffic_manager.set_random_device_seed(SEED)
+        if self.args.respawn:
+            traffic_manager.set_respawn_dormant_vehicles(True)
+        if self.args.hybrid:
+            traffic_manager.set_hybrid_physics_mode(True)
+            traffic_manager.set_hybrid_physics_radius(70.0)
+        self.traffic_manager = traffic_manager
+
+    def configure(self):
+        settings = self.world.get_settings()
+        if not self.args.asynch:
+            self.traffic_manager.set_synchronous_mode(True)
+            if not settings.synchronous_mode:
+                self.synchronous_master = True
+                settings.synchronous_mode = True
+                settings.fixed_delta_seconds = self.scenario.fixed_delta_seconds
+            else:
+                self.synchronous_master = False
+        else:
+            print("You are currently in asynchronous mode. If this is a traffic simulation, \
+            you could experience some issues. If it's not working correctly, switch to synchronous \
+            mode by using traffic_manager.set_synchronous_mode(True)")
+
+        self.world.apply_settings(settings)
+        self.control_queue = ControlQueue(self.client, self.traffic_manager.get_port(),
+                                          period=None if self.synchronous_master else CONTROL_FLUSH_PERIOD,
+                                          loop=asyncio.get_running_loop())
+
+    def spawn_batch(self):
+        with self.startup_timer.phase("blueprint catalogue"):
+            catalogue = BlueprintCatalogue.load(self.client, self.world)
+            records = catalogue.select(self.scenario.blueprints)
+
+        # @todo cannot import these directly.
+        SpawnActor = carla.command.SpawnActor
+        SetAutopilot = carla.command.SetAutopilot
+        FutureActor = carla.command.FutureActor
+
+        spawns = spawn_transforms(self.scenario, self.world)
+        batch = []
+        chosen = choose_blueprints(records, self.scenario.blueprints, len(spawns))
+        for (transform, tm), record in zip(spawns, chosen):
+            blueprint = catalogue.blueprint(record)
+            if 'color' in record.recommended:
+                color = random.choice(record.recommended['color'])
+                blueprint.set_attribute('color', color)
+            if 'driver_id' in record.recommended:
+                driver_id = random.choice(record.recommended['driver_id'])
+                blueprint.set_attribute('driver_id', driver_id)
+            blueprint.set_attribute('role_name', 'autopilot')
+
+            # spawn the cars and set their autopilot
+            batch.append(SpawnActor(blueprint, transform).then(
+                SetAutopilot(FutureActor, True, self.traffic_manager.get_port())))
+        return batch, spawns
+
+    async def spawn(self, batch, spawns):
+        with self.startup_timer.phase("spawn vehicles"):
+            responses = self.client.apply_batch_sync(batch, self.synchronous_master)
+        for response, (_, tm) in zip(responses, spawns):
+            if response.error:
+                logging.error(response.error)
+            else:
+                self.vehicles_list.append(response.actor_id)
+                self.vehicle_settings[response.actor_id] = tm
+
+    async def start_agents(self):
+        args = self.args
+        timer = self.startup_timer
+        with timer.phase("create agents"):
+            self.fleet_snapshot = FleetSnapshotService(self.world, self.vehicles_list)
+            self.fleet_snapshot.start()
+            # agents sleep on the snapshot's simulated time; the listener runs on the CARLA client thread
+            loop = asyncio.get_running_loop()
+            self.sim_clock.advance(self.fleet_snapshot.latest.elapsed_seconds)
+            self.fleet_snapshot.add_listener(
+                lambda snapshot: loop.call_soon_threadsafe(self.sim_clock.advance, snapshot.elapsed_seconds))
+            # with --workers the agents are created in the worker processes
+            new_agents = self.create_agents() if args.workers <= 1 else []
+        if args.provision and self.message_bus is None:
+            with timer.phase("provision accounts"):
+                await provision_fleet(self.vehicles_list)
+        # vehicles in other processes (manual control) and the semaphore controller
+        # learn who is on the road from this registry instead of polling the server
+        fleet_registry_agent = FleetRegistryAgent(FLEET_REGISTRY_JID, "passfleet", bus=self.message_bus)
+        with timer.phase("start fleet registry"):
+            self.service_agents.extend(await start_agents([fleet_registry_agent]))
+        if args.workers > 1:
+            with timer.phase("start workers"):
+                await self.start_shards()
+        else:
+            with timer.phase("start agents"):
+                self.agents.extend(await start_agents(new_agents, args.startup_concurrency))
+        with timer.phase("join fleet"):
+            fleet_registry = fleet_registry_agent.registry
+            for agent in self.agents:
+                agent.fleet_registry = fleet_registry
+            self.plugin.join_fleet(self, fleet_registry)
+            if self.shards is not None:
+                fleet_registry.join(*[f"car{actor_id}@localhost" for actor_id in self.vehicles_list])
+            else:
+                fleet_registry.join(*[str(agent.jid) for agent in self.agents])
+        timer.report("startup")
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.start()
+        self.plugin.agents_started(self)
+
+        print('spawned %d vehicles, press Ctrl+C to exit.' % (len(self.vehicles_list)))
+
+    def create_agents(self):
+        if self.plugin.sends_bsms and self.args.bsm_rate:
+            self.tick_scheduler = TickScheduler(self.fleet_snapshot, self.args.bsm_rate)
+        cars = {car.id: car for car in self.world.get_actors(self.vehicles_list)}
+        new_agents = []
+        for actor_id in self.vehicles_list:
+            car = cars.get(actor_id)
+            if car is None:
+                continue
+            agent = self.plugin.create_agent(self, actor_id, car)
+            agent.clock = self.sim_clock
+            agent.latency = self.bsm_latency
+            agent.control_queue = self.control_queue
+            agent.fleet_snapshot = self.fleet_snapshot
+            if self.tick_scheduler is not None:
+                agent.bsm_ticks = self.tick_scheduler.subscribe(actor_id)
+            new_agents.append(agent)
+        return new_agents
+
+    async def start_shards(self):
+        # lockstep like the tick scheduler: the next tick waits for every worker's BSMs
+        lockstep = not self.args.asynch and self.synchronous_master and self.plugin.sends_bsms \
+            and bool(self.args.bsm_rate)
+        self.shards = ShardPool(self, self.args.workers)
+        await self.shards.start(self.vehicles_list, self.fleet_snapshot.latest, lockstep)
+        loop = asyncio.get_running_loop()
+        # the snapshot listener runs on the CARLA client thread
+        self.fleet_snapshot.add_listener(
+            lambda snapshot: loop.call_soon_threadsafe(self.shards.publish_snapshot, snapshot))
+
+    def prepare_world(self):
+        if self.plugin.sends_bsms and self.args.comm_radius:
+            self.fleet_index = SpatialGrid(cell_size=self.args.comm_radius)
+            refresh_fleet_index(self.fleet_index, self.fleet_snapshot.latest)
+            for agent in self.agents:
+                agent.neighbour_index = self.fleet_index
+
+        apply_traffic_lights(self.world, self.scenario)
+        apply_traffic_manager(self.traffic_manager, self.world, self.scenario, self.vehicle_settings)
+
+        # blueprint_library = world.get_blueprint_library()
+        # camera_bp = blueprint_library.find('sensor.camera.rgb')
+        # camera_bp.set_attribute('image_size_x', '1920')
+        # camera_bp.set_attribute('image_size_y', '1080')
+        camera_transform = spectator_transform(self.scenario)
+        # camera = world.spawn_actor(camera_bp, camera_transform)
+        # def process_image(image):
+        #     image.save_to_disk('camera-photos/%06d.png' % image.frame)
+
+        # camera.listen(lambda image: process_image(image))
+
+        if camera_transform is not None:
+            spectator = self.world.get_spectator()
+            spectator.set_transform(camera_transform)
+
+    async def tick_loop(self):
+        world = self.world
+        while True:
+            if not self.args.asynch and self.synchronous_master:
+                self.control_queue.flush()
+                frame = world.tick()
+                self.sim_clock.update(frame)
+                if self.tick_scheduler is not None:
+                    # do not advance the simulation before every agent sent the BSM of this frame
+                    await self.tick_scheduler.wait_sent(frame)
+                elif self.shards is not None and self.shards.lockstep:
+                    await self.shards.wait_frame(frame)
+                # let the agents run between ticks
+                await asyncio.sleep(0)
+                if self.fleet_index is not None:
+                    refresh_fleet_index(self.fleet_index, self.fleet_snapshot.latest)
+            else:
+                snapshot = world.wait_for_tick()
+                self.sim_clock.update(snapshot.frame)
+                if self.fleet_index is not None:
+                    refresh_fleet_index(self.fleet_index, self.fleet_snapshot.latest)
+                await asyncio.sleep(2)
+
+    async def teardown(self):
+        if self.world_clean or self.client is None:
+            return
+        teardown_timer = PhaseTimer()
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.stop()
+        if self.fleet_snapshot is not None:
+            self.fleet_snapshot.stop()
+        # Stop all agents
+        with teardown_timer.phase("stop agents"):
+            agents_stopped = await stop_agents(self.agents + self.service_agents, timeout=AGENT_STOP_TIMEOUT)
+            if self.shards is not None:
+                agents_stopped += await self.shards.stop()
+        with teardown_timer.phase("restore settings"):
+            world = self.client.get_world()
+            settings = world.get_settings()
+            settings.synchronous_mode = False
+            settings.fixed_delta_seconds = None
+            world.apply_settings(settings)
+
+        print('\ndestroying %d vehicles' % len(self.vehicles_list))
+        print(f"Spade agents stopped: {agents_stopped}")
+        with teardown_timer.phase("destroy actors"):
+            # apply_batch_sync returns once the server has destroyed the actors
+            self.client.apply_batch_sync([carla.command.DestroyActor(x) for x in self.vehicles_list])
+            if self.camera:
+                self.camera.destroy()
+        self.world_clean = True
+        teardown_timer.report("teardown")
+        if self.message_bus is not None:
+            self.message_bus.report()
+        if self.shards is not None:
+            self.shards.report()
+        self.plugin.services_stopped(self)
+        self.bsm_latency.report()
+        if self.control_queue is not None:
+            self.control_queue.report()
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.report()
+
+
+def run_simulation(plugin, description=None, argv=None):
+    argparser = build_argparser(plugin, description)
+    args = argparser.parse_args(argv)
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    runner = SimulationRunner(plugin, args)
+    # checked once the scenario's defaults are in, either option may come from it
+    if plugin.sends_bsms and args.broadcast and args.comm_radius is not None:
+        argparser.error('broadcast cannot be combined with a comm radius, a broadcast BSM reaches every vehicle '
+                        'in the room (both come from --broadcast/--no-broadcast, --comm-radius or the scenario)')
+    try:
+        # start with --asynch
+        asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        if not runner.world_clean:
+            asyncio.run(runner.teardown())
+    finally:
+        print('\ndone.')
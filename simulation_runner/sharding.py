@@ -0,0 +1,390 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import signal
+
+from helpers.agent_lifecycle import start_agents, stop_agents
+from helpers.carla_backend import carla
+from helpers.control_queue import ControlQueue
+from helpers.fleet_snapshot import FleetSnapshot
+from helpers.latency import BsmLatency, SimulationClock
+from helpers.spatial_index import SpatialGrid
+from helpers.tick_scheduler import TickScheduler
+from spade_classes.message_bus import TRANSPORT_BUS
+from spade_classes.shard_bus import ShardBus
+
+# Sharded mode (--workers N): the vehicle agents run in N worker processes,
+# each with its own event loop, so BSM generation and parsing use N cores.
+# The coordinator (SimulationRunner) keeps the CARLA connection: it spawns,
+# ticks, runs the fleet registry and tears down. After every tick it pipes
+# the FleetSnapshot arrays to the workers, whose agents read their vehicle
+# from them through RemoteVehicle; control changes travel back coalesced per
+# worker and go out in the coordinator's ControlQueue batch.
+# With --transport bus the workers and the coordinator's service agents are
+# connected by a ShardBus, with XMPP the server routes between them anyway.
+# In synchronous mode with --bsm-rate each worker acknowledges a frame once
+# its agents sent their BSMs, and the coordinator does not tick before all
+# of them did.
+
+# flush interval of a worker's control changes between two frames
+CONTROL_FLUSH_PERIOD = 0.05
+SHARD_STOP_TIMEOUT = 15.0
+
+
+def pack_control(control):
+    return (control.throttle, control.steer, control.brake, control.hand_brake, control.reverse)
+
+
+def unpack_control(packed):
+    throttle, steer, brake, hand_brake, reverse = packed
+    return carla.VehicleControl(throttle=throttle, steer=steer, brake=brake, hand_brake=hand_brake, reverse=reverse)
+
+
+def create_coordinator_bus(workers):
+    # the coordinator's ShardBus, it is the shard after the workers'; ShardPool.start fills in the owners
+    context = multiprocessing.get_context("spawn")
+    shard_inboxes = [context.Queue() for _ in range(workers + 1)]
+    return ShardBus(workers, shard_inboxes, {}, workers)
+
+
+def partition(actor_ids, workers):
+    # round robin, so every worker gets vehicles from all over the spawn list
+    return [actor_ids[shard::workers] for shard in range(workers)]
+
+
+class RemoteFleetSnapshotService:
+    # FleetSnapshotService of a worker, fed by the coordinator instead of world.on_tick
+    def __init__(self, actor_ids):
+        self.actor_ids = list(actor_ids)
+        self.latest = None
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def update(self, frame, elapsed_seconds, positions, velocities, alive):
+        self.latest = FleetSnapshot(frame, elapsed_seconds, self.actor_ids, positions, velocities, alive)
+        for callback in list(self.listeners):
+            callback(self.latest)
+
+    def stop(self):
+        self.listeners = []
+
+
+class RemoteVehicle:
+    # stands in for the carla.Vehicle of an agent in a worker, answered from the latest fleet snapshot
+    def __init__(self, actor_id, fleet):
+        self.id = actor_id
+        self.fleet = fleet
+
+    @property
+    def is_alive(self):
+        state = self.fleet.latest.state(self.id)
+        return state is not None and state.alive
+
+    def get_transform(self):
+        state = self.fleet.latest.state(self.id)
+        return carla.Transform(carla.Location(x=state.x, y=state.y, z=state.z), carla.Rotation())
+
+    def get_velocity(self):
+        snapshot = self.fleet.latest
+        x, y, z = snapshot.velocities[snapshot.rows[self.id]].tolist()
+        return carla.Vector3D(x, y, z)
+
+
+class ForwardingControlQueue(ControlQueue):
+    # a worker's control changes, sent to the coordinator instead of the server
+    def __init__(self, conn, loop):
+        super().__init__(None, period=CONTROL_FLUSH_PERIOD, loop=loop)
+        self.conn = conn
+
+    def send(self, autopilot, controls):
+        self.conn.send(("controls", autopilot, {actor_id: pack_control(control)
+                                                for actor_id, control in controls.items()}))
+        return len(autopilot) + len(controls)
+
+
+# -- worker process ------------------------------------------------------------
+
+
+def shard_main(shard, config, conn, shard_inboxes):
+    # Ctrl+C reaches the whole process group, the coordinator stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format=f'%(levelname)s: shard {shard}: %(message)s', level=logging.INFO)
+    asyncio.run(ShardWorker(shard, config, conn, shard_inboxes).run())
+
+
+class ShardWorker:
+    def __init__(self, shard, config, conn, shard_inboxes):
+        from simulation_runner.plugins import PLUGINS
+        self.shard = shard
+        self.plugin = PLUGINS[config["plugin"]]()
+        self.args = config["args"]
+        self.conn = conn
+        self.lockstep = config["lockstep"]
+        self.actor_ids = config["actor_ids"]
+        self.jids = [f"car{actor_id}@localhost" for actor_id in config["all_actor_ids"]]
+        self.message_bus = None
+        if self.args.transport == TRANSPORT_BUS:
+            self.message_bus = ShardBus(shard, shard_inboxes, config["owners"], config["coordinator"])
+        self.fleet_snapshot = RemoteFleetSnapshotService(config["all_actor_ids"])
+        self.fleet_snapshot.update(*config["snapshot"])
+        self.sim_clock = SimulationClock()
+        self.sim_clock.update(self.fleet_snapshot.latest.frame)
+        self.sim_clock.advance(self.fleet_snapshot.latest.elapsed_seconds)
+        self.bsm_latency = BsmLatency(self.sim_clock)
+        self.control_queue = None
+        self.tick_scheduler = None
+        self.fleet_index = None
+        self.agents = []
+        self.stopping = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.control_queue = ForwardingControlQueue(self.conn, loop)
+        if self.message_bus is not None:
+            self.message_bus.start(loop)
+        loop.add_reader(self.conn.fileno(), self._on_pipe)
+        await self.start_agents()
+        self.conn.send(("ready", len(self.agents)))
+        await self.stopping.wait()
+        loop.remove_reader(self.conn.fileno())
+        await self.teardown()
+
+    async def start_agents(self):
+        args = self.args
+        if self.plugin.sends_bsms and args.bsm_rate:
+            self.tick_scheduler = TickScheduler(self.fleet_snapshot, args.bsm_rate)
+        new_agents = []
+        for actor_id in self.actor_ids:
+            agent = self.plugin.create_agent(self, actor_id, RemoteVehicle(actor_id, self.fleet_snapshot))
+            agent.clock = self.sim_clock
+            agent.latency = self.bsm_latency
+            agent.control_queue = self.control_queue
+            agent.fleet_snapshot = self.fleet_snapshot
+            if self.tick_scheduler is not None:
+                agent.bsm_ticks = self.tick_scheduler.subscribe(actor_id)
+            new_agents.append(agent)
+        self.agents.extend(await start_agents(new_agents, args.startup_concurrency))
+        # agents of the other workers are not in this process, so the receivers are all scripted vehicles
+        for agent in self.agents:
+            own_jid = str(agent.jid)
+            agent.receivers = [jid for jid in self.jids if jid != own_jid]
+        if self.plugin.sends_bsms and args.comm_radius:
+            from simulation_runner.runner import refresh_fleet_index
+            self.fleet_index = SpatialGrid(cell_size=args.comm_radius)
+            refresh_fleet_index(self.fleet_index, self.fleet_snapshot.latest)
+            for agent in self.agents:
+                agent.neighbour_index = self.fleet_index
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.start()
+
+    def _on_pipe(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == "snapshot":
+                    self._on_snapshot(*message[1:])
+                elif message[0] == "stop":
+                    self.stopping.set()
+        except EOFError:
+            # coordinator is gone
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.stopping.set()
+
+    def _on_snapshot(self, frame, elapsed_seconds, positions, velocities, alive):
+        self.fleet_snapshot.update(frame, elapsed_seconds, positions, velocities, alive)
+        self.sim_clock.update(frame)
+        self.sim_clock.advance(elapsed_seconds)
+        if self.fleet_index is not None:
+            from simulation_runner.runner import refresh_fleet_index
+            refresh_fleet_index(self.fleet_index, self.fleet_snapshot.latest)
+        if self.lockstep:
+            asyncio.ensure_future(self._acknowledge(frame))
+
+    async def _acknowledge(self, frame):
+        if self.tick_scheduler is not None:
+            await self.tick_scheduler.wait_sent(frame)
+        # let the agents react before the coordinator applies the controls and ticks
+        await asyncio.sleep(0)
+        self.control_queue.flush()
+        self.conn.send(("ack", frame))
+
+    async def teardown(self):
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.stop()
+        stopped = await stop_agents(self.agents)
+        self.control_queue.flush()
+        stats = {
+            "agents": stopped,
+            "latency": self.bsm_latency,
+            "delivered": 0,
+            "dropped": 0,
+            "forwarded": 0,
+            "fired": 0,
+            "replaced": 0,
+        }
+        if self.message_bus is not None:
+            self.message_bus.stop()
+            stats.update(delivered=self.message_bus.delivered, dropped=self.message_bus.dropped,
+                         forwarded=self.message_bus.forwarded)
+        if self.tick_scheduler is not None:
+            stats.update(fired=self.tick_scheduler.fired, replaced=self.tick_scheduler.replaced)
+        self.conn.send(("stats", stats))
+
+
+# -- coordinator -----------------------------------------------------------------
+
+
+class ShardPool:
+    def __init__(self, runner, workers):
+        self.runner = runner
+        self.workers = workers
+        self.processes = []
+        self.conns = []
+        self.ready = []
+        self.acked = [None] * workers
+        self.frame_acked = asyncio.Event()
+        self.stats = [None] * workers
+        self.stats_received = asyncio.Event()
+        self.agents = 0
+        self.lockstep = False
+
+    async def start(self, actor_ids, snapshot, lockstep):
+        runner = self.runner
+        loop = asyncio.get_running_loop()
+        self.lockstep = lockstep
+        context = multiprocessing.get_context("spawn")
+        shards = partition(actor_ids, self.workers)
+        owners = {f"car{actor_id}@localhost": shard
+                  for shard, shard_ids in enumerate(shards) for actor_id in shard_ids}
+        bus = runner.message_bus
+        shard_inboxes = None
+        if bus is not None:
+            # the coordinator's services reach the vehicles through its own ShardBus
+            bus.owners.update(owners)
+            bus.start(loop)
+            shard_inboxes = bus.shard_inboxes
+        for shard, shard_ids in enumerate(shards):
+            config = {
+                "plugin": runner.plugin.name,
+                "args": runner.args,
+                "lockstep": lockstep,
+                "actor_ids": shard_ids,
+                "all_actor_ids": list(actor_ids),
+                "owners": owners,
+                "coordinator": self.workers,
+                "snapshot": self._pack_snapshot(snapshot),
+            }
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=shard_main, args=(shard, config, child_conn, shard_inboxes),
+                                      name=f"shard-{shard}", daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.conns.append(parent_conn)
+            self.ready.append(loop.create_future())
+            loop.add_reader(parent_conn.fileno(), functools.partial(self._on_pipe, shard))
+        self.agents = sum(await asyncio.gather(*self.ready))
+        return self.agents
+
+    @staticmethod
+    def _pack_snapshot(snapshot):
+        return (snapshot.frame, snapshot.elapsed_seconds, snapshot.positions, snapshot.velocities, snapshot.alive)
+
+    def publish_snapshot(self, snapshot):
+        message = ("snapshot",) + self._pack_snapshot(snapshot)
+        for shard, conn in enumerate(self.conns):
+            if self.stats[shard] is None and not conn.closed:
+                conn.send(message)
+
+    def _on_pipe(self, shard):
+        conn = self.conns[shard]
+        try:
+            while conn.poll():
+                message = conn.recv()
+                kind = message[0]
+                if kind == "ack":
+                    self.acked[shard] = message[1]
+                    self.frame_acked.set()
+                elif kind == "controls":
+                    control_queue = self.runner.control_queue
+                    for actor_id, enabled in message[1].items():
+                        control_queue.set_autopilot(actor_id, enabled)
+                    for actor_id, control in message[2].items():
+                        control_queue.apply_control(actor_id, unpack_control(control))
+                elif kind == "ready":
+                    self.ready[shard].set_result(message[1])
+                elif kind == "stats":
+                    self._finished(shard, message[1])
+        except (EOFError, OSError):
+            logging.error(f"shard {shard} exited")
+            self._finished(shard, {})
+
+    def _finished(self, shard, stats):
+        asyncio.get_running_loop().remove_reader(self.conns[shard].fileno())
+        self.stats[shard] = stats
+        if not self.ready[shard].done():
+            self.ready[shard].set_result(0)
+        # a dead shard does not hold back the ticks
+        self.acked[shard] = float("inf")
+        self.frame_acked.set()
+        self.stats_received.set()
+
+    async def wait_frame(self, frame, timeout=1.0):
+        try:
+            await asyncio.wait_for(self._wait_frame(frame), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"shards did not finish frame {frame} within {timeout} s")
+
+    async def _wait_frame(self, frame):
+        while any(acked is None or acked < frame for acked in self.acked):
+            self.frame_acked.clear()
+            await self.frame_acked.wait()
+
+    async def stop(self, timeout=SHARD_STOP_TIMEOUT):
+        # returns the number of agents the workers stopped
+        for shard, conn in enumerate(self.conns):
+            if self.stats[shard] is None:
+                try:
+                    conn.send(("stop",))
+                except OSError:
+                    self._finished(shard, {})
+        try:
+            await asyncio.wait_for(self._wait_stats(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"shards did not stop within {timeout} s")
+        for process in self.processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.conns:
+            conn.close()
+        if self.runner.message_bus is not None:
+            self.runner.message_bus.stop()
+        latency = self.runner.bsm_latency
+        for stats in self.stats:
+            if stats and stats.get("latency") is not None:
+                latency.merge(stats["latency"])
+        return sum(stats.get("agents", 0) for stats in self.stats if stats)
+
+    async def _wait_stats(self):
+        while any(stats is None for stats in self.stats):
+            self.stats_received.clear()
+            await self.stats_received.wait()
+
+    def report(self):
+        stats = [s for s in self.stats if s]
+
+        def total(key):
+            return sum(s.get(key, 0) for s in stats)
+
+        print(f"shards: {self.workers} workers hosted {self.agents} agents")
+        if self.runner.args.transport == TRANSPORT_BUS:
+            forwarded = total('forwarded') + self.runner.message_bus.forwarded
+            print(f"  message bus      {total('delivered')} messages delivered, {total('dropped')} dropped, "
+                  f"{forwarded} forwarded between shards")
+        if total("fired"):
+            print(f"  tick schedulers  fired {total('fired')} times, {total('replaced')} states replaced")
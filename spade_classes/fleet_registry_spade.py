@@ -0,0 +1,124 @@
+import asyncio
+import spade
+
+from helpers.fleet_registry import FleetRegistry, receivers_updater
+from spade_classes.message_bus import SendOnlyBehaviour, TransportAgent
+
+# The registry agent is hosted by the simulation launcher. Agents in other
+# processes (manual control, semaphore control) talk to it over XMPP:
+#   agent -> registry: "join", "leave", "subscribe", "unsubscribe"
+#   registry -> subscribers: "joined:<jid,jid,...>;left:<jid,...>"
+# A new subscriber first receives all current members as joined.
+FLEET_REGISTRY_JID = "fleet@localhost"
+
+fleet_template = spade.template.Template()
+fleet_template.metadata = {"performative": "inform", "ontology": "fleet"}
+
+
+def create_fleet_message(to, body):
+    msg = spade.message.Message(to=to)
+    msg.set_metadata("performative", "inform")
+    msg.set_metadata("ontology", "fleet")
+    msg.body = body
+    return msg
+
+
+def encode_delta(joined, left):
+    return f"joined:{','.join(sorted(joined))};left:{','.join(sorted(left))}"
+
+
+def decode_delta(body):
+    joined_part, left_part = body.split(";")
+    joined = joined_part[len("joined:"):]
+    left = left_part[len("left:"):]
+    return set(joined.split(",")) if joined else set(), set(left.split(",")) if left else set()
+
+
+class FleetRegistryAgent(TransportAgent):
+    def __init__(self, jid, password, registry=None, bus=None):
+        super().__init__(jid, password, bus)
+        self.registry = registry if registry is not None else FleetRegistry()
+        self.remote_subscribers = set()
+        self.deltas = asyncio.Queue()
+
+    def _queue_delta(self, joined, left):
+        self.deltas.put_nowait((joined, left))
+
+    class ParseFleetRequest(spade.behaviour.CyclicBehaviour):
+        async def run(self):
+            msg = await self.receive(timeout=10)
+            if not msg:
+                return
+            sender = str(msg.sender.bare())
+            if msg.body == "join":
+                await self.subscribe(sender)
+                self.agent.registry.join(sender)
+            elif msg.body == "subscribe":
+                await self.subscribe(sender)
+            elif msg.body == "leave":
+                self.agent.remote_subscribers.discard(sender)
+                self.agent.registry.leave(sender)
+            elif msg.body == "unsubscribe":
+                self.agent.remote_subscribers.discard(sender)
+
+        async def subscribe(self, sender):
+            await self.send(create_fleet_message(sender, encode_delta(self.agent.registry.members, set())))
+            self.agent.remote_subscribers.add(sender)
+
+    class PushDeltaBehaviour(SendOnlyBehaviour, spade.behaviour.CyclicBehaviour):
+        async def run(self):
+            joined, left = await self.agent.deltas.get()
+            body = encode_delta(joined, left)
+            for subscriber in list(self.agent.remote_subscribers):
+                await self.send(create_fleet_message(subscriber, body))
+
+    async def setup(self):
+        self.registry.subscribe(self._queue_delta)
+        # the first delta is the initial member list, remote subscribers get that on subscribe
+        self.deltas.get_nowait()
+        self.add_behaviour(self.ParseFleetRequest(), fleet_template)
+        self.add_behaviour(self.PushDeltaBehaviour())
+
+
+class JoinFleetBehaviour(SendOnlyBehaviour, spade.behaviour.PeriodicBehaviour):
+    # Keeps asking the registry until it answers, so the agent can be started
+    # before the launcher hosting the registry. `request` is "join" for
+    # vehicles and "subscribe" for agents that only want the member list.
+    def __init__(self, registry_jid=FLEET_REGISTRY_JID, request="join", period=2):
+        super().__init__(period=period)
+        self.registry_jid = registry_jid
+        self.request = request
+
+    async def run(self):
+        if self.agent.fleet_joined:
+            self.kill()
+            return
+        await self.send(create_fleet_message(self.registry_jid, self.request))
+
+
+class ParseFleetMsg(spade.behaviour.CyclicBehaviour):
+    async def on_start(self):
+        self.update_receivers = receivers_updater(self.agent)
+
+    async def run(self):
+        msg = await self.receive(timeout=10)
+        if msg:
+            joined, left = decode_delta(msg.body)
+            self.update_receivers(joined, left)
+            self.agent.fleet_joined = True
+
+
+async def leave_fleet(behaviour):
+    # agents of the launcher hosting the registry leave in-process (agent.fleet_registry),
+    # agents in other processes over XMPP (agent.fleet_registry_jid)
+    agent = behaviour.agent
+    if getattr(agent, "fleet_registry", None) is not None:
+        agent.fleet_registry.leave(str(agent.jid))
+    elif getattr(agent, "fleet_registry_jid", None):
+        await behaviour.send(create_fleet_message(agent.fleet_registry_jid, "leave"))
+
+
+def add_fleet_behaviours(agent, registry_jid=FLEET_REGISTRY_JID, request="join"):
+    agent.fleet_joined = False
+    agent.add_behaviour(JoinFleetBehaviour(registry_jid, request))
+    agent.add_behaviour(ParseFleetMsg(), fleet_template)
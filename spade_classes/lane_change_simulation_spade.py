@@ -1,37 +1,63 @@
-import asyncio
-from collections import deque
-import math
 import spade
-import carla
 from exceptions.carla_related_exceptions import VehicleDestroyed
+from exceptions.bsm_exceptions import InvalidBSM
+from helpers.bsm_codec import encode_bsm, decode_bsm
+from helpers.fleet_snapshot import vehicle_state_from_actor
+from helpers.vehicle_tracks import VehicleTracks
+from spade_classes.message_bus import SendOnlyBehaviour, TransportAgent, broadcast_channel
+from spade_classes.fleet_registry_spade import add_fleet_behaviours, leave_fleet
 
 bsm_template = spade.template.Template()
 bsm_template.metadata = {"performative": "inform", "ontology": "bsm"}
 
-def get_speed(vehicle):
-    velocity = vehicle.get_velocity()
-    speed = 3.6 * math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
-    # print(f"speed {speed}")
-    return speed
-
-class CarAgent(spade.agent.Agent):
-    def __init__(self, jid, password, carla_vehicle):
-        super().__init__(jid, password)
+class CarAgent(TransportAgent):
+    def __init__(self, jid, password, carla_vehicle, bsm_room=None, comm_radius=None, fleet_registry_jid=None, tracks=None,
+                 bus=None):
+        super().__init__(jid, password, bus)
         self.carla_vehicle = carla_vehicle
         self.receivers = []
-        self.dict_positions = {}
-        self.dict_vehicle_speed_list = {}
+        self.bsm_room = bsm_room
+        self.bsm_channel = None
+        # receivers come from the fleet registry, in-process (set by the launcher) or over XMPP
+        self.fleet_registry = None
+        self.fleet_registry_jid = fleet_registry_jid
+        # range limited delivery, neighbour_index is a shared SpatialGrid of receiver jids
+        self.comm_radius = comm_radius
+        self.neighbour_index = None
+        self.location = None
+        # shared SimulationClock and BsmLatency, set by the launcher
+        self.clock = None
+        self.latency = None
+        # queue of VehicleStates from the launcher's TickScheduler, None to send on the wall clock
+        self.bsm_ticks = None
+        # FleetSnapshotService of the launcher, BSMs read the vehicle state from it instead of the server
+        self.fleet_snapshot = None
+        # pass a VehicleTracks to share it with another thread (the HUD)
+        self.tracks = tracks if tracks is not None else VehicleTracks(history=5)
+
+    def vehicle_state(self):
+        if self.fleet_snapshot is not None and self.fleet_snapshot.latest is not None:
+            state = self.fleet_snapshot.latest.state(self.carla_vehicle.id)
+            if state is not None:
+                return state
+        frame = self.clock.frame if self.clock is not None else None
+        return vehicle_state_from_actor(self.carla_vehicle, frame, with_speed=True)
 
-    class SendBSMBehaviour(spade.behaviour.PeriodicBehaviour):
+    class SendBSMBehaviour(SendOnlyBehaviour, spade.behaviour.PeriodicBehaviour):
         async def run(self):
+            # with a tick scheduler the state is sampled at the simulation tick, see setup()
+            state = await self.agent.bsm_ticks.get() if self.agent.bsm_ticks is not None else None
             try:
-                msg = self.create_bsm_message()
+                msg = self.create_bsm_message(state)
                 if msg.body == "":
                     return
+                await self.send_message_to_all(msg)
             except VehicleDestroyed:
+                await leave_fleet(self)
                 await self.agent.stop()
-                return
-            await self.send_message_to_all(msg)
+            finally:
+                if state is not None:
+                    self.agent.bsm_ticks.task_done()
 
         async def on_end(self):
             pass
@@ -39,46 +65,66 @@ class CarAgent(spade.agent.Agent):
         async def on_start(self):
             pass
 
-        def create_bsm_message(self):
+        def create_bsm_message(self, state=None):
             msg = spade.message.Message()
             if not self.agent.carla_vehicle:
                 msg.body = ""
-            if not self.agent.carla_vehicle.is_alive:
+            if state is None:
+                state = self.agent.vehicle_state()
+            if not state.alive:
                 raise VehicleDestroyed("Please stop agent")
-            location = self.agent.carla_vehicle.get_transform().location
+            self.agent.location = state
             crash = False
             if hasattr(self.agent.carla_vehicle, "crash") and self.agent.carla_vehicle.crash:
                 crash = True
                 self.agent.carla_vehicle.crash = False
             msg.set_metadata("performative", "inform")
             msg.set_metadata("ontology", "bsm")
-            msg.body = f"{self.agent.name}*Location:{location.x},{location.y},{location.z}*Crash:{crash}*Speed:{get_speed(self.agent.carla_vehicle)}"
+            msg.body = encode_bsm(self.agent.name, state, crash, state.speed, frame=state.frame)
             return msg
         
         async def send_message_to_all(self, msg):
-            for a in self.agent.receivers:
+            if self.agent.bsm_channel:
+                await self.agent.bsm_channel.publish(msg)
+                return
+            for a in self.receivers_in_range():
                 msg.to = a
                 await self.send(msg)
 
+        def receivers_in_range(self):
+            index = self.agent.neighbour_index
+            if index is None or self.agent.comm_radius is None or self.agent.location is None:
+                return self.agent.receivers
+            in_range = set(index.query_radius(self.agent.location, self.agent.comm_radius))
+            # receivers the index does not track (e.g. the manual control car) are always kept
+            return [a for a in self.agent.receivers if a in in_range or a not in index]
+
     class ParseBSM(spade.behaviour.CyclicBehaviour):
         async def run(self):
             msg = await self.receive(timeout=10)
             if msg:
-                msg_splitted = msg.body.split("*")
-                # print(f"msg_spliited: {msg_splitted}")
-                car_name = msg_splitted[0]
-                car_location = msg_splitted[1].split(":")[1]
-                x,y,z = car_location.split(",")
-                car_speed = float(msg_splitted[3].split(":")[1])
-                loc = carla.Location(x=float(x), y=float(y), z=float(z))
-                if car_name in self.agent.dict_positions:
-                    self.agent.dict_positions[car_name].append(loc)
-                else:
-                    self.agent.dict_positions[car_name] = deque(maxlen=5)
-                    self.agent.dict_positions[car_name].append(loc)
-                self.agent.dict_vehicle_speed_list[car_name] = car_speed
+                try:
+                    bsm = decode_bsm(msg.body)
+                except InvalidBSM:
+                    return
+                if self.agent.latency is not None:
+                    self.agent.latency.record(bsm)
+                car_speed = bsm.speed if bsm.speed is not None else 0.0
+                self.agent.tracks.update(bsm.sender, bsm.x, bsm.y, bsm.z, car_speed)
                 # print(f"{self.agent.name} got message: {msg.body}")
 
     async def setup(self):
-        self.add_behaviour(self.SendBSMBehaviour(period=0.5), None)
-        self.add_behaviour(self.ParseBSM(), bsm_template)
\ No newline at end of file
+        if self.bsm_room:
+            self.bsm_channel = broadcast_channel(self, self.bsm_room)
+            await self.bsm_channel.join(self)
+        if self.fleet_registry_jid:
+            add_fleet_behaviours(self, self.fleet_registry_jid)
+        # on ticks the behaviour waits for the next state itself, so it runs back to back
+        self.add_behaviour(self.SendBSMBehaviour(period=0 if self.bsm_ticks is not None else 0.5), None)
+        self.add_behaviour(self.ParseBSM(), bsm_template)
+
+    async def teardown(self):
+        # the BSM room is persistent, leave it so stopped cars do not stay occupants
+        if self.bsm_channel:
+            await self.bsm_channel.leave()
+            self.bsm_channel = None
\ No newline at end of file
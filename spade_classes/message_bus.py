@@ -0,0 +1,147 @@
+import asyncio
+
+import spade
+
+from spade_classes.muc_broadcast import BSM_ROOM_JID, MucBroadcastChannel
+
+# In-process replacement for the XMPP server, to measure the agents' own
+# throughput without ejabberd in the way. Agents started on a bus do not log
+# in anywhere: the bus becomes their container (spade sends every message
+# through agent.container.send) and each agent gets an inbox queue that is
+# dispatched to its behaviours with the usual template matching.
+# Rooms stand in for MUC rooms, see BusBroadcastChannel.
+TRANSPORT_XMPP = "xmpp"
+TRANSPORT_BUS = "bus"
+TRANSPORTS = (TRANSPORT_XMPP, TRANSPORT_BUS)
+
+
+class MessageBus:
+    def __init__(self):
+        self.inboxes = {}
+        self.pumps = {}
+        self.rooms = {}
+        self.delivered = 0
+        self.dropped = 0
+
+    def attach(self, agent):
+        jid = str(agent.jid)
+        inbox = asyncio.Queue()
+        self.inboxes[jid] = inbox
+        self.pumps[jid] = asyncio.ensure_future(self._pump(agent, inbox))
+
+    def detach(self, agent):
+        jid = str(agent.jid)
+        self.inboxes.pop(jid, None)
+        pump = self.pumps.pop(jid, None)
+        if pump is not None:
+            pump.cancel()
+        for members in self.rooms.values():
+            members.discard(jid)
+
+    async def _pump(self, agent, inbox):
+        while True:
+            msg = await inbox.get()
+            agent.dispatch(msg)
+
+    def deliver(self, jid, msg):
+        inbox = self.inboxes.get(jid)
+        if inbox is None:
+            # like a message to an offline user, nobody gets it
+            self.dropped += 1
+            return False
+        inbox.put_nowait(msg)
+        self.delivered += 1
+        return True
+
+    async def send(self, msg, behaviour):
+        # called by Behaviour.send in place of spade's Container.send
+        self.deliver(str(msg.to), msg)
+
+    def join_room(self, room_jid, jid):
+        self.rooms.setdefault(room_jid, set()).add(jid)
+
+    def leave_room(self, room_jid, jid):
+        self.rooms.get(room_jid, set()).discard(jid)
+
+    def publish(self, room_jid, msg):
+        # every occupant but the sender gets the same message object, receivers only read it
+        sender = str(msg.sender)
+        for jid in list(self.rooms.get(room_jid, ())):
+            if jid != sender:
+                self.deliver(jid, msg)
+
+    def report(self):
+        print(f"message bus: {self.delivered} messages delivered, {self.dropped} dropped")
+
+
+class BusBroadcastChannel:
+    # same interface as MucBroadcastChannel
+    def __init__(self, bus, room_jid=BSM_ROOM_JID):
+        self.bus = bus
+        self.room_jid = room_jid
+        self.agent = None
+
+    async def join(self, agent):
+        self.agent = agent
+        self.bus.join_room(self.room_jid, str(agent.jid))
+
+    async def publish(self, msg):
+        if not msg.sender:
+            msg.sender = str(self.agent.jid)
+        self.bus.publish(self.room_jid, msg)
+
+    async def leave(self):
+        if self.agent is not None:
+            self.bus.leave_room(self.room_jid, str(self.agent.jid))
+
+
+def broadcast_channel(agent, room_jid):
+    if agent.bus is not None:
+        return BusBroadcastChannel(agent.bus, room_jid)
+    return MucBroadcastChannel(room_jid)
+
+
+class SendOnlyBehaviour:
+    # mixin for behaviours that only send, e.g.
+    # class SendBSMBehaviour(SendOnlyBehaviour, spade.behaviour.PeriodicBehaviour)
+    def match(self, message):
+        # do not collect incoming messages in this behaviour's queue
+        return False
+
+
+class TransportAgent(spade.agent.Agent):
+    # Agent that talks over XMPP, or over `bus` when one is given.
+    # Behaviours, templates and metadata are the same for both. The bus path
+    # replaces spade's connect and disconnect in the public start()/stop() but
+    # still has to set the agent's _alive event, an internal of the spade
+    # release pinned in requirements.txt.
+    def __init__(self, jid, password, bus=None):
+        super().__init__(jid, password)
+        self.bus = bus
+
+    async def start(self, auto_register=True):
+        if self.bus is None:
+            return await super().start(auto_register)
+        self.set_container(self.bus)
+        self.bus.attach(self)
+        await self.setup()
+        self._alive.set()
+        for behaviour in self.behaviours:
+            if not behaviour.is_running:
+                behaviour.set_agent(self)
+                behaviour.start()
+
+    async def stop(self):
+        # teardown() runs on both transports, before the agent goes offline
+        if self.is_alive():
+            await self.teardown()
+        if self.bus is None:
+            return await super().stop()
+        for behaviour in self.behaviours:
+            behaviour.kill()
+        self.bus.detach(self)
+        self._alive.clear()
+
+    async def teardown(self):
+        # counterpart of setup(), may be overloaded
+        pass
@@ -0,0 +1,46 @@
+import aioxmpp
+import aioxmpp.muc
+import spade
+
+# Room on the ejabberd mod_muc service (see ejabberd-setup/ejabberd.yml).
+# Every car publishes its BSM once to the room and the server fans it out to
+# all occupants, so a period costs N stanzas from the cars instead of N*(N-1).
+BSM_ROOM_JID = "bsm@conference.localhost"
+
+
+class MucBroadcastChannel:
+    def __init__(self, room_jid=BSM_ROOM_JID):
+        self.room_jid = aioxmpp.JID.fromstr(room_jid)
+        self.agent = None
+        self.room = None
+
+    async def join(self, agent):
+        # the agent has to be connected, so call this from Agent.setup()
+        self.agent = agent
+        muc_client = agent.client.summon(aioxmpp.MUCClient)
+        self.room, join_future = muc_client.join(
+            self.room_jid,
+            agent.name,
+            history=aioxmpp.muc.xso.History(maxstanzas=0),
+        )
+        self.room.on_message.connect(self._on_message)
+        await join_future
+
+    def _on_message(self, message, member, source, **kwargs):
+        # the room reflects our own messages back, do not parse them
+        if member is not None and member is self.room.me:
+            return
+        self.agent.dispatch(spade.message.Message.from_node(message))
+
+    async def publish(self, msg):
+        if not msg.sender:
+            msg.sender = str(self.agent.jid)
+        stanza = msg.prepare()
+        stanza.to = self.room_jid
+        stanza.type_ = aioxmpp.MessageType.GROUPCHAT
+        await self.agent.client.send(stanza)
+
+    async def leave(self):
+        if self.room is not None and self.room.muc_active:
+            await self.room.leave()
+        self.room = None
@@ -1,8 +1,31 @@
-import asyncio
 import math
+import time
+import numpy as np
 import spade
-import carla
+from helpers.carla_backend import carla
 from exceptions.carla_related_exceptions import VehicleDestroyed
+from exceptions.bsm_exceptions import InvalidBSM
+from exceptions.spat_exceptions import InvalidSpat
+from helpers.bsm_codec import encode_bsm, decode_bsm
+from helpers.fleet_snapshot import read_fleet_snapshot
+from helpers.spat_codec import encode_spat, decode_spat
+from helpers.timing_plan import schedule_for, signal_states
+from spade_classes.message_bus import SendOnlyBehaviour, TransportAgent, broadcast_channel
+from spade_classes.fleet_registry_spade import add_fleet_behaviours, leave_fleet
+from spade_classes.vehicle_control_behaviours import sleep_simulated, start_timed_control
+
+EMERGENCY_BRAKE_HOLD = 5
+# seconds of full throttle when a stopped car gets the green light
+GREEN_LAUNCH_HOLD = 4
+# intersection controllers send the signal state to vehicles within this many metres
+# of the intersection that drive towards it or stand in its queue
+APPROACH_RADIUS = 90.0
+# km/h, slower vehicles count as standing in the queue
+QUEUED_SPEED = 2.0
+# seconds between two checks for due receivers; SPaT is only sent when the state
+# changed, to new receivers and every SPAT_HEARTBEAT seconds
+SPAT_POLL_PERIOD = 0.1
+SPAT_HEARTBEAT = 2.0
 
 bsm_template = spade.template.Template()
 bsm_template.metadata = {"performative": "inform", "ontology": "bsm"}
@@ -17,19 +40,30 @@ def is_vehicle_stationary(vehicle, threshold=15):
     # print(f"speed {speed}")
     return speed < threshold
 
-class CarAgent(spade.agent.Agent):
-    def __init__(self, jid, password, carla_vehicle):
-        super().__init__(jid, password)
+class CarAgent(TransportAgent):
+    def __init__(self, jid, password, carla_vehicle, bsm_room=None, bus=None):
+        super().__init__(jid, password, bus)
         self.carla_vehicle = carla_vehicle
         self.receivers = []
+        self.bsm_room = bsm_room
+        self.bsm_channel = None
+        self.fleet_registry = None
+        self.emergency_brake = None
+        self.green_launch = None
+        # ControlQueue shared by the launcher's agents, None sends controls straight to the server
+        self.control_queue = None
+        # shared SimulationClock and BsmLatency, set by the launcher
+        self.clock = None
+        self.latency = None
 
-    class SendBSMBehaviour(spade.behaviour.PeriodicBehaviour):
+    class SendBSMBehaviour(SendOnlyBehaviour, spade.behaviour.PeriodicBehaviour):
         async def run(self):
             try:
                 msg = self.create_bsm_message()
                 if msg.body == "":
                     return
             except VehicleDestroyed:
+                await leave_fleet(self)
                 await self.agent.stop()
                 return
             await self.send_message_to_all(msg)
@@ -53,10 +87,14 @@ class CarAgent(spade.agent.Agent):
                 self.agent.carla_vehicle.crash = False
             msg.set_metadata("performative", "inform")
             msg.set_metadata("ontology", "bsm")
-            msg.body = f"{self.agent.name}*Location:{location.x},{location.y},{location.z}*Crash:{crash}"
+            msg.body = encode_bsm(self.agent.name, location, crash,
+                                  frame=self.agent.clock.frame if self.agent.clock is not None else None)
             return msg
         
         async def send_message_to_all(self, msg):
+            if self.agent.bsm_channel:
+                await self.agent.bsm_channel.publish(msg)
+                return
             for a in self.agent.receivers:
                 msg.to = a
                 await self.send(msg)
@@ -65,79 +103,294 @@ class CarAgent(spade.agent.Agent):
         async def run(self):
             msg = await self.receive(timeout=10)
             if msg:
-                msg_splitted = msg.body.split("*")
-                if msg_splitted[2] == "Crash:True":
-                    print("breaking")
-                    self.agent.carla_vehicle.set_autopilot(False)
+                try:
+                    bsm = decode_bsm(msg.body)
+                except InvalidBSM:
+                    return
+                if self.agent.latency is not None:
+                    self.agent.latency.record(bsm)
+                if bsm.crash:
                     control = carla.VehicleControl(throttle=0.0, steer=0.0, brake=1.0, hand_brake=True)
-                    self.agent.carla_vehicle.apply_control(control)
-                    await asyncio.sleep(5)
-                    self.agent.carla_vehicle.set_autopilot(True)
+                    # repeated crash BSMs while already braking do not restart the hold
+                    if start_timed_control(self.agent, control, EMERGENCY_BRAKE_HOLD, "emergency_brake"):
+                        print("breaking")
                 # print(f"{self.agent.name} got message: {msg.body}")
     
     class ParseEnvMsg(spade.behaviour.CyclicBehaviour):
         async def run(self):
             msg = await self.receive(timeout=10)
             if msg:
-                if "Semaphore:Green" in msg.body:
-                    msg_splitted = msg.body.split(",")
-                    semaphore_location = carla.Location(x=float(msg_splitted[1]), y=float(msg_splitted[2]), z=0)
+                try:
+                    spat = decode_spat(msg.body)
+                except InvalidSpat:
+                    return
+                launch = self.agent.green_launch
+                if spat.state != "Green" and launch is not None:
+                    # the light changed before this car's turn, a launch still waiting is called off
+                    launch.cancel()
+                if spat.state == "Green" and spat.departure_offset is not None:
+                    # the semaphore saw this car in its queue, it launches at its turn unless that is
+                    # after the light changes; offset and time to change are simulated seconds
+                    if spat.time_to_change is not None and spat.departure_offset >= spat.time_to_change:
+                        return
+                    control = carla.VehicleControl(throttle=1.0, steer=0.0, brake=0.0)
+                    if start_timed_control(self.agent, control, GREEN_LAUNCH_HOLD, "green_launch",
+                                           delay=spat.departure_offset):
+                        print("starting")
+                elif spat.state == "Green":
+                    semaphore_location = carla.Location(x=spat.x, y=spat.y, z=0)
                     vehicle_location = self.agent.carla_vehicle.get_transform().location
                     print(f"{self.agent.name} - distance: {vehicle_location.distance(semaphore_location)}")
                     print(f"{self.agent.name} - stationary: {is_vehicle_stationary(self.agent.carla_vehicle)}")
                     if is_vehicle_stationary(self.agent.carla_vehicle) and vehicle_location.distance(semaphore_location) < 90:
-                        print("starting")
-                        self.agent.carla_vehicle.set_autopilot(False)
                         control = carla.VehicleControl(throttle=1.0, steer=0.0, brake=0.0)
-                        self.agent.carla_vehicle.apply_control(control)
-                        await asyncio.sleep(4)
-                        self.agent.carla_vehicle.set_autopilot(True)
+                        if start_timed_control(self.agent, control, GREEN_LAUNCH_HOLD, "green_launch"):
+                            print("starting")
                 # print(f"{self.agent.name} got message: {msg.body}")
 
     async def setup(self):
+        if self.bsm_room:
+            self.bsm_channel = broadcast_channel(self, self.bsm_room)
+            await self.bsm_channel.join(self)
         #self.add_behaviour(self.SendBSMBehaviour(period=0.5), None)
         #self.add_behaviour(self.ParseBSM(), bsm_template)
         self.add_behaviour(self.ParseEnvMsg(), environment_template)
 
+    async def teardown(self):
+        # the BSM room is persistent, leave it so stopped cars do not stay occupants
+        if self.bsm_channel:
+            await self.bsm_channel.leave()
+            self.bsm_channel = None
 
-class SemaphoreAgent(spade.agent.Agent):
-    def __init__(self, jid, password, semaphore_obj):
-        super().__init__(jid, password)
+
+class SemaphoreAgent(TransportAgent):
+    def __init__(self, jid, password, semaphore_obj, fleet_registry_jid=None, bus=None):
+        super().__init__(jid, password, bus)
         self.semaphore = semaphore_obj
         self.receivers = []
+        self.fleet_registry_jid = fleet_registry_jid
+        # the light does not move, its location is read once in setup()
+        self.location = None
+        # the light's state and when (time.monotonic()) it switches by its own cycle, None when frozen;
+        # the light is read again then, or at the next heartbeat
+        self.light_state = None
+        self.changes_at = None
+        self.read_at = 0.0
+        # state sent last, the receivers that got it and when it was last sent to all of them
+        self.sent_state = None
+        self.informed = set()
+        self.heartbeat_at = 0.0
+        self.spat_sent = 0
+
+    def due_receivers(self, state, receivers=None):
+        # all receivers on a state change or heartbeat, otherwise only the ones that joined since
+        now = time.monotonic()
+        if state != self.sent_state or now - self.heartbeat_at >= SPAT_HEARTBEAT:
+            self.sent_state = state
+            self.informed = set()
+            self.heartbeat_at = now
+        due = [jid for jid in (self.receivers if receivers is None else receivers) if jid not in self.informed]
+        self.informed.update(due)
+        return due
+
+    def read_light(self):
+        self.light_state, time_to_change = read_light_cycle(self.semaphore)
+        now = time.monotonic()
+        self.changes_at = None if time_to_change is None else now + time_to_change
+        # without a known change (frozen, switched by hand) the heartbeat read catches it
+        self.read_at = now + SPAT_HEARTBEAT if self.changes_at is None else min(self.changes_at, now + SPAT_HEARTBEAT)
+
+    def light_switched(self):
+        # called after switching the light from this process, it is read again right away
+        self.read_at = 0.0
+
+    def time_to_change(self):
+        if self.changes_at is None:
+            return None
+        return max(0.0, self.changes_at - time.monotonic())
 
-    class SendLightStateBehaviour(spade.behaviour.PeriodicBehaviour):
+    class SendLightStateBehaviour(SendOnlyBehaviour, spade.behaviour.PeriodicBehaviour):
+        # SPaT on state changes, to new receivers and as a heartbeat, not every period;
+        # the light itself is only read when it is due to change (see read_light)
         async def run(self):
+            agent = self.agent
+            if not agent.semaphore:
+                return
             try:
-                msg = self.create_semaphore_message()
-                if msg.body == "":
-                    return
+                if time.monotonic() >= agent.read_at:
+                    agent.read_light()
             except:
                 await self.agent.stop()
                 return
-            await self.send_message_to_all(msg)
+            due = agent.due_receivers(agent.light_state)
+            if not due:
+                return
+            body = encode_spat(agent.light_state, agent.location.x, agent.location.y, agent.time_to_change())
+            for jid in due:
+                await self.send(spat_message(jid, body))
+            agent.spat_sent += len(due)
 
-        async def on_end(self):
-            pass
+    async def setup(self):
+        if self.fleet_registry_jid:
+            # only interested in the vehicles, the semaphore is not a fleet member
+            add_fleet_behaviours(self, self.fleet_registry_jid, request="subscribe")
+        if self.semaphore:
+            self.location = self.semaphore.get_location()
+        self.add_behaviour(self.SendLightStateBehaviour(period=SPAT_POLL_PERIOD), None)
 
-        async def on_start(self):
-            pass
 
-        def create_semaphore_message(self):
-            msg = spade.message.Message()
-            if not self.agent.semaphore:
-                msg.body = ""
-            location = self.agent.semaphore.get_transform().location
-            msg.set_metadata("performative", "inform")
-            msg.set_metadata("ontology", "environment")
-            msg.body = f"Semaphore:{self.agent.semaphore.get_state()},{location.x},{location.y}"
-            #print(msg.body)
-            return msg
-        
-        async def send_message_to_all(self, msg):
-            for a in self.agent.receivers:
-                msg.to = a
-                await self.send(msg)
+def read_light_cycle(light):
+    # (state, seconds until the light switches by the server's own cycle), None for a frozen light
+    # and for one past its time, e.g. a red light waiting for the rest of its group
+    state = light.get_state()
+    if light.is_frozen():
+        return state, None
+    if state == carla.TrafficLightState.Green:
+        duration = light.get_green_time()
+    elif state == carla.TrafficLightState.Yellow:
+        duration = light.get_yellow_time()
+    elif state == carla.TrafficLightState.Red:
+        duration = light.get_red_time()
+    else:
+        return state, None
+    time_to_change = duration - light.get_elapsed_time()
+    return state, time_to_change if time_to_change > 0 else None
+
+
+def spat_message(to, body):
+    msg = spade.message.Message(to=to)
+    msg.set_metadata("performative", "inform")
+    msg.set_metadata("ontology", "environment")
+    msg.body = body
+    return msg
+
+
+def vehicle_actor_id(jid):
+    # actor id of a "car<id>@localhost" agent, None for other agents
+    name = str(jid).split("@")[0]
+    if name.startswith("car") and name[3:].isdigit():
+        return int(name[3:])
+    return None
+
+
+class IntersectionAgent(SemaphoreAgent):
+    # switches all lights of one intersection (a traffic light group) from a timing plan
+    # and sends their state only to the vehicles approaching the intersection
+    def __init__(self, jid, password, traffic_lights, positions, schedule, world, fleet_registry_jid=None, bus=None):
+        super().__init__(jid, password, traffic_lights[0], fleet_registry_jid, bus)
+        self.traffic_lights = traffic_lights
+        self.poles = [light.get_pole_index() for light in traffic_lights]
+        # the lights do not move, positions are (x, y) per light from the TrafficLightIndex
+        self.light_positions = np.array(positions, dtype=float)
+        self.center = self.light_positions.mean(axis=0)
+        self.schedule = schedule
+        self.world = world
+        # light id -> state name last set by the timing plan
+        self.states = {}
+        # the launcher's FleetSnapshotService when running in its process, else the world snapshot is read
+        self.fleet_snapshot = None
+        # the launcher's SimulationClock, else the plan is run on the wall clock
+        self.clock = None
+
+    def elapsed_seconds(self):
+        if self.fleet_snapshot is not None and self.fleet_snapshot.latest is not None:
+            return self.fleet_snapshot.latest.elapsed_seconds
+        return self.world.get_snapshot().timestamp.elapsed_seconds
+
+    def approaching_vehicles(self):
+        # [(jid, index of the light closest to the vehicle, queued, distance to that light)]
+        # of the receivers approaching or queued here
+        jids = {}
+        for jid in self.receivers:
+            actor_id = vehicle_actor_id(jid)
+            if actor_id is not None:
+                jids[actor_id] = jid
+        if not jids:
+            return []
+        if self.fleet_snapshot is not None and self.fleet_snapshot.latest is not None:
+            snapshot = self.fleet_snapshot.latest
+        else:
+            snapshot = read_fleet_snapshot(self.world.get_snapshot(), list(jids))
+        actor_ids = [actor_id for actor_id in jids if actor_id in snapshot.rows]
+        rows = np.array([snapshot.rows[actor_id] for actor_id in actor_ids], dtype=int)
+        positions = snapshot.positions[rows, :2]
+        to_center = self.center - positions
+        distance = np.sqrt(np.einsum("vk,vk->v", to_center, to_center))
+        towards = np.einsum("vk,vk->v", snapshot.velocities[rows, :2], to_center) > 0
+        queued = snapshot.speeds[rows] < QUEUED_SPEED
+        approaching = snapshot.alive[rows] & (distance < APPROACH_RADIUS) & (towards | queued)
+        # the light of a vehicle's approach is the one closest to it
+        offsets = positions[:, None, :] - self.light_positions[None, :, :]
+        squared = np.einsum("vlk,vlk->vl", offsets, offsets)
+        closest = squared.argmin(axis=1)
+        light_distance = np.sqrt(squared[np.arange(len(closest)), closest])
+        return [(jids[actor_ids[i]], int(closest[i]), bool(queued[i]), float(light_distance[i]))
+                for i in np.flatnonzero(approaching)]
+
+    def departure_offsets(self, approaching, lights):
+        # platoon launch: {jid: seconds to wait} for the vehicles queued at `lights`,
+        # the front of the queue goes first and every follower launch_headway later
+        offsets = {}
+        for light in lights:
+            queue = sorted((distance, jid) for jid, closest, queued, distance in approaching
+                           if closest == light and queued)
+            for position, (_, jid) in enumerate(queue):
+                offsets[jid] = position * self.schedule.launch_headway
+        return offsets
+
+    class RunTimingPlanBehaviour(SendOnlyBehaviour, spade.behaviour.CyclicBehaviour):
+        # switches the lights and sends SPaT to approaching vehicles when their light
+        # changed, when they start approaching and as a heartbeat, every SPAT_POLL_PERIOD
+        # of simulated time when the agent has the launcher's clock
+        async def run(self):
+            agent = self.agent
+            signals = signal_states(agent.schedule, agent.elapsed_seconds(), agent.poles)
+            states = []
+            turned_green = []
+            for index, (light, pole) in enumerate(zip(agent.traffic_lights, agent.poles)):
+                state = signals[pole][0]
+                states.append(state)
+                if agent.states.get(light.id) != state:
+                    light.set_state(getattr(carla.TrafficLightState, state))
+                    agent.states[light.id] = state
+                    if state == "Green":
+                        turned_green.append(index)
+            approaching = agent.approaching_vehicles()
+            departures = {}
+            if turned_green and agent.schedule.launch_headway is not None:
+                # the queue is taken from this one snapshot, the vehicles do not look themselves
+                departures = agent.departure_offsets(approaching, turned_green)
+            # any light of the intersection changing resends to every approaching vehicle
+            due = set(agent.due_receivers(tuple(states), [jid for jid, _, _, _ in approaching]))
+            for jid, light, _, _ in approaching:
+                if jid not in due:
+                    continue
+                state, time_to_change = signals[agent.poles[light]]
+                x, y = agent.light_positions[light].tolist()
+                await self.send(spat_message(jid, encode_spat(state, x, y, time_to_change, departures.get(jid))))
+                agent.spat_sent += 1
+            await sleep_simulated(agent, SPAT_POLL_PERIOD)
 
     async def setup(self):
-        self.add_behaviour(self.SendLightStateBehaviour(period=0.5), None)
\ No newline at end of file
+        if self.fleet_registry_jid:
+            add_fleet_behaviours(self, self.fleet_registry_jid, request="subscribe")
+        # the server's own light cycle must not switch them in between
+        for light in self.traffic_lights:
+            light.freeze(True)
+        self.add_behaviour(self.RunTimingPlanBehaviour(), None)
+
+
+def create_intersection_agents(world, light_index, plan, records=None, fleet_registry_jid=None, bus=None):
+    # one IntersectionAgent per traffic light group of `records` (default every light of the map)
+    agents = []
+    for group in light_index.groups(records):
+        group_records = [light_index.records[light_id] for light_id in group if light_id in light_index.records]
+        lights = light_index.actors(group_records)
+        if not lights:
+            continue
+        positions = [(light_index.records[light.id].x, light_index.records[light.id].y) for light in lights]
+        agent = IntersectionAgent(f"intersection{lights[0].id}@localhost", f"pass{lights[0].id}", lights, positions,
+                                  None, world, fleet_registry_jid=fleet_registry_jid, bus=bus)
+        agent.schedule = schedule_for(plan, tuple(agent.center.tolist()), agent.poles)
+        agents.append(agent)
+    return agents
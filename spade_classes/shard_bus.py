@@ -0,0 +1,100 @@
+import threading
+
+import spade
+
+from spade_classes.message_bus import MessageBus
+
+# MessageBus for agents spread over several worker processes (--workers).
+# Each shard delivers to its own agents as MessageBus does; a message for an
+# agent of another shard is packed into a plain tuple and put on that shard's
+# multiprocessing queue, batched per destination shard once per event loop
+# pass. A room publish reaches every other worker shard once and is fanned
+# out there to the local occupants, like the MUC server does for XMPP.
+# The coordinator process is a shard too: its service agents (the fleet
+# registry, the intersection controllers) are reached by every jid that is
+# not a vehicle's, and they do not join rooms.
+
+
+def pack_message(msg):
+    return (str(msg.to) if msg.to else None, str(msg.sender) if msg.sender else None, msg.body, msg.thread,
+            dict(msg.metadata))
+
+
+def unpack_message(packed):
+    to, sender, body, thread, metadata = packed
+    return spade.message.Message(to=to, sender=sender, body=body, thread=thread, metadata=metadata)
+
+
+class ShardBus(MessageBus):
+    def __init__(self, shard, shard_inboxes, owners, coordinator):
+        # shard_inboxes are the multiprocessing queues of all shards, owners maps the vehicles' jids to
+        # their shard; any other jid belongs to the coordinator's shard
+        super().__init__()
+        self.shard = shard
+        self.shard_inboxes = shard_inboxes
+        self.owners = owners
+        self.coordinator = coordinator
+        self.outgoing = {}
+        self.flush_handle = None
+        self.forwarded = 0
+        self.loop = None
+        self.reader = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.reader = threading.Thread(target=self._read, name=f"shard-bus-{self.shard}", daemon=True)
+        self.reader.start()
+
+    def stop(self):
+        self._flush()
+        # wakes up the reader thread, it must be done before the queue is closed at exit
+        self.shard_inboxes[self.shard].put(None)
+        if self.reader is not None:
+            self.reader.join(1.0)
+            self.reader = None
+
+    def _read(self):
+        inbox = self.shard_inboxes[self.shard]
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                return
+            try:
+                self.loop.call_soon_threadsafe(self._receive, batch)
+            except RuntimeError:
+                # loop closed, this shard is shutting down
+                return
+
+    def _receive(self, batch):
+        for jid, room_jid, packed in batch:
+            msg = unpack_message(packed)
+            if room_jid is None:
+                MessageBus.deliver(self, jid, msg)
+            else:
+                MessageBus.publish(self, room_jid, msg)
+
+    def deliver(self, jid, msg):
+        shard = self.owners.get(jid, self.coordinator)
+        if shard == self.shard or jid in self.inboxes:
+            return super().deliver(jid, msg)
+        self._forward(shard, (jid, None, pack_message(msg)))
+        return True
+
+    def publish(self, room_jid, msg):
+        super().publish(room_jid, msg)
+        packed = pack_message(msg)
+        for shard in range(len(self.shard_inboxes)):
+            if shard != self.shard and shard != self.coordinator:
+                self._forward(shard, (None, room_jid, packed))
+
+    def _forward(self, shard, item):
+        self.outgoing.setdefault(shard, []).append(item)
+        self.forwarded += 1
+        if self.flush_handle is None and self.loop is not None:
+            self.flush_handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_handle = None
+        outgoing, self.outgoing = self.outgoing, {}
+        for shard, batch in outgoing.items():
+            self.shard_inboxes[shard].put(batch)
@@ -0,0 +1,75 @@
+import asyncio
+import spade
+
+
+class TimedControlBehaviour(spade.behaviour.OneShotBehaviour):
+    # Takes the car off autopilot, holds `control` for `hold` seconds and gives
+    # the car back to the autopilot. Seconds are simulated, see sleep_simulated. Runs as its own behaviour so the one that
+    # started it (e.g. ParseBSM) keeps draining its mailbox meanwhile.
+    # `slot` is the agent attribute that points to the running manoeuvre, it is
+    # cleared on release so callers can skip triggering a second one.
+    # With `delay` the car waits that many seconds before taking control,
+    # cancel() in the meantime calls the manoeuvre off.
+    def __init__(self, control, hold, slot, delay=0.0):
+        super().__init__()
+        self.control = control
+        self.hold = hold
+        self.slot = slot
+        self.delay = delay
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    async def run(self):
+        if self.delay > 0:
+            await sleep_simulated(self.agent, self.delay)
+        vehicle = self.agent.carla_vehicle
+        if self.cancelled or not vehicle.is_alive:
+            return
+        take_control(self.agent, vehicle, self.control)
+        await sleep_simulated(self.agent, self.hold)
+        if vehicle.is_alive:
+            release_control(self.agent, vehicle)
+
+    async def on_end(self):
+        # spade removes the finished behaviour from the agent itself
+        if getattr(self.agent, self.slot, None) is self:
+            setattr(self.agent, self.slot, None)
+
+
+def sleep_simulated(agent, seconds):
+    # on the launcher's SimulationClock (agent.clock), agents without one sleep on the wall clock
+    clock = getattr(agent, "clock", None)
+    if clock is None:
+        return asyncio.sleep(seconds)
+    return clock.sleep(seconds)
+
+
+def take_control(agent, vehicle, control):
+    # through the launcher's ControlQueue when there is one, otherwise straight to the server
+    control_queue = getattr(agent, "control_queue", None)
+    if control_queue is None:
+        vehicle.set_autopilot(False)
+        vehicle.apply_control(control)
+    else:
+        control_queue.set_autopilot(vehicle.id, False)
+        control_queue.apply_control(vehicle.id, control)
+
+
+def release_control(agent, vehicle):
+    control_queue = getattr(agent, "control_queue", None)
+    if control_queue is None:
+        vehicle.set_autopilot(True)
+    else:
+        control_queue.set_autopilot(vehicle.id, True)
+
+
+def start_timed_control(agent, control, hold, slot, delay=0.0):
+    # returns False when a manoeuvre is already running (or waiting to start) in `slot`
+    if getattr(agent, slot, None) is not None:
+        return False
+    behaviour = TimedControlBehaviour(control, hold, slot, delay)
+    setattr(agent, slot, behaviour)
+    agent.add_behaviour(behaviour)
+    return True